@@ -0,0 +1,316 @@
+"""
+LLM呼び出しの受付制御モジュール
+利用者ごとのトークンバケット（補充速度・連続利用の上限）と、上流のLLMへの同時リクエスト数の上限＋
+優先度付きの待ち行列を提供（待つ間は順番と待ち時間の見込みを呼び出し元に知らせる）
+生徒の質問（対話）はFAQの事前生成・会話履歴の要約・一括評価（バックグラウンド）より先に処理し、
+バックグラウンドの同時実行数は別に制限して、対話の待ち時間がバックグラウンドの処理に左右されないようにする
+"""
+
+import bisect
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import constants as ct
+from metrics import metrics_registry
+
+# 優先度（小さいほど先に処理）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class AdmissionRejected(RuntimeError):
+    """受け付けられないリクエスト（retry_after秒後に再試行できる見込み）"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RequestCancelled(RuntimeError):
+    """待つ間に依頼元（Streamlitのセッションなど）が無くなったため取り消したリクエスト"""
+
+
+class Slot:
+    """受付済みのリクエスト（処理の開始時刻と期限）"""
+
+    def __init__(self, priority: int, deadline: float, started: float = None):
+        self.priority = priority
+        self.deadline = deadline
+        self.started = time.monotonic() if started is None else started
+
+    def remaining(self) -> float:
+        """期限までの残り秒数（LLMの呼び出しのタイムアウトに使う）"""
+        return max(0.0, self.deadline - time.monotonic())
+
+
+class TokenBucket:
+    """トークンバケット（rate_per_second で補充、最大 burst 個まで貯まる）"""
+
+    def __init__(self, rate_per_second: float, burst: int):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def reserve(self, max_wait: float) -> float:
+        """
+        1トークンを予約
+
+        Args:
+            max_wait: トークンが貯まるまで待てる最大秒数
+
+        Returns:
+            トークンが貯まるまでの秒数（0ならすぐ使える）。max_waitを超える場合は予約せずに負の値で返す
+        """
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, (1 - self.tokens) / self.rate_per_second)
+        if wait > max_wait:
+            return -wait
+        self.tokens -= 1
+        return wait
+
+    def refund(self):
+        """予約したトークンを返す（待ち行列に入れなかった場合など）"""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def available(self) -> float:
+        """今すぐ使えるトークン数"""
+        self._refill(time.monotonic())
+        return max(0.0, self.tokens)
+
+
+class AdmissionController:
+    """
+    LLM呼び出しの受付制御（プロセス内で共有）
+    1. 利用者ごとのトークンバケットで、1人が短時間に大量に送っても他の利用者の枠を使い切らないようにする
+    2. 同時リクエスト数の上限を超えた分は優先度・到着順に待たせ、順番と待ち時間の見込みを知らせる
+    3. 期限（待ち時間＋LLMの呼び出し）を過ぎたリクエスト、依頼元が無くなったリクエストは待ち行列から外す
+    """
+
+    def __init__(self, rate_per_minute: float = ct.ADMISSION_USER_RATE_PER_MINUTE,
+                 burst: int = ct.ADMISSION_USER_BURST,
+                 max_concurrent: int = ct.ADMISSION_MAX_CONCURRENT,
+                 max_background_concurrent: int = ct.ADMISSION_MAX_BACKGROUND_CONCURRENT,
+                 max_queue: int = ct.ADMISSION_MAX_QUEUE,
+                 max_wait_seconds: float = ct.ADMISSION_MAX_WAIT_SECONDS,
+                 max_tracked_users: int = ct.ADMISSION_MAX_TRACKED_USERS):
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_background_concurrent = max_background_concurrent
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.max_tracked_users = max_tracked_users
+        self.deadline_seconds = {
+            PRIORITY_INTERACTIVE: ct.LLM_INTERACTIVE_DEADLINE_SECONDS,
+            PRIORITY_BACKGROUND: ct.LLM_BACKGROUND_DEADLINE_SECONDS,
+        }
+        self._condition = threading.Condition()
+        self._buckets = OrderedDict()
+        self._queue = []  # (優先度, 到着順) の昇順
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._background_in_flight = 0
+        # 1リクエストの処理時間（対話の指数移動平均）。待ち時間の見込みに使う
+        self._service_seconds = ct.ADMISSION_INITIAL_SERVICE_SECONDS
+        self.admitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.total_wait_seconds = 0.0
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate_per_second, self.burst)
+            # しばらく利用の無い利用者のバケットから捨てる（捨てられた利用者は満タンから再開）
+            while len(self._buckets) > self.max_tracked_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def _estimate_wait(self, position: int) -> float:
+        """待ち行列のposition番目（1始まり）が処理を始めるまでの見込み秒数"""
+        return position * self._service_seconds / self.max_concurrent
+
+    def _has_capacity(self, priority: int) -> bool:
+        """同時実行の空きがあるか（バックグラウンドは専用の上限の範囲内のみ）"""
+        if self._in_flight >= self.max_concurrent:
+            return False
+        return priority == PRIORITY_INTERACTIVE or self._background_in_flight < self.max_background_concurrent
+
+    def _wait_for_bucket(self, bucket_wait: float, on_wait, is_cancelled):
+        """利用者の枠が回復するまで待つ（予約済みのため、他の利用者の枠は減らない）"""
+        until = time.monotonic() + bucket_wait
+        while (remaining := until - time.monotonic()) > 0:
+            if is_cancelled and is_cancelled():
+                raise RequestCancelled("依頼元のセッションが終了したため取り消しました。")
+            if on_wait:
+                on_wait(0, remaining)
+            time.sleep(min(1.0, remaining))
+
+    def acquire(self, user_id: str = None, on_wait=None, priority: int = PRIORITY_INTERACTIVE,
+                deadline_seconds: float = None, is_cancelled=None) -> Slot:
+        """
+        LLMを呼び出す前に、受付（利用者の枠と同時実行の空き）を待つ
+
+        Args:
+            user_id: 利用者の識別子（セッションID・生徒ID・接続元など）。Noneの場合は利用者ごとの制限を行わない
+            on_wait: 待つ間に (待ち行列の順番（利用者の枠の回復を待つ場合は0）, 待ち時間の見込み秒数) を受け取る関数
+            priority: PRIORITY_INTERACTIVE（生徒の質問）またはPRIORITY_BACKGROUND（事前生成・要約・評価）
+            deadline_seconds: 待ち時間とLLMの呼び出しを合わせた期限（Noneの場合は優先度ごとの既定値）
+            is_cancelled: 依頼元が無くなった場合にTrueを返す関数（待つ間に確認し、Trueなら取り消す）
+
+        Returns:
+            受付済みのSlot（release()に渡す。remaining()をLLMの呼び出しのタイムアウトに使う）
+
+        Raises:
+            AdmissionRejected: 利用者の枠の回復・待ち行列の待ち時間が長すぎる、待ち行列がいっぱい、または期限切れの場合
+            RequestCancelled: 待つ間に依頼元が無くなった場合
+        """
+        started = time.monotonic()
+        if deadline_seconds is None:
+            deadline_seconds = self.deadline_seconds[priority]
+        deadline = started + deadline_seconds
+        max_wait = min(self.max_wait_seconds, deadline_seconds)
+
+        bucket = None
+        if user_id is not None and priority == PRIORITY_INTERACTIVE:
+            with self._condition:
+                bucket = self._bucket(user_id)
+                bucket_wait = bucket.reserve(max_wait)
+                if bucket_wait < 0:
+                    self.rejected += 1
+                    raise AdmissionRejected(
+                        f"短時間に質問が集中しています。約{-bucket_wait:.0f}秒後にもう一度お試しください。", -bucket_wait
+                    )
+            try:
+                self._wait_for_bucket(bucket_wait, on_wait, is_cancelled)
+            except BaseException as e:
+                with self._condition:
+                    bucket.refund()
+                    if isinstance(e, RequestCancelled):
+                        self.cancelled += 1
+                raise
+
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            bisect.insort(self._queue, entry)
+            try:
+                if self._queue[0] != entry or not self._has_capacity(priority):
+                    # 対話は見込みの待ち時間が長すぎる場合はすぐに断る（対話は常にバックグラウンドより前に並ぶ）
+                    position = self._queue.index(entry) + 1
+                    estimated = self._estimate_wait(position)
+                    if priority == PRIORITY_INTERACTIVE and (position > self.max_queue or estimated > max_wait):
+                        self.rejected += 1
+                        raise AdmissionRejected(
+                            f"ただいま混み合っています（待ち{position - 1}件）。約{estimated:.0f}秒後にもう一度お試しください。",
+                            estimated
+                        )
+
+                # 優先度・到着順に、先頭かつ空きがあるときだけ進む
+                while self._queue[0] != entry or not self._has_capacity(priority):
+                    if is_cancelled and is_cancelled():
+                        self.cancelled += 1
+                        raise RequestCancelled("依頼元のセッションが終了したため取り消しました。")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.expired += 1
+                        raise AdmissionRejected(
+                            "ただいま混み合っているため、時間内に回答を始められませんでした。もう一度お試しください。",
+                            self._estimate_wait(self._queue.index(entry) + 1)
+                        )
+                    if on_wait:
+                        position = self._queue.index(entry) + 1
+                        self._condition.release()
+                        try:
+                            on_wait(position, self._estimate_wait(position))
+                        finally:
+                            self._condition.acquire()
+                    self._condition.wait(timeout=min(1.0, remaining))
+            except BaseException:
+                # 断られた・待つ間に中断された場合（画面の再実行・切断など）は列から抜け、後ろの人を進める
+                self._queue.remove(entry)
+                if bucket:
+                    bucket.refund()
+                self._condition.notify_all()
+                raise
+            self._queue.pop(0)
+            # 後ろの人の順番の表示を更新させる
+            self._condition.notify_all()
+            self._in_flight += 1
+            if priority == PRIORITY_BACKGROUND:
+                self._background_in_flight += 1
+            self.admitted += 1
+            self.total_wait_seconds += time.monotonic() - started
+        return Slot(priority, deadline)
+
+    def release(self, slot: Slot):
+        """LLMの呼び出しが終わったら同時実行の枠を返し、処理時間（対話のみ）を待ち時間の見込みに反映"""
+        with self._condition:
+            self._in_flight -= 1
+            if slot.priority == PRIORITY_BACKGROUND:
+                self._background_in_flight -= 1
+            else:
+                elapsed = time.monotonic() - slot.started
+                self._service_seconds += ct.ADMISSION_SERVICE_EMA_ALPHA * (elapsed - self._service_seconds)
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, user_id: str = None, on_wait=None, priority: int = PRIORITY_INTERACTIVE,
+              deadline_seconds: float = None, is_cancelled=None):
+        """LLMを呼び出す処理をこのwith文で囲む（受付済みのSlotを返す。引数・例外はacquire()と同じ）"""
+        slot = self.acquire(user_id, on_wait, priority, deadline_seconds, is_cancelled)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def get_user_status(self, user_id: str) -> dict:
+        """利用者の残りの枠（今すぐ送れる回数）と、1回分が貯まるまでの秒数"""
+        with self._condition:
+            available = self._bucket(user_id).available()
+        return {
+            "available": int(available),
+            "burst": self.burst,
+            "seconds_per_token": 1 / self.rate_per_second,
+        }
+
+    def get_stats(self) -> dict:
+        """同時実行数・待ち行列の長さ・受付/拒否/取り消し/期限切れの件数・平均待ち時間"""
+        with self._condition:
+            background_queued = sum(1 for priority, _ in self._queue if priority == PRIORITY_BACKGROUND)
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._queue) - background_queued,
+                "background_in_flight": self._background_in_flight,
+                "background_queued": background_queued,
+                "max_concurrent": self.max_concurrent,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "expired": self.expired,
+                "avg_wait_seconds": self.total_wait_seconds / self.admitted if self.admitted else 0.0,
+                "service_seconds": self._service_seconds,
+            }
+
+
+def describe_wait(position: int, seconds: float) -> str:
+    """待ち状況の表示用メッセージ"""
+    if position == 0:
+        return f"⏳ 続けて質問しているため、約{seconds:.0f}秒後に回答を始めます..."
+    return f"⏳ ただいま混み合っています。順番待ち: {position}番目（約{seconds:.0f}秒）"
+
+
+# グローバルインスタンス（プロセス内の全セッションで共有）
+admission_controller = AdmissionController()
+metrics_registry.register_collector("admission", admission_controller.get_stats)
@@ -0,0 +1,233 @@
+"""
+FAQ事前回答（アンサーバンク）モジュール
+例示質問・よくある質問の回答をデプロイ時に事前生成し、一致する質問には即座に回答する機能を提供
+"""
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+from pathlib import Path
+import constants as ct
+from file_lock import FileLock
+from math_normalizer import NORMALIZER_VERSION
+from query_canonicalizer import canonicalize_query
+
+
+def get_prompt_version() -> str:
+    """回答生成に使うプロンプト・モデル設定・数式整形のルールからバージョン文字列を生成"""
+    payload = json.dumps([
+        ct.SYSTEM_PROMPT_STUDENT_FRIENDLY,
+        ct.USER_PROMPT_STUDENT_FRIENDLY,
+        ct.OPENAI_CHAT_MODEL,
+        ct.OPENAI_TEMPERATURE,
+        ct.OPENAI_MAX_TOKENS,
+        ct.SEARCH_K,
+        # 保存する表示用の回答（rendered）は数式整形の結果のため、ルールが変わったら作り直す
+        NORMALIZER_VERSION,
+    ], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def load_faq_questions() -> list:
+    """事前生成対象のFAQ一覧を取得（FAQファイルがあればそちらを優先）"""
+    faq_path = Path(ct.FAQ_FILE_PATH)
+    if faq_path.exists():
+        with open(faq_path, "r", encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        if questions:
+            return questions
+    return list(ct.FAQ_QUESTIONS)
+
+
+class AnswerBank:
+    """事前生成した回答の保存・検索クラス"""
+
+    def __init__(self, path: str = ct.ANSWER_BANK_PATH):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        # 読み込み→追加→書き込みの間に他のワーカーの保存を上書きしないよう、プロセス間でも排他
+        self.file_lock = FileLock(self.path.with_suffix(".lock"))
+        # 事前生成は全ワーカーで1つだけ行う（他のワーカーは保存されたファイルを読み直して使う）
+        self.warm_lock = FileLock(self.path.with_suffix(".warm.lock"))
+        self._entries = None
+        self._mtime = None
+        self._warm_status = {"running": False, "index_version": None, "generated": 0, "error": None,
+                             "finished_at": None}
+
+    def get_key(self, question: str) -> str:
+        """質問文から検索キーを生成（全角・半角、単位の読み方、丁寧語などの表記ゆれを正規化）"""
+        return canonicalize_query(question)
+
+    def _load(self) -> dict:
+        """ファイルが更新されていれば読み直し、メモリ上のエントリを返す"""
+        try:
+            mtime = self.path.stat().st_mtime_ns if self.path.exists() else None
+        except OSError:
+            mtime = None
+
+        if self._entries is None or mtime != self._mtime:
+            entries = {}
+            if mtime is not None:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        entries = json.load(f).get("entries", {})
+                    # 検索キーの作り方が変わっても引けるよう、保存されている質問文からキーを作り直す
+                    entries = {self.get_key(entry["question"]): entry for entry in entries.values()}
+                except Exception:
+                    entries = {}
+            self._entries = entries
+            self._mtime = mtime
+
+        return self._entries
+
+    def _save(self, entries: dict):
+        """エントリ一覧を一時ファイル経由で原子的に保存"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._entries = entries
+        self._mtime = self.path.stat().st_mtime_ns
+
+    def _is_fresh(self, entry: dict, index_version: str) -> bool:
+        """インデックス・プロンプトのバージョンが現在と一致するか"""
+        return (entry.get("index_version") == index_version
+                and entry.get("prompt_version") == get_prompt_version())
+
+    def lookup(self, question: str, index_version: str):
+        """一致する事前回答を取得（バージョンが古いものは返さない）"""
+        if not ct.ENABLE_ANSWER_BANK or not index_version:
+            return None
+
+        with self.lock:
+            entry = self._load().get(self.get_key(question))
+
+        if entry and self._is_fresh(entry, index_version):
+            return entry
+        return None
+
+    def store(self, question: str, answer: str, rendered: str, sources: list, index_version: str):
+        """事前回答を保存"""
+        entry = {
+            "question": question,
+            "answer": answer,
+            "rendered": rendered,
+            "sources": [
+                {
+                    "content": source["content"],
+                    "metadata": dict(source["metadata"]),
+                    "similarity_score": float(source["similarity_score"]),
+                }
+                for source in sources
+            ],
+            "index_version": index_version,
+            "prompt_version": get_prompt_version(),
+            "created_at": datetime.now().isoformat(),
+        }
+
+        with self.lock, self.file_lock:
+            entries = dict(self._load())
+            entries[self.get_key(question)] = entry
+            self._save(entries)
+
+    def invalidate_stale(self, index_version: str) -> int:
+        """インデックス・プロンプトのバージョンが変わったエントリを削除"""
+        with self.lock, self.file_lock:
+            entries = self._load()
+            fresh = {key: entry for key, entry in entries.items() if self._is_fresh(entry, index_version)}
+            removed = len(entries) - len(fresh)
+            if removed:
+                self._save(fresh)
+        return removed
+
+    def warm_up(self, answer_fn, index_version: str, questions: list = None, progress=None) -> int:
+        """
+        FAQを回答パイプラインに通して事前回答を作成
+
+        Args:
+            answer_fn: 質問を受け取り (answer, rendered, sources) を返す関数
+            index_version: 現在のインデックスのバージョン
+            questions: 対象の質問一覧（省略時はFAQ設定から読み込み）
+            progress: 進捗通知用の関数（任意）
+
+        Returns:
+            新たに生成した回答数
+        """
+        if not ct.ENABLE_ANSWER_BANK or not index_version:
+            return 0
+
+        self.invalidate_stale(index_version)
+        questions = questions if questions is not None else load_faq_questions()
+        pending = [q for q in questions if self.lookup(q, index_version) is None]
+
+        generated = 0
+        for i, question in enumerate(pending, 1):
+            if progress:
+                progress(f"FAQ回答を事前生成中 {i}/{len(pending)}: {question}")
+            try:
+                answer, rendered, sources = answer_fn(question)
+            except Exception as e:
+                if progress:
+                    progress(f"FAQ回答の生成に失敗: {question} ({e})")
+                continue
+            if answer:
+                self.store(question, answer, rendered, sources, index_version)
+                generated += 1
+
+        return generated
+
+    def start_warm_up(self, answer_fn, index_version: str, questions: list = None) -> bool:
+        """
+        バックグラウンドのスレッドでFAQの事前回答を作成（画面の操作・生徒の質問を待たせない）
+        他のスレッド・ワーカーが事前生成中の場合は何もしない
+
+        Args:
+            answer_fn: 質問を受け取り (answer, rendered, sources) を返す関数（Streamlitに依存しないもの）
+            index_version: 現在のインデックスのバージョン
+            questions: 対象の質問一覧（省略時はFAQ設定から読み込み）
+
+        Returns:
+            事前生成を開始した場合はTrue
+        """
+        if not ct.ENABLE_ANSWER_BANK or not index_version:
+            return False
+        if not self.warm_lock.acquire(blocking=False):
+            return False
+
+        with self.lock:
+            self._warm_status = {"running": True, "index_version": index_version, "generated": 0, "error": None,
+                                 "finished_at": None}
+
+        def run():
+            generated, error = 0, None
+            try:
+                generated = self.warm_up(answer_fn, index_version, questions)
+            except Exception as e:
+                error = str(e)
+            finally:
+                self.warm_lock.release()
+                with self.lock:
+                    self._warm_status = {"running": False, "index_version": index_version, "generated": generated,
+                                         "error": error, "finished_at": datetime.now().isoformat()}
+
+        threading.Thread(target=run, name="answer-bank-warm-up", daemon=True).start()
+        return True
+
+    def get_warm_up_status(self) -> dict:
+        """このプロセスでの事前生成の状態（実行中か・対象のバージョン・生成数・エラー・終了時刻）"""
+        with self.lock:
+            return dict(self._warm_status)
+
+    def get_stats(self, index_version: str) -> dict:
+        """事前回答の件数を取得"""
+        with self.lock:
+            entries = self._load()
+        fresh = sum(1 for entry in entries.values() if self._is_fresh(entry, index_version))
+        return {"total": len(entries), "fresh": fresh}
+
+
+# グローバルインスタンス
+answer_bank = AnswerBank()
@@ -0,0 +1,312 @@
+"""
+このファイルは、RAGパイプライン（FAISS検索＋回答生成）をHTTP APIとして提供する非同期サーバーです。
+Streamlitの画面を経由せずに、学校のLMSや負荷試験ツールから直接利用できます。
+
+起動例:
+    python api_server.py --port 8000 --workers 2
+
+エンドポイント:
+    GET  /health      インデックスの読み込み状態（読み込み完了前は503）
+    POST /v1/answer   質問への回答（"stream": true の場合はServer-Sent Eventsで生成された順に返す）
+    POST /v1/search   複数の検索クエリをまとめてFAISS検索
+    GET  /metrics     処理段階ごとの所要時間・回数（Prometheusのテキスト形式、ワーカーごとの値）
+
+環境変数「RAG_API_KEY」を設定した場合は、「Authorization: Bearer <キー>」ヘッダーが必要になります。
+LLMでの回答生成は利用者ごとに回数を制限します（「X-User-Id」ヘッダー、無い場合は接続元のアドレスごと）。
+制限を超えた場合・混み合っている場合は429（Retry-Afterヘッダー付き）を返します。
+LLMで回答を生成できない場合（失敗・遅延の継続、日次の上限）は、教科書の抜粋を「degraded」に理由を付けて返します。
+インデックスは画面と同じ永続化データ（data/vector_store/）を共有し、新しいバージョンが公開されると切り替えます。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import argparse
+import asyncio
+import json
+import math
+import os
+import secrets
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+import constants as ct
+import index_loader as il
+import rag_pipeline
+from admission import AdmissionRejected
+from metrics import configure_otel_exporter, metrics_registry
+
+
+############################################################
+# 設定関連
+############################################################
+load_dotenv()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # ワーカーごとに、起動直後からバックグラウンドでインデックスを読み込む
+    il.index_loader.start()
+    # OTEL_EXPORTER_OTLP_ENDPOINTが設定されていれば、処理時間の計測値をOpenTelemetryで送信
+    configure_otel_exporter()
+    yield
+
+
+app = FastAPI(title=f"{ct.APP_NAME} API", lifespan=lifespan)
+
+
+class AnswerRequest(BaseModel):
+    question: str = Field(..., min_length=1, max_length=ct.API_MAX_QUESTION_CHARS)
+    mode: str = Field(ct.ANSWER_MODE_2, description=f"{ct.ANSWER_MODE_2}（LLMで回答）または{ct.ANSWER_MODE_1}（教科書の抜粋）")
+    stream: bool = False
+
+
+class SearchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=ct.API_MAX_BATCH_QUERIES)
+    k: int = Field(ct.FAISS_SEARCH_K, ge=1, le=ct.API_MAX_SEARCH_K)
+
+
+############################################################
+# 共通処理
+############################################################
+
+def verify_api_key(authorization: Optional[str] = Header(None)):
+    """
+    RAG_API_KEYが設定されている場合のみ、Bearerトークンを確認
+    """
+    api_key = os.getenv("RAG_API_KEY")
+    if not api_key:
+        return
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token, api_key):
+        raise HTTPException(status_code=401, detail="APIキーが正しくありません。")
+
+
+def get_user_id(request: Request, x_user_id: Optional[str] = Header(None)):
+    """
+    受付制御で枠を数える利用者の識別子（X-User-Idヘッダー、無い場合は接続元のアドレス）
+    """
+    if x_user_id:
+        return f"user:{x_user_id}"
+    return f"host:{request.client.host if request.client else 'unknown'}"
+
+
+def get_ready_index():
+    """
+    読み込み済みのインデックスを取得（新しいバージョンが公開されていれば読み込み直しを開始）
+    """
+    il.index_loader.check_for_update()
+    index = il.index_loader.get_index()
+    if index is None:
+        status = il.index_loader.get_status()
+        detail = status["error"] if status["state"] == il.STATE_FAILED else "インデックスを読み込み中です。"
+        raise HTTPException(status_code=503, detail=detail)
+    return index
+
+
+def format_source(result):
+    """
+    検索結果をJSONで返す形に変換
+    """
+    return {
+        "source_file": result["metadata"].get("source_file", "unknown"),
+        "page": result["metadata"].get("page"),
+        "similarity_score": float(result["similarity_score"]),
+        "content": result["content"],
+    }
+
+
+def sse_event(event, data):
+    """
+    Server-Sent Eventsの1イベント
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def find_prepared_answer(question, index):
+    """
+    事前生成済みのFAQ回答、または回路計算ソルバーの回答（LLMの解説なし）を探す
+
+    Returns:
+        (回答, 検索結果, 回答元) のタプル（無い場合はNone）
+    """
+    from answer_bank import answer_bank
+
+    entry = answer_bank.lookup(question, index["version"])
+    if entry:
+        return entry["answer"], entry["sources"], "answer_bank"
+
+    if ct.ENABLE_CIRCUIT_SOLVER and not ct.CIRCUIT_SOLVER_LLM_EXPLANATION:
+        import circuit_solver
+        solution = circuit_solver.solve_question(question)
+        if solution:
+            return rag_pipeline.finish_solver_answer(solution), [], "circuit_solver"
+
+    return None
+
+
+async def prepare_answer(question, mode, index):
+    """
+    生成前までの処理（事前回答・ソルバー・検索）をスレッドで実行
+
+    Returns:
+        (回答または None, 検索結果, 回答元) のタプル（回答がNoneの場合はLLMで生成する）
+    """
+    if mode == ct.ANSWER_MODE_2:
+        prepared = await run_in_threadpool(find_prepared_answer, question, index)
+        if prepared:
+            return prepared
+
+    search_results = await run_in_threadpool(rag_pipeline.search, index["vectorstore"], question, ct.FAISS_SEARCH_K)
+    if not search_results:
+        return ct.NO_SEARCH_RESULTS_MESSAGE, [], "no_results"
+    if mode == ct.ANSWER_MODE_1:
+        return rag_pipeline.format_search_answer(question, search_results), search_results, "search"
+    return None, search_results, "llm"
+
+
+############################################################
+# エンドポイント
+############################################################
+
+@app.get("/health")
+async def health():
+    il.index_loader.check_for_update()
+    status = il.index_loader.get_status()
+    body = {
+        "status": "ok" if status["state"] == il.STATE_READY else status["state"],
+        "index": status,
+    }
+    return JSONResponse(body, status_code=200 if status["state"] == il.STATE_READY else 503)
+
+
+@app.get("/metrics", dependencies=[Depends(verify_api_key)])
+async def metrics():
+    return PlainTextResponse(metrics_registry.to_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.post("/v1/search", dependencies=[Depends(verify_api_key)])
+async def search(request: SearchRequest):
+    index = get_ready_index()
+    # クエリごとの埋め込み・検索を並行して実行（FAISSの検索中はGILを解放する）
+    results = await asyncio.gather(*[
+        run_in_threadpool(rag_pipeline.search, index["vectorstore"], query, request.k)
+        for query in request.queries
+    ])
+    return {
+        "index_version": index["version"],
+        "results": [
+            {"query": query, "hits": [format_source(result) for result in hits]}
+            for query, hits in zip(request.queries, results)
+        ],
+    }
+
+
+@app.post("/v1/answer", dependencies=[Depends(verify_api_key)])
+async def answer(request: AnswerRequest, user_id: str = Depends(get_user_id)):
+    if request.mode not in (ct.ANSWER_MODE_1, ct.ANSWER_MODE_2):
+        raise HTTPException(status_code=422, detail=f"未対応のモードです: {request.mode}")
+
+    index = get_ready_index()
+    prepared, search_results, answered_by = await prepare_answer(request.question, request.mode, index)
+    sources = [format_source(result) for result in search_results]
+
+    if request.stream:
+        return StreamingResponse(
+            stream_answer(request.question, prepared, search_results, sources, answered_by, index["version"], user_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    degraded = None
+    if prepared is None:
+        context_text = rag_pipeline.build_context(search_results)
+        try:
+            generated = await run_in_threadpool(
+                rag_pipeline.generate_student_answer, request.question, context_text, user_id=user_id
+            )
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+        except rag_pipeline.GenerationUnavailable as e:
+            # LLMが使えない間は教科書の抜粋ですぐに回答する
+            degraded = str(e)
+            answered_by = "extractive_fallback"
+            prepared = rag_pipeline.format_degraded_answer(request.question, search_results, e)
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=f"回答の生成に失敗しました: {e}")
+        else:
+            prepared = rag_pipeline.finish_student_answer(generated, search_results)
+
+    return {
+        "answer": prepared,
+        "mode": request.mode,
+        "answered_by": answered_by,
+        "degraded": degraded,
+        "index_version": index["version"],
+        "sources": sources,
+    }
+
+
+async def stream_answer(question, prepared, search_results, sources, answered_by, index_version, user_id=None):
+    """
+    回答をServer-Sent Eventsで返す
+    （sources → delta（生成された断片）→ done（数式表示・参考情報を整えた回答全体）の順。エラー時は error）
+    """
+    yield sse_event("sources", {"answered_by": answered_by, "index_version": index_version, "sources": sources})
+
+    if prepared is not None:
+        yield sse_event("delta", {"text": prepared})
+        yield sse_event("done", {"answer": prepared})
+        return
+
+    parts = []
+    try:
+        async for text in rag_pipeline.astream_student_answer(question, rag_pipeline.build_context(search_results), user_id):
+            parts.append(text)
+            yield sse_event("delta", {"text": text})
+    except AdmissionRejected as e:
+        yield sse_event("error", {"detail": str(e), "retry_after": math.ceil(e.retry_after)})
+        return
+    except rag_pipeline.GenerationUnavailable as e:
+        if parts:
+            # 途中まで返した後の失敗は、抜粋に差し替えられないためエラーとして知らせる
+            yield sse_event("error", {"detail": str(e)})
+            return
+        fallback = rag_pipeline.format_degraded_answer(question, search_results, e)
+        yield sse_event("delta", {"text": fallback})
+        yield sse_event("done", {"answer": fallback, "degraded": str(e)})
+        return
+    except Exception as e:
+        yield sse_event("error", {"detail": str(e)})
+        return
+
+    yield sse_event("done", {"answer": rag_pipeline.finish_student_answer("".join(parts), search_results)})
+
+
+############################################################
+# 起動処理
+############################################################
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="RAGパイプラインのHTTP APIサーバー")
+    parser.add_argument("--host", default=ct.API_HOST)
+    parser.add_argument("--port", type=int, default=ct.API_PORT)
+    parser.add_argument("--workers", type=int, default=1, help="ワーカープロセス数（インデックスの作成は1プロセスだけが行う）")
+    return parser
+
+
+def main(argv=None):
+    import uvicorn
+
+    config = build_arg_parser().parse_args(argv)
+    uvicorn.run("api_server:app", host=config.host, port=config.port, workers=config.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+画面の初回表示に必要なモジュールの読み込み時間の計測（python -X importtime を利用）
+Streamlit本体（サーバー起動時に読み込み済み）を除いた、アプリのモジュールの読み込み時間と、
+初回表示の時点でLangChain・FAISSなどの重いライブラリを読み込んでいないことを確認する
+
+使い方:
+    python benchmarks/bench_import_time.py [--repeat 5] [--budget-ms 300] [--json result.json]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# サーバー起動時に読み込み済みのため、計測から除くモジュール
+BASELINE_MODULES = ["streamlit", "dotenv"]
+
+# 画面の初回表示で読み込むモジュール
+SHELL_MODULES = ["constants", "app_init", "components", "cost_optimizer", "utils", "main"]
+
+# 初回表示の時点で読み込まれていてはいけないパッケージ（検索の初回利用時・バックグラウンドで読み込む）
+DEFERRED_PACKAGES = ["langchain", "langchain_core", "langchain_community", "langchain_openai",
+                     "langchain_text_splitters", "faiss", "numpy", "openai", "tiktoken", "fitz"]
+
+
+def parse_importtime(stderr: str) -> list:
+    """-X importtime の出力を (モジュール名, 自身の時間µs, 累計µs, 階層) のリストに変換"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def measure(module: str) -> dict:
+    """1モジュールの読み込み時間と、読み込まれた重いパッケージを計測"""
+    code = "".join(f"import {name}; " for name in BASELINE_MODULES) + f"import {module}"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{module} の読み込みに失敗しました:\n{result.stderr[-2000:]}")
+
+    rows = parse_importtime(result.stderr)
+    # ベースラインの読み込みが終わった後の行だけを対象にする
+    baseline_end = max(i for i, (name, _, _, depth) in enumerate(rows) if depth == 0 and name in BASELINE_MODULES)
+    rows = rows[baseline_end + 1:]
+    total_us = next(cumulative for name, _, cumulative, depth in rows if depth == 0 and name == module)
+    deferred = sorted({name.split(".")[0] for name, _, _, _ in rows if name.split(".")[0] in DEFERRED_PACKAGES})
+    heaviest = sorted(rows, key=lambda row: -row[1])[:5]
+    return {
+        "module": module,
+        "total_ms": total_us / 1000,
+        "deferred_packages_loaded": deferred,
+        "heaviest": [{"module": name, "self_ms": self_us / 1000} for name, self_us, _, _ in heaviest],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数（最小値を採用）")
+    parser.add_argument("--budget-ms", type=float, default=300.0, help="1モジュールあたりの読み込み時間の上限（ミリ秒）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    results = []
+    failures = 0
+    print(f"{'モジュール':<18}{'読み込み(ms)':>14}  重いライブラリ")
+    for module in SHELL_MODULES:
+        runs = [measure(module) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run["total_ms"])
+        results.append(best)
+        over_budget = best["total_ms"] > args.budget_ms
+        failures += bool(best["deferred_packages_loaded"]) + over_budget
+        loaded = ", ".join(best["deferred_packages_loaded"]) or "なし"
+        print(f"{module:<18}{best['total_ms']:>14.1f}  {loaded}{'  [上限超過]' if over_budget else ''}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"budget_ms": args.budget_ms, "results": results}, f, ensure_ascii=False, indent=2)
+
+    print(f"\n問題 {failures}件（重いライブラリの読み込み・上限超過）")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""
+インデックス作成・検索のオフラインベンチマーク（ネットワーク・APIキー不要）
+data/教科書データのPDFを複製して1倍・10倍・100倍のコーパスを作り、規模ごとに次を計測してJSONに保存する
+    PDFの読み込み（ページ/秒）・チャンク分割・前処理・埋め込み（チャンク/秒）・FAISSインデックスの作成・
+    保存・読み込みの時間、インデックスのサイズ、メモリ使用量（RSS）、検索（rag_pipeline.search・FAISSのみ）のp50/p99
+埋め込みは既定で決定的な偽の埋め込み（text-embedding-3-smallと同じ次元数の乱数ベクトル）を使う
+（--embeddings stub の場合はOPENAI_BASE_URLのスタブサーバー（mock_openai_server.py）を使う。LLMは使わない）
+規模の影響を見るため、チャンク数の上限（MAX_CHUNKS）は適用しない
+規模ごとに別のプロセスで計測し、メモリ使用量が前の規模の影響を受けないようにする
+
+使い方:
+    python benchmarks/bench_ingestion.py [--scales 1 10 100] [--queries 200] [--json result.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+import constants as ct  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+
+SOURCE_DIR = ROOT / "data" / "教科書データ"
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+############################################################
+# 計測の補助
+############################################################
+
+def current_rss_mb():
+    """現在の常駐メモリ（MB、取得できない環境ではNone）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    """プロセス開始からの最大常駐メモリ（MB、取得できない環境ではNone）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def directory_size_mb(path: Path) -> float:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file()) / 1024 / 1024
+
+
+def git_commit():
+    """計測したコミット（gitが無い場合はNone）と、未コミットの変更があるか"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def create_embeddings(kind: str):
+    """埋め込みモデル（fake: 決定的な乱数ベクトル / stub: OPENAI_BASE_URLのスタブサーバー）"""
+    if kind == "fake":
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        return DeterministicFakeEmbedding(size=ct.STUB_EMBEDDING_DIMENSIONS)
+
+    import llm_client
+    if not llm_client.get_base_url():
+        raise SystemExit("--embeddings stub にはOPENAI_BASE_URL（スタブサーバーの接続先）の設定が必要です。")
+    return llm_client.create_embeddings()
+
+
+def replicate_corpus(source_files: list, scale: int, corpus_dir: Path) -> list:
+    """元のPDFをscale回分、別の名前で並べたコーパス（シンボリックリンク、作れない環境ではコピー）"""
+    import shutil
+
+    paths = []
+    for copy in range(scale):
+        for source in source_files:
+            path = corpus_dir / f"{source.stem}_{copy:03d}{source.suffix}"
+            try:
+                os.symlink(source, path)
+            except OSError:
+                shutil.copyfile(source, path)
+            paths.append(str(path))
+    return paths
+
+
+def build_queries(count: int) -> list:
+    """検索に使う質問（FAQの質問を繰り返して件数を揃える）"""
+    return [ct.FAQ_QUESTIONS[i % len(ct.FAQ_QUESTIONS)] for i in range(count)]
+
+
+############################################################
+# 1規模分の計測（別プロセスで実行）
+############################################################
+
+def run_scale(scale: int, embeddings_kind: str, query_count: int) -> dict:
+    from langchain_community.vectorstores import FAISS
+
+    import index_loader
+    import rag_pipeline
+    from chunk_preprocessor import preprocess_chunks
+    from cost_optimizer import VectorStoreManager
+
+    source_files = sorted(SOURCE_DIR.glob("*.pdf"))
+    embeddings = create_embeddings(embeddings_kind)
+    result = {"scale": scale, "files": len(source_files) * scale, "rss_start_mb": current_rss_mb()}
+
+    with tempfile.TemporaryDirectory(prefix="bench_ingestion_") as temp_dir:
+        corpus_dir = Path(temp_dir) / "corpus"
+        corpus_dir.mkdir()
+        paths = replicate_corpus(source_files, scale, corpus_dir)
+
+        # PDFの読み込み
+        started = time.perf_counter()
+        documents = index_loader.load_pdf_documents(paths, report=lambda message: None)
+        seconds = time.perf_counter() - started
+        result["pages"] = len(documents)
+        result["pdf_load_seconds"] = seconds
+        result["pdf_pages_per_second"] = len(documents) / seconds
+
+        # チャンク分割・前処理
+        started = time.perf_counter()
+        chunks = index_loader.split_documents(documents)
+        seconds = time.perf_counter() - started
+        result["chunks"] = len(chunks)
+        result["split_seconds"] = seconds
+        result["split_pages_per_second"] = len(documents) / seconds
+        del documents
+
+        started = time.perf_counter()
+        preprocess_chunks(chunks)
+        seconds = time.perf_counter() - started
+        result["preprocess_seconds"] = seconds
+        result["preprocess_chunks_per_second"] = len(chunks) / seconds
+
+        # 埋め込み・インデックスの作成
+        texts = [chunk.page_content for chunk in chunks]
+        started = time.perf_counter()
+        vectors = embeddings.embed_documents(texts)
+        seconds = time.perf_counter() - started
+        result["embedding_seconds"] = seconds
+        result["embedding_chunks_per_second"] = len(texts) / seconds
+
+        started = time.perf_counter()
+        vectorstore = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings,
+                                            metadatas=[chunk.metadata for chunk in chunks])
+        result["index_build_seconds"] = time.perf_counter() - started
+        result["rss_after_build_mb"] = current_rss_mb()
+        del vectors, texts
+
+        # 保存・読み込み（アプリと同じ永続化の処理を一時ディレクトリで行う）
+        manager = VectorStoreManager(Path(temp_dir) / "vector_store")
+        started = time.perf_counter()
+        version = manager.save_vector_store(vectorstore, chunks)
+        result["index_save_seconds"] = time.perf_counter() - started
+        if version is None:
+            raise RuntimeError("インデックスの保存に失敗しました。")
+        result["index_size_mb"] = directory_size_mb(manager.versions_dir / version)
+        del vectorstore, chunks
+
+        started = time.perf_counter()
+        vectorstore, _, _ = manager.load_vector_store(embeddings)
+        result["index_load_seconds"] = time.perf_counter() - started
+        if vectorstore is None:
+            raise RuntimeError("インデックスの読み込みに失敗しました。")
+
+        # 検索（質問の埋め込み・整形を含むrag_pipeline.searchと、FAISSの検索のみ）
+        queries = build_queries(query_count)
+        rag_pipeline.search(vectorstore, queries[0])  # 初回の読み込みを計測から除く
+        search_latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            rag_pipeline.search(vectorstore, query, k=ct.FAISS_SEARCH_K)
+            search_latencies.append(time.perf_counter() - started)
+
+        query_vectors = [embeddings.embed_query(query) for query in queries]
+        faiss_latencies = []
+        for vector in query_vectors:
+            started = time.perf_counter()
+            vectorstore.similarity_search_with_score_by_vector(vector, k=ct.FAISS_SEARCH_K)
+            faiss_latencies.append(time.perf_counter() - started)
+
+        for name, latencies in (("search", search_latencies), ("faiss_search", faiss_latencies)):
+            for percent in (50, 99):
+                result[f"{name}_p{percent}_ms"] = percentile(latencies, percent) * 1000
+
+    result["rss_end_mb"] = current_rss_mb()
+    result["rss_peak_mb"] = peak_rss_mb()
+    return result
+
+
+############################################################
+# 全規模の計測
+############################################################
+
+def measure_scale(scale: int, args) -> dict:
+    """1規模分を別のプロセスで計測"""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    try:
+        command = [sys.executable, __file__, "--run-scale", str(scale), "--result-path", result_path,
+                   "--embeddings", args.embeddings, "--queries", str(args.queries)]
+        completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"{scale}倍の計測に失敗しました:\n{completed.stderr[-2000:]}")
+        with open(result_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="コーパスの倍率")
+    parser.add_argument("--queries", type=int, default=200, help="検索の計測に使う質問数")
+    parser.add_argument("--embeddings", choices=["fake", "stub"], default="fake", help="埋め込みモデル")
+    parser.add_argument("--json", help="結果を保存するパス（既定は benchmarks/results/ingestion-<コミット>.json）")
+    parser.add_argument("--run-scale", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-path", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_scale is not None:
+        # 共通モジュールの画面向けメッセージ（st.success等）は表示しない
+        logging.getLogger("streamlit").setLevel(logging.ERROR)
+        result = run_scale(args.run_scale, args.embeddings, args.queries)
+        with open(args.result_path, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return 0
+
+    if not any(SOURCE_DIR.glob("*.pdf")):
+        print(f"PDFが見つかりません: {SOURCE_DIR}")
+        return 1
+
+    commit, dirty = git_commit()
+    print(f"{'倍率':>4}{'ページ':>8}{'チャンク':>9}{'読込(p/s)':>11}{'分割(s)':>9}{'埋込(c/s)':>11}"
+          f"{'作成(s)':>9}{'保存(s)':>9}{'読込(s)':>9}{'サイズ(MB)':>11}{'最大RSS(MB)':>12}"
+          f"{'検索p50/p99(ms)':>17}{'FAISS p50/p99(ms)':>19}")
+    results = []
+    for scale in args.scales:
+        result = measure_scale(scale, args)
+        results.append(result)
+        peak = f"{result['rss_peak_mb']:.0f}" if result["rss_peak_mb"] is not None else "-"
+        print(f"{scale:>4}{result['pages']:>8}{result['chunks']:>9}{result['pdf_pages_per_second']:>11.1f}"
+              f"{result['split_seconds']:>9.2f}{result['embedding_chunks_per_second']:>11.0f}"
+              f"{result['index_build_seconds']:>9.2f}{result['index_save_seconds']:>9.2f}"
+              f"{result['index_load_seconds']:>9.2f}{result['index_size_mb']:>11.1f}{peak:>12}"
+              f"{result['search_p50_ms']:>8.2f}/{result['search_p99_ms']:<8.2f}"
+              f"{result['faiss_search_p50_ms']:>9.3f}/{result['faiss_search_p99_ms']:<9.3f}")
+
+    output = Path(args.json) if args.json else RESULTS_DIR / f"ingestion-{commit or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "benchmark": "ingestion",
+            "commit": commit,
+            "dirty": dirty,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "embeddings": args.embeddings,
+            "dimensions": ct.STUB_EMBEDDING_DIMENSIONS if args.embeddings == "fake" else None,
+            "chunk_size": ct.CHUNK_SIZE,
+            "chunk_overlap": ct.CHUNK_OVERLAP,
+            "search_k": ct.FAISS_SEARCH_K,
+            "queries": args.queries,
+            "results": results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
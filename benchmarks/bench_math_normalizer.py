@@ -0,0 +1,181 @@
+"""
+数式表示の正規化（math_normalizer）のマイクロベンチマーク
+期待出力（math_normalizer_golden.json）との一致を確認した上で、長い回答1件あたりの処理時間を
+旧実装（re.subの連続適用）と比較する
+
+使い方:
+    python benchmarks/bench_math_normalizer.py [--sizes 2000 20000 200000] [--repeat 20]
+"""
+
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import math_normalizer  # noqa: E402
+
+
+GOLDEN_PATH = Path(__file__).resolve().parent / "math_normalizer_golden.json"
+FUNCTIONS = ["enhance_math_display", "normalize_answer_math", "prepare_math_response", "format_latex_equations"]
+
+# 長い回答を作るための、実際の回答に近い段落
+ANSWER_BLOCK = """## 📝 解説
+
+オームの法則は V = I × R で表されます。電力は P = V × I、または P = I² × R で求められます。
+
+### ステップ1: 与えられた値を整理
+抵抗 R = 10Ω
+電流 I = 2A
+
+### ステップ2: 計算
+V = 2A × 10Ω = 20V
+P = 20V × 2A = 40W
+
+直列接続の合成抵抗は $R = R1 + R2$、並列接続は 1/R = 1/R1 + 1/R2 です。
+単位の変換に気をつけましょう（$R = 1\\,\\text{k}\\Omega$ は 1000Ω）。
+
+"""
+
+
+############################################################
+# 旧実装（比較用）
+############################################################
+
+def legacy_enhance_math_display(text):
+    text = re.sub(r'\\text\{([^}]+)\}', r'\1', text)
+    text = text.replace('\\,', ' ')
+    text = text.replace('\\dots', '…')
+    math_patterns = [
+        (r'\bV\s*=\s*I\s*[×*]\s*R\b', r'$V = I × R$'),
+        (r'\bP\s*=\s*V\s*[×*]\s*I\b', r'$P = V × I$'),
+        (r'\bP\s*=\s*I\s*[²2]\s*[×*]\s*R\b', r'$P = I² × R$'),
+        (r'\bP\s*=\s*V\s*[²2]\s*/\s*R\b', r'$P = V²/R$'),
+        (r'\bR\s*=\s*R1\s*\+\s*R2\s*\+\s*R3\s*\+\s*[…\\dots]+\s*\+\s*Rn\b', r'$R = R1 + R2 + R3 + … + Rn$'),
+        (r'\bR\s*=\s*R1\s*\+\s*R2S?\s*\+\s*R3\s*\+\s*[…\\dots]+\s*\+\s*Rn\b', r'$R = R1 + R2 + R3 + … + Rn$'),
+        (r'\bR\s*=\s*R1\s*\+\s*R2\b', r'$R = R1 + R2$'),
+        (r'\b1/R\s*=\s*1/R1\s*\+\s*1/R2\s*\+\s*[…\\dots]+\s*\+\s*1/Rn\b', r'$1/R = 1/R1 + 1/R2 + … + 1/Rn$'),
+        (r'\b1/R\s*=\s*1/R1\s*\+\s*1/R2\b', r'$1/R = 1/R1 + 1/R2$'),
+        (r'\bΣV\s*=\s*0\b', r'$ΣV = 0$'),
+        (r'\bΣI\s*=\s*0\b', r'$ΣI = 0$'),
+        (r'V\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[A]\s*[×*]\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[ΩΩ]\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[V]', r'$V = \1A × \2Ω = \3V$'),
+        (r'P\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[V]\s*[×*]\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[A]\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[W]', r'$P = \1V × \2A = \3W$'),
+    ]
+    for pattern, replacement in math_patterns:
+        text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
+    text = re.sub(r'\$([^$]*),\s*\\text\{([^}]+)\}([^$]*)\$', r'$\1\2\3$', text)
+    text = re.sub(r'\$([^$]*R2S[^$]*)\$', lambda m: m.group(0).replace('R2S', 'R2'), text)
+    text = re.sub(r'\$([^$]*\\dots[^$]*)\$', lambda m: m.group(0).replace('\\dots', '…'), text)
+    text = text.replace('\\times', '×')
+    text = text.replace('\\Omega', 'Ω')
+    return text
+
+
+def legacy_normalize_answer_math(answer):
+    answer = legacy_enhance_math_display(answer)
+    if '=' in answer and ('V' in answer or 'I' in answer or 'R' in answer or 'P' in answer):
+        answer = re.sub(r'([VIRPvipr])\s*=\s*([^$\n]+?)(?=\n|$)',
+                        lambda m: f"${m.group(1)} = {m.group(2).strip()}$" if '$' not in m.group(0) else m.group(0),
+                        answer)
+    return answer
+
+
+def _legacy_clean_formula(match):
+    formula = match.group(1)
+    clean_formula = (formula
+                     .replace('\\times', '×')
+                     .replace('\\text{A}', 'A')
+                     .replace('\\text{V}', 'V')
+                     .replace('\\text{Ω}', 'Ω')
+                     .replace('\\text{W}', 'W')
+                     .replace('\\text{', '')
+                     .replace('}', '')
+                     .replace('\\Omega', 'Ω')
+                     .replace('\\,', ' ')
+                     .replace('\\dots', '…')
+                     .replace(',', '')
+                     .replace('R2S', 'R2')
+                     .replace('\\', '')
+                     .strip())
+    return f"\n\n$${clean_formula}$$\n\n"
+
+
+def legacy_prepare_math_response(response):
+    response = re.sub(r'\[\s*([^]]+)\s*\]', _legacy_clean_formula, response)
+    return re.sub(r'\$([^$]+)\$', _legacy_clean_formula, response)
+
+
+def legacy_format_latex_equations(text):
+    text = re.sub(r'\[\s*([^\[\]]+?)\s*\]', r'$$\1$$', text)
+    text = re.sub(r'(?<!\$)\$(?!\$)([^$]+?)(?<!\$)\$(?!\$)', r'$$\1$$', text)
+    text = re.sub(r'\$\$([^$]*?)([A-Za-z])_([0-9]+)([^$]*?)\$\$', r'$$\1\2_{\3}\4$$', text)
+    text = re.sub(r'\$\$\s*\$\$', r'$$', text)
+    text = re.sub(r'\$\$([^$]+?)\$\$', r'\n\n$$\1$$\n\n', text)
+    return text
+
+
+LEGACY_FUNCTIONS = {
+    "enhance_math_display": legacy_enhance_math_display,
+    "normalize_answer_math": legacy_normalize_answer_math,
+    "prepare_math_response": legacy_prepare_math_response,
+    "format_latex_equations": legacy_format_latex_equations,
+}
+
+
+############################################################
+# ベンチマーク
+############################################################
+
+def check_golden() -> int:
+    """期待出力と一致しないケース数を返す（不一致は内容を表示）"""
+    with open(GOLDEN_PATH, "r", encoding="utf-8") as f:
+        cases = json.load(f)["cases"]
+
+    failures = 0
+    for case in cases:
+        for name in FUNCTIONS:
+            actual = getattr(math_normalizer, name)(case["input"])
+            if actual != case[name]:
+                failures += 1
+                print(f"[不一致] {name}({case['input']!r})\n  期待: {case[name]!r}\n  実際: {actual!r}")
+            elif "note" not in case and LEGACY_FUNCTIONS[name](case["input"]) != actual:
+                failures += 1
+                print(f"[旧実装と不一致] {name}({case['input']!r})")
+    print(f"期待出力: {len(cases)}ケース x {len(FUNCTIONS)}関数, 不一致 {failures}件")
+    return failures
+
+
+def time_per_call(func, text: str, repeat: int) -> float:
+    """1回あたりの処理時間（マイクロ秒、repeat回の最小値）"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - started)
+    return best * 1_000_000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 20000, 200000], help="回答の文字数")
+    parser.add_argument("--repeat", type=int, default=20, help="計測の繰り返し回数")
+    args = parser.parse_args(argv)
+
+    if check_golden():
+        return 1
+
+    print(f"\n{'関数':<24}{'文字数':>10}{'旧実装(µs)':>14}{'新実装(µs)':>14}{'速度比':>8}")
+    for size in args.sizes:
+        text = (ANSWER_BLOCK * (size // len(ANSWER_BLOCK) + 1))[:size]
+        for name in FUNCTIONS:
+            legacy = time_per_call(LEGACY_FUNCTIONS[name], text, args.repeat)
+            current = time_per_call(getattr(math_normalizer, name), text, args.repeat)
+            print(f"{name:<24}{size:>10}{legacy:>14.0f}{current:>14.0f}{legacy / current:>7.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
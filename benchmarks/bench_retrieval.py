@@ -0,0 +1,467 @@
+"""
+検索の精度と速度の評価（CHUNK_SIZE・CHUNK_OVERLAP・SEARCH_K・FAISSのインデックスの種類の組み合わせを比較）
+各章の練習問題（_練習）と章のまとめ（_まとめ）のPDFから「質問 → 答えが載っている節のPDF」の評価用の質問集を作り、
+節のPDF（_練習・_まとめ・_章扉を除く）を設定ごとに分割・埋め込み・インデックス化して、
+recall@k・MRR・インデックスのサイズ・検索時間（p50/p99）・回答生成に渡す文脈の文字数を比較する
+現在の設定の recall@SEARCH_K を下回らない組み合わせのうち、文脈の文字数（プロンプトのトークン数）と
+検索時間が最も小さいものを推奨として表示する
+
+評価用の質問集（retrieval_queries.json）の正解の節は、同じ章の節のうち文字バイグラムのTF-IDFが
+最も近いものを自動で付けたもの（label_confidenceが低いものは確認・修正して使う）
+PDFの抽出結果と埋め込みは benchmarks/results/cache/ にキャッシュし、2回目以降は抽出・埋め込みAPIを使わない
+（--embeddings api はOPENAI_BASE_URLが設定されていればスタブサーバー（文字バイグラムのハッシュによる埋め込み）を使う）
+
+使い方:
+    python benchmarks/bench_retrieval.py [--chunk-sizes 500 1000 1500] [--chunk-overlaps 0 100 200]
+                                         [--ks 1 2 3 5 8] [--index-types flat sq8 hnsw ivf] [--rebuild-queries]
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+import unicodedata
+from collections import Counter
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+import constants as ct  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+
+SOURCE_DIR = ROOT / "data" / "教科書データ"
+QUERIES_PATH = Path(__file__).resolve().parent / "retrieval_queries.json"
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+CACHE_DIR = RESULTS_DIR / "cache"
+
+# 313生シ_<章>_<節 / 練習 / まとめ / 章扉>.pdf
+FILE_PATTERN = re.compile(r"^313生シ_(\d+)_(.+)\.pdf$")
+QUERY_KINDS = ("練習", "まとめ")
+QUERY_MAX_CHARS = 200  # 質問として使う最大文字数（図の説明など後ろのテキストは捨てる）
+QUERY_MIN_CHARS = 8
+LOW_CONFIDENCE = 0.1  # 1位と2位の節の類似度の差がこれ未満の質問は、正解の確認を促す
+
+
+############################################################
+# PDFの抽出（キャッシュ）
+############################################################
+
+def classify_pdfs() -> dict:
+    """章ごとの節のPDFと、質問の元になるPDF（練習・まとめ）"""
+    chapters = {}
+    for path in sorted(SOURCE_DIR.glob("*.pdf")):
+        match = FILE_PATTERN.match(path.name)
+        if not match:
+            continue
+        chapter = chapters.setdefault(int(match.group(1)), {"sections": [], "練習": None, "まとめ": None})
+        part = match.group(2)
+        if part.isdigit():
+            chapter["sections"].append(path)
+        elif part in QUERY_KINDS:
+            chapter[part] = path
+    return chapters
+
+
+def load_pages(paths: list) -> dict:
+    """PDFごとのページのテキスト（ファイルのサイズ・更新時刻が変わっていなければキャッシュを使う）"""
+    cache_path = CACHE_DIR / "extractions.json"
+    cache = {}
+    if cache_path.exists():
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+
+    pages = {}
+    updated = False
+    for path in paths:
+        stat = path.stat()
+        entry = cache.get(path.name)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            import index_loader
+            documents = index_loader.load_pdf_documents([str(path)], report=lambda message: None)
+            entry = cache[path.name] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                                        "pages": [doc.page_content for doc in documents]}
+            updated = True
+        pages[path.name] = entry["pages"]
+
+    if updated:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+    return pages
+
+
+############################################################
+# 評価用の質問集
+############################################################
+
+def _trim_query(text: str) -> str:
+    """質問文を整える（最後の「。」までを上限の文字数まで使う）"""
+    text = re.sub(r"\s+", " ", text.replace("………", " ")).strip()
+    head = text[:QUERY_MAX_CHARS]
+    end = head.rfind("。")
+    return head[:end + 1] if end > 0 else head
+
+
+def extract_practice_queries(text: str) -> list:
+    """練習問題の問題文（「1.」「2.」…の番号順に区切る）"""
+    problems, expected = [], 1
+    for line in text.split("練習問題", 1)[-1].splitlines():
+        match = re.match(r"^\s*(\d+)\.\s*(.*)$", line)
+        if match and int(match.group(1)) == expected:
+            problems.append([match.group(2)])
+            expected += 1
+        elif problems:
+            problems[-1].append(line.strip())
+    return [_trim_query("".join(lines)) for lines in problems]
+
+
+def extract_summary_queries(text: str) -> list:
+    """章のまとめの項目（番号だけの行を、番号順に区切りとして使う）"""
+    items, expected = [], 1
+    for line in text.split("この章のまとめ", 1)[-1].splitlines():
+        if re.fullmatch(r"\s*(\d+)\s*", line) and int(line) == expected:
+            items.append([])
+            expected += 1
+        elif items and line.strip():
+            items[-1].append(line.strip())
+    return [_trim_query("".join(lines)) for lines in items]
+
+
+def _bigrams(text: str) -> Counter:
+    text = "".join(char for char in unicodedata.normalize("NFKC", text) if char.isalnum())
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def _tfidf(counts: Counter, idf: dict) -> dict:
+    vector = {gram: count * idf.get(gram, 0.0) for gram, count in counts.items()}
+    norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {gram: value / norm for gram, value in vector.items()}
+
+
+def build_query_set(chapters: dict, pages: dict) -> list:
+    """
+    練習・まとめのPDFから質問を取り出し、同じ章の節のうち文字バイグラムのTF-IDFのコサイン類似度が最も高い節を正解とする
+    """
+    section_counts = {path.name: _bigrams("\n".join(pages[path.name]))
+                      for chapter in chapters.values() for path in chapter["sections"]}
+    document_frequency = Counter(gram for counts in section_counts.values() for gram in counts)
+    idf = {gram: math.log(len(section_counts) / frequency) + 1.0 for gram, frequency in document_frequency.items()}
+    section_vectors = {name: _tfidf(counts, idf) for name, counts in section_counts.items()}
+
+    queries = []
+    for number, chapter in sorted(chapters.items()):
+        if not chapter["sections"]:
+            continue
+        for kind, extract in (("練習", extract_practice_queries), ("まとめ", extract_summary_queries)):
+            if chapter[kind] is None:
+                continue
+            for i, query in enumerate(extract("\n".join(pages[chapter[kind].name])), 1):
+                if len(query) < QUERY_MIN_CHARS:
+                    continue
+                query_vector = _tfidf(_bigrams(query), idf)
+                scores = sorted(
+                    ((sum(value * section_vectors[path.name].get(gram, 0.0) for gram, value in query_vector.items()),
+                      path.name) for path in chapter["sections"]),
+                    reverse=True
+                )
+                confidence = scores[0][0] - (scores[1][0] if len(scores) > 1 else 0.0)
+                queries.append({
+                    "id": f"{number}_{kind}_{i}",
+                    "chapter": number,
+                    "kind": kind,
+                    "query": query,
+                    "expected_source_file": scores[0][1],
+                    "label_confidence": round(confidence, 3),
+                })
+    return queries
+
+
+def load_query_set(chapters: dict, pages: dict, rebuild: bool) -> list:
+    """評価用の質問集を読み込む（無い場合・--rebuild-queriesの場合は作成して保存）"""
+    if QUERIES_PATH.exists() and not rebuild:
+        with open(QUERIES_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)["queries"]
+
+    queries = build_query_set(chapters, pages)
+    with open(QUERIES_PATH, "w", encoding="utf-8") as f:
+        json.dump({
+            "description": "練習問題・章のまとめの質問と、答えが載っている節のPDF（文字バイグラムのTF-IDFで自動付与。"
+                           f"label_confidenceが{LOW_CONFIDENCE}未満のものは確認して修正する）",
+            "queries": queries,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"評価用の質問集を作成しました: {QUERIES_PATH}（{len(queries)}問、"
+          f"要確認 {sum(1 for query in queries if query['label_confidence'] < LOW_CONFIDENCE)}問）")
+    return queries
+
+
+############################################################
+# 埋め込み（キャッシュ）
+############################################################
+
+class EmbeddingCache:
+    """埋め込みベクトルのキャッシュ（SQLite。キーはモデル・接続先とテキストのハッシュ）"""
+
+    def __init__(self, db_path: Path, embeddings, namespace: str):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.api_texts = 0
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (cache_key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.namespace}\n{text}".encode("utf-8")).hexdigest()
+
+    def embed(self, texts: list, is_query: bool = False):
+        """テキストの埋め込み（float32の行列。キャッシュに無いものだけ埋め込みモデルに渡す）"""
+        import numpy as np
+
+        keys = [self._key(text) for text in texts]
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            cached = {}
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT cache_key, vector FROM embeddings WHERE cache_key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                cached.update({key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows})
+
+            missing = list({key: text for key, text in zip(keys, texts) if key not in cached}.items())
+            if missing:
+                self.api_texts += len(missing)
+                missing_texts = [text for _, text in missing]
+                if is_query:
+                    vectors = [self.embeddings.embed_query(text) for text in missing_texts]
+                else:
+                    vectors = self.embeddings.embed_documents(missing_texts)
+                rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for (key, _), vector in zip(missing, vectors)]
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO embeddings (cache_key, vector) VALUES (?, ?)", rows)
+                cached.update({key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows})
+
+        return np.vstack([cached[key] for key in keys])
+
+
+def create_embedding_cache(kind: str) -> EmbeddingCache:
+    """埋め込みモデル（api: llm_client（OPENAI_BASE_URLが設定されていればスタブ） / fake: 決定的な乱数ベクトル）"""
+    if kind == "fake":
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        embeddings = DeterministicFakeEmbedding(size=ct.STUB_EMBEDDING_DIMENSIONS)
+        namespace = f"fake:{ct.STUB_EMBEDDING_DIMENSIONS}"
+    else:
+        import llm_client
+        if not llm_client.is_openai_configured():
+            raise SystemExit("OpenAI APIキー、またはOPENAI_BASE_URL（スタブサーバーの接続先）の設定が必要です。")
+        embeddings = llm_client.create_embeddings()
+        namespace = f"{ct.OPENAI_EMBEDDING_MODEL}@{llm_client.get_base_url() or 'openai'}"
+    return EmbeddingCache(CACHE_DIR / "embeddings.db", embeddings, namespace)
+
+
+############################################################
+# インデックス
+############################################################
+
+def build_faiss_index(index_type: str, vectors):
+    """
+    FAISSのインデックスを作成
+    flat: 全件比較（L2。アプリのLangChain FAISSと同じ） / sq8: 8bitスカラー量子化 /
+    hnsw: グラフによる近似検索 / ivf: クラスタに分けた近似検索（全体の1/4のクラスタを探す）
+    """
+    import faiss
+
+    count, dimensions = vectors.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dimensions)
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dimensions, faiss.ScalarQuantizer.QT_8bit)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimensions, 32)
+        index.hnsw.efSearch = 64
+    elif index_type == "ivf":
+        nlist = max(1, min(int(math.sqrt(count)), count // 39))  # クラスタあたり39件以上で学習する
+        quantizer = faiss.IndexFlatL2(dimensions)
+        index = faiss.IndexIVFFlat(quantizer, dimensions, nlist)
+        index.nprobe = max(1, nlist // 4)
+    else:
+        raise ValueError(f"未対応のインデックスの種類です: {index_type}")
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def evaluate_config(chunk_size: int, chunk_overlap: int, args, documents: list, queries: list,
+                    query_vectors, embedding_cache: EmbeddingCache) -> list:
+    """1つの分割設定について、インデックスの種類とkごとの精度・速度"""
+    import faiss
+    import index_loader
+
+    chunks = index_loader.split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    sources = [chunk.metadata["source_file"] for chunk in chunks]
+    lengths = [len(chunk.page_content) for chunk in chunks]
+    vectors = embedding_cache.embed([chunk.page_content for chunk in chunks])
+    expected = [query["expected_source_file"] for query in queries]
+    max_k = min(max(args.ks), len(chunks))
+
+    results = []
+    for index_type in args.index_types:
+        started = time.perf_counter()
+        index = build_faiss_index(index_type, vectors)
+        build_seconds = time.perf_counter() - started
+        index_size = len(faiss.serialize_index(index))
+
+        # 正解の節のチャンクが最初に現れた順位（max_k位までに無い場合はNone）
+        _, ids = index.search(query_vectors, max_k)
+        ranks = []
+        for row, answer in zip(ids, expected):
+            hits = [rank for rank, chunk_id in enumerate(row, 1) if chunk_id >= 0 and sources[chunk_id] == answer]
+            ranks.append(hits[0] if hits else None)
+
+        for k in sorted(args.ks):
+            k = min(k, len(chunks))
+            latencies = []
+            for vector in query_vectors:
+                started = time.perf_counter()
+                index.search(vector.reshape(1, -1), k)
+                latencies.append(time.perf_counter() - started)
+            results.append({
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "index_type": index_type,
+                "k": k,
+                "chunks": len(chunks),
+                "recall_at_k": sum(1 for rank in ranks if rank is not None and rank <= k) / len(ranks),
+                "mrr_at_k": sum(1 / rank for rank in ranks if rank is not None and rank <= k) / len(ranks),
+                "index_size_kb": index_size / 1024,
+                "index_build_ms": build_seconds * 1000,
+                "search_p50_ms": percentile(latencies, 50) * 1000,
+                "search_p99_ms": percentile(latencies, 99) * 1000,
+                "context_chars": sum(sum(lengths[chunk_id] for chunk_id in row[:k] if chunk_id >= 0)
+                                     for row in ids) / len(ids),
+            })
+    return results
+
+
+def recommend(results: list, baseline: dict, min_recall: float = None):
+    """基準（現在の設定）のrecallを下回らない組み合わせのうち、文脈の文字数・検索時間が最も小さいもの"""
+    target = baseline["recall_at_k"] if min_recall is None else min_recall
+    candidates = [result for result in results if result["recall_at_k"] >= target]
+    if not candidates:
+        return None, target
+    return min(candidates, key=lambda result: (result["context_chars"], result["search_p50_ms"])), target
+
+
+############################################################
+# 実行
+############################################################
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_row(result: dict) -> str:
+    return (f"{result['chunk_size']:>6}{result['chunk_overlap']:>8}{result['index_type']:>6}{result['k']:>4}"
+            f"{result['chunks']:>7}{result['recall_at_k']:>9.3f}{result['mrr_at_k']:>8.3f}"
+            f"{result['index_size_kb']:>11.0f}{result['search_p50_ms']:>9.3f}{result['search_p99_ms']:>9.3f}"
+            f"{result['context_chars']:>9.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[500, 1000, 1500])
+    parser.add_argument("--chunk-overlaps", type=int, nargs="+", default=[0, 100, 200])
+    parser.add_argument("--ks", type=int, nargs="+", default=[1, 2, 3, 5, 8])
+    parser.add_argument("--index-types", nargs="+", choices=["flat", "sq8", "hnsw", "ivf"],
+                        default=["flat", "sq8", "hnsw", "ivf"])
+    parser.add_argument("--embeddings", choices=["api", "fake"], default="api",
+                        help="埋め込みモデル（fakeは精度の評価には使えない。処理の確認用）")
+    parser.add_argument("--min-recall", type=float, help="推奨の条件にするrecall（既定は現在の設定のrecall@SEARCH_K）")
+    parser.add_argument("--rebuild-queries", action="store_true", help="評価用の質問集を作り直す")
+    parser.add_argument("--json", help="結果を保存するパス（既定は benchmarks/results/retrieval-<コミット>.json）")
+    args = parser.parse_args(argv)
+
+    # 現在の設定を必ず比較対象に含める
+    args.chunk_sizes = sorted(set(args.chunk_sizes) | {ct.CHUNK_SIZE})
+    args.chunk_overlaps = sorted(set(args.chunk_overlaps) | {ct.CHUNK_OVERLAP})
+    args.ks = sorted(set(args.ks) | {ct.SEARCH_K})
+    if "flat" not in args.index_types:
+        args.index_types = ["flat"] + args.index_types
+
+    chapters = classify_pdfs()
+    section_paths = [path for chapter in chapters.values() for path in chapter["sections"]]
+    query_paths = [chapter[kind] for chapter in chapters.values() for kind in QUERY_KINDS if chapter[kind]]
+    if not section_paths or not query_paths:
+        print(f"節・練習・まとめのPDFが見つかりません: {SOURCE_DIR}")
+        return 1
+
+    pages = load_pages(section_paths + query_paths)
+    queries = load_query_set(chapters, pages, args.rebuild_queries)
+
+    from langchain_core.documents import Document
+    documents = [Document(page_content=text, metadata={"source_file": path.name, "page": page})
+                 for path in section_paths for page, text in enumerate(pages[path.name])]
+
+    embedding_cache = create_embedding_cache(args.embeddings)
+    query_vectors = embedding_cache.embed([query["query"] for query in queries], is_query=True)
+
+    print(f"節のPDF {len(section_paths)}件（{len(documents)}ページ）・質問 {len(queries)}問・埋め込み {embedding_cache.namespace}\n")
+    print(f"{'size':>6}{'overlap':>8}{'index':>6}{'k':>4}{'chunks':>7}{'recall@k':>9}{'MRR@k':>8}"
+          f"{'index KB':>11}{'p50 ms':>9}{'p99 ms':>9}{'context':>9}")
+    results = []
+    for chunk_size in args.chunk_sizes:
+        for chunk_overlap in args.chunk_overlaps:
+            if chunk_overlap >= chunk_size:
+                continue
+            for result in evaluate_config(chunk_size, chunk_overlap, args, documents, queries,
+                                          query_vectors, embedding_cache):
+                results.append(result)
+                print(format_row(result))
+
+    baseline = next(result for result in results
+                    if (result["chunk_size"], result["chunk_overlap"], result["index_type"], result["k"])
+                    == (ct.CHUNK_SIZE, ct.CHUNK_OVERLAP, "flat", ct.SEARCH_K))
+    recommended, target = recommend(results, baseline, args.min_recall)
+    print(f"\n現在の設定:\n{format_row(baseline)}")
+    if recommended:
+        print(f"推奨（recall@k {target:.3f}以上で文脈の文字数・検索時間が最小）:\n{format_row(recommended)}")
+    else:
+        print(f"recall@k {target:.3f}以上の組み合わせがありません")
+    print(f"埋め込みAPIに送ったテキスト: {embedding_cache.api_texts}件（他はキャッシュ）")
+
+    commit = git_commit()
+    output = Path(args.json) if args.json else RESULTS_DIR / f"retrieval-{commit or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "benchmark": "retrieval",
+            "commit": commit,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "embeddings": embedding_cache.namespace,
+            "queries": len(queries),
+            "section_files": len(section_paths),
+            "baseline": baseline,
+            "recommended": recommended,
+            "results": results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
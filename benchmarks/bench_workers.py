@@ -0,0 +1,230 @@
+"""
+複数ワーカーの振り分けのベンチマーク（ネットワーク・APIキー不要）
+run_workers.py の振り分けプロキシの後ろに模擬ワーカーを1・2・4個起動し、同じIPアドレス（学校のNATの後ろの教室）から
+接続する生徒40人分のブラウザでリクエストを送り続けて、ワーカー数ごとのスループット（リクエスト/秒）・
+応答時間のp50/p99・ワーカーごとの生徒数を、変更前の振り分け（IPアドレスのハッシュ）と比べる
+
+模擬ワーカーは1リクエストごとに --rerun-ms ミリ秒の処理を行う（Streamlitのスクリプトの再実行の代わり）
+    cpu: Pythonの計算で処理する（GILにより1プロセスで1コアまで。CPUコア数までワーカー数に比例して伸びる）
+    serialized: プロセス内で1件ずつ待つ（GILで直列になる再実行を、CPUコア数によらず再現する）
+各ブラウザは毎回新しい接続でリクエストし、最初の応答で受け取ったCookieを次から送る
+
+使い方:
+    python benchmarks/bench_workers.py [--workers 1 2 4] [--clients 40] [--work cpu serialized] [--duration 5]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+import run_workers  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+STRATEGIES = ("ip_hash", "balanced")
+
+
+############################################################
+# 模擬ワーカー
+############################################################
+
+def run_worker(port: int, work: str, rerun_ms: float):
+    """1リクエストごとにrerun_msミリ秒の処理を行うHTTPサーバー（応答の本文はポート番号）"""
+    lock = threading.Lock()
+    seconds = rerun_ms / 1000
+    body = str(port).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if work == "cpu":
+                # スレッドのCPU時間で数える（同時に届いたリクエストがCPUを取り合うと、その分だけ遅れる）
+                deadline = time.thread_time() + seconds
+                while time.thread_time() < deadline:
+                    pass
+            else:
+                with lock:
+                    time.sleep(seconds)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+############################################################
+# 振り分け
+############################################################
+
+class IpHashBalancer(run_workers.WorkerBalancer):
+    """変更前の振り分け（接続元のIPアドレスのハッシュ。計測のブラウザは全員127.0.0.1から接続する）"""
+
+    def choose(self, headers):
+        digest = hashlib.md5(b"127.0.0.1").digest()
+        return int.from_bytes(digest[:4], "big") % len(self.ports), False
+
+
+async def browser(proxy_port: int, deadline: float, latencies: list, served: list):
+    """1人分のブラウザ（毎回新しい接続でリクエストし、振り分けのCookieを保持する）"""
+    cookie = None
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        request = "GET /rerun HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+        if cookie:
+            request += f"Cookie: {cookie}\r\n"
+        writer.write((request + "\r\n").encode())
+        response = await reader.read()
+        writer.close()
+        latencies.append(time.perf_counter() - started)
+
+        head, _, body = response.partition(b"\r\n\r\n")
+        for line in head.decode("latin-1").split("\r\n"):
+            if line.lower().startswith("set-cookie:"):
+                cookie = line.split(":", 1)[1].split(";", 1)[0].strip()
+        served.append(int(body))
+
+
+async def measure_proxy(ports: list, strategy: str, clients: int, duration: float) -> dict:
+    """振り分けプロキシを起動し、ブラウザclients人分のリクエストをduration秒間送り続ける"""
+    balancer = IpHashBalancer(ports) if strategy == "ip_hash" else run_workers.WorkerBalancer(ports)
+    server = await asyncio.start_server(run_workers.create_connection_handler(ports, balancer), "127.0.0.1", 0)
+    proxy_port = server.sockets[0].getsockname()[1]
+
+    latencies = []
+    served = [[] for _ in range(clients)]
+    started = time.perf_counter()
+    deadline = started + duration
+    async with server:
+        await asyncio.gather(*(browser(proxy_port, deadline, latencies, served[i]) for i in range(clients)))
+    elapsed = time.perf_counter() - started
+
+    # ブラウザごとに最後に応答したワーカー（Cookieで固定された振り分け先）
+    clients_per_worker = [sum(1 for history in served if history and history[-1] == port) for port in ports]
+    requests_per_worker = [sum(history.count(port) for history in served) for port in ports]
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "clients_per_worker": clients_per_worker,
+        "requests_per_worker": requests_per_worker,
+        # 最初の応答の後に別のワーカーへ移ったブラウザ（セッションが失われる）
+        "moved_clients": sum(1 for history in served if len(set(history[1:])) > 1),
+    }
+
+
+def measure(workers: int, work: str, args) -> list:
+    """ワーカー数・処理の種類ごとに、振り分け方法を比べる"""
+    ports = [free_port() for _ in range(workers)]
+    processes = [
+        subprocess.Popen([sys.executable, __file__, "--run-worker", str(port), "--work", work,
+                          "--rerun-ms", str(args.rerun_ms)], cwd=ROOT)
+        for port in ports
+    ]
+    try:
+        for port, process in zip(ports, processes):
+            if not run_workers.wait_for_port(port, process, 30):
+                raise RuntimeError(f"模擬ワーカー（ポート{port}）の起動に失敗しました")
+        results = []
+        for strategy in STRATEGIES:
+            result = asyncio.run(measure_proxy(ports, strategy, args.clients, args.duration))
+            results.append({"workers": workers, "work": work, "strategy": strategy, **result})
+        return results
+    finally:
+        run_workers.stop_workers(processes)
+
+
+############################################################
+# 実行
+############################################################
+
+def git_commit():
+    """計測したコミット（gitが無い場合はNone）と、未コミットの変更があるか"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="ワーカー数")
+    parser.add_argument("--clients", type=int, default=40, help="同じIPアドレスから接続するブラウザの数")
+    parser.add_argument("--work", nargs="+", choices=["cpu", "serialized"], default=["cpu", "serialized"],
+                        help="模擬ワーカーの処理の種類")
+    parser.add_argument("--rerun-ms", type=float, default=20, help="1リクエストあたりの処理時間（ミリ秒）")
+    parser.add_argument("--duration", type=float, default=5, help="1条件あたりの計測時間（秒）")
+    parser.add_argument("--json", help="結果を保存するパス（既定は benchmarks/results/workers-<コミット>.json）")
+    parser.add_argument("--run-worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_worker is not None:
+        run_worker(args.run_worker, args.work[0], args.rerun_ms)
+        return 0
+
+    commit, dirty = git_commit()
+    print(f"CPUコア数 {os.cpu_count()}・ブラウザ {args.clients}人（同じIPアドレス）・1リクエスト {args.rerun_ms:g}ms\n")
+    print(f"{'work':>11}{'workers':>8}{'strategy':>10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}  clients per worker")
+    results = []
+    for work in args.work:
+        for workers in args.workers:
+            for result in measure(workers, work, args):
+                results.append(result)
+                print(f"{work:>11}{workers:>8}{result['strategy']:>10}{result['requests_per_second']:>9.1f}"
+                      f"{result['latency_p50_ms']:>9.1f}{result['latency_p99_ms']:>9.1f}"
+                      f"  {'/'.join(str(count) for count in result['clients_per_worker'])}")
+
+    output = Path(args.json) if args.json else RESULTS_DIR / f"workers-{commit or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "benchmark": "workers",
+            "commit": commit,
+            "dirty": dirty,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "clients": args.clients,
+            "rerun_ms": args.rerun_ms,
+            "duration_seconds": args.duration,
+            "results": results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
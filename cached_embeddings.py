@@ -0,0 +1,43 @@
+"""
+検索クエリの埋め込みキャッシュモジュール
+表記ゆれを正規化した質問文をキーに、検索クエリの埋め込みベクトルをキャッシュする機能を提供
+（L1: プロセス内メモリ / L2: 全ワーカーで共有するSQLite）
+（llm_client.create_embeddings(cache_queries=True) から利用時に読み込む）
+"""
+
+import json
+
+from langchain_core.embeddings import Embeddings
+import constants as ct
+from query_canonicalizer import canonicalize_query
+from response_cache import SQLiteResponseCache, TieredResponseCache
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    検索クエリの埋め込みをキャッシュする埋め込みモデル
+    表記ゆれを正規化した質問文をキーにし、同じ質問の2回目以降はAPIを呼ばずにベクトルを返す
+    （文書の埋め込みはそのまま元のモデルに任せる）
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        # 他のワーカーが埋め込んだ質問もAPIを呼ばずに引けるよう、ベクトルはJSONにしてSQLiteにも保存
+        self.cache = TieredResponseCache(
+            SQLiteResponseCache(ct.QUERY_EMBEDDING_CACHE_DB_PATH, max_entries=ct.QUERY_EMBEDDING_CACHE_MAX_ENTRIES),
+            l1_max_entries=ct.QUERY_EMBEDDING_CACHE_MAX_ENTRIES,
+            l1_ttl_seconds=ct.QUERY_EMBEDDING_CACHE_TTL_SECONDS
+        )
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        # 同じキーには常に同じベクトルを返すよう、正規化後の質問文を埋め込む
+        query = canonicalize_query(text) or text
+        cached = self.cache.get(query)
+        if cached is not None:
+            return json.loads(cached)
+        vector = self.embeddings.embed_query(query)
+        self.cache.set(query, query, json.dumps(vector), ct.QUERY_EMBEDDING_CACHE_TTL_SECONDS)
+        return list(vector)
@@ -0,0 +1,106 @@
+"""
+チャンクの前処理モジュール
+教科書チャンクの整形テキストと重要ポイントをインデックス作成時に1度だけ計算し、
+チャンクのメタデータに保存する機能を提供（検索時はメタデータを参照するだけにする）
+"""
+
+import re
+
+
+# 整形・抽出のルールを変更したら上げる（保存済みチャンクは読み込み時に再計算される）
+PREPROCESS_VERSION = 1
+
+# メタデータのキー
+CLEANED_TEXT_KEY = "cleaned_text"
+KEY_POINTS_KEY = "key_points"
+VERSION_KEY = "preprocess_version"
+
+# 整形用のパターン
+NEWLINES = re.compile(r"\n+")
+SPACES = re.compile(r"\s+")
+UNWANTED_CHARS = re.compile(r"[^\w\s\.\,\!\?\(\)\[\]\{\}\-\+\=\×\÷\°\%\：\；\、\。\（\）\「\」\『\』]")
+PERIOD_SPACING = re.compile(r"([。\.])\s*")
+COMMA_SPACING = re.compile(r"([、\,])\s*")
+FORMULA_START = re.compile(r"([A-Z])\s*=\s*")
+NUMBERED_ITEM = re.compile(r"(\d+)\s*\.")
+
+# 重要ポイント抽出用のパターン
+FORMULA = re.compile(r"[A-Z]\s*=\s*[^。\n]+")
+CONCEPT = re.compile(r"([ア-ン]{2,}の法則|[ア-ン]{2,}の定理)")
+DEFINITION = re.compile(r"([^。\n]*とは[^。\n]*)")
+
+
+def clean_and_format_text(text: str) -> str:
+    """教科書テキストを読みやすく整形"""
+    # 改行・空白をまとめる
+    text = NEWLINES.sub("\n", text)
+    text = SPACES.sub(" ", text)
+
+    # 不要な文字を削除
+    text = UNWANTED_CHARS.sub("", text)
+
+    # 句読点の後にスペースを追加
+    text = PERIOD_SPACING.sub(r"\1 ", text)
+    text = COMMA_SPACING.sub(r"\1 ", text)
+
+    # 数式を見やすく
+    text = FORMULA_START.sub(r"\n**\1 = ", text)
+    text = NUMBERED_ITEM.sub(r"\n\1. ", text)
+
+    return text.strip()
+
+
+def extract_key_points(content: str) -> list:
+    """教科書内容から重要ポイント（公式・重要概念・定義）を抽出"""
+    key_points = [f"📐 **公式**: {formula.strip()}" for formula in FORMULA.findall(content)]
+    key_points += [f"🔑 **重要概念**: {concept}" for concept in CONCEPT.findall(content)]
+    # 定義は最大2つ
+    key_points += [f"💡 **定義**: {definition.strip()}" for definition in DEFINITION.findall(content)[:2]]
+    return key_points
+
+
+def _is_current(metadata: dict) -> bool:
+    return metadata.get(VERSION_KEY) == PREPROCESS_VERSION
+
+
+def is_outdated(metadata: dict) -> bool:
+    """保存された前処理が現在のルール（PREPROCESS_VERSION）より古いか（前処理が無い場合も古いとみなす）"""
+    # 新しいルールのコードを動かす別のワーカーが保存したものは、古いルールで計算し直さない
+    return metadata.get(VERSION_KEY, 0) < PREPROCESS_VERSION
+
+
+def preprocess_chunks(documents) -> int:
+    """
+    チャンク（Document）のメタデータに整形テキストと重要ポイントを保存
+
+    Args:
+        documents: LangChainのDocumentのリスト
+
+    Returns:
+        計算したチャンク数（前処理のバージョンが古いチャンクだけを計算する）
+    """
+    updated = 0
+    for doc in documents:
+        if not is_outdated(doc.metadata):
+            continue
+        doc.metadata[CLEANED_TEXT_KEY] = clean_and_format_text(doc.page_content)
+        doc.metadata[KEY_POINTS_KEY] = extract_key_points(doc.page_content)
+        doc.metadata[VERSION_KEY] = PREPROCESS_VERSION
+        updated += 1
+    return updated
+
+
+def get_cleaned_text(result: dict) -> str:
+    """検索結果（content・metadata）の整形テキストを取得（前処理が古い・無い場合はその場で計算）"""
+    metadata = result.get("metadata") or {}
+    if _is_current(metadata):
+        return metadata[CLEANED_TEXT_KEY]
+    return clean_and_format_text(result["content"])
+
+
+def get_key_points(result: dict) -> list:
+    """検索結果（content・metadata）の重要ポイントを取得（前処理が古い・無い場合はその場で計算）"""
+    metadata = result.get("metadata") or {}
+    if _is_current(metadata):
+        return metadata[KEY_POINTS_KEY]
+    return extract_key_points(result["content"])
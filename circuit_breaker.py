@@ -0,0 +1,150 @@
+"""
+回答生成のサーキットブレーカーモジュール
+直近の呼び出しの失敗率・低速率がしきい値を超えたらLLMの呼び出しを一時停止し（開）、
+一定時間後に1件だけ試して（半開）、回復していれば再開する（閉）機能を提供
+停止中は呼び出し元が教科書の抜粋（LLMを使わない回答）をすぐに返せるようにする
+"""
+
+import threading
+import time
+from collections import deque
+
+import constants as ct
+from metrics import metrics_registry
+
+# 状態
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    LLMの回答生成のサーキットブレーカー（プロセス内で共有）
+    allow_request()で呼び出してよいかを確認し、結果をrecord_success()/record_failure()で記録する
+    """
+
+    def __init__(self, window_size: int = ct.BREAKER_WINDOW_SIZE,
+                 min_calls: int = ct.BREAKER_MIN_CALLS,
+                 failure_rate_threshold: float = ct.BREAKER_FAILURE_RATE_THRESHOLD,
+                 slow_call_seconds: float = ct.BREAKER_SLOW_CALL_SECONDS,
+                 slow_rate_threshold: float = ct.BREAKER_SLOW_RATE_THRESHOLD,
+                 open_seconds: float = ct.BREAKER_OPEN_SECONDS):
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate_threshold = slow_rate_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window_size)  # (失敗したか, 低速だったか)
+        self._state = STATE_CLOSED
+        self._opened_at = None
+        self._reason = None
+        self._probe_in_flight = False
+        self.opened = 0
+        self.short_circuited = 0
+
+    def _open(self, reason: str):
+        self._state = STATE_OPEN
+        self._opened_at = time.monotonic()
+        self._reason = reason
+        self._probe_in_flight = False
+        self.opened += 1
+
+    def _rates(self):
+        count = len(self._outcomes)
+        if not count:
+            return 0.0, 0.0
+        failures = sum(1 for failed, _ in self._outcomes if failed)
+        slow = sum(1 for _, slow in self._outcomes if slow)
+        return failures / count, slow / count
+
+    def allow_request(self) -> bool:
+        """
+        LLMを呼び出してよいか（開の間はFalse。開いてから一定時間後は1件だけ試しに通す）
+
+        Returns:
+            呼び出してよい場合はTrue（Trueの場合は必ず結果を記録する）
+        """
+        with self._lock:
+            if self._state == STATE_OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._state = STATE_HALF_OPEN
+            if self._state == STATE_CLOSED:
+                return True
+            if self._state == STATE_HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self, seconds: float):
+        """呼び出しの成功を記録（slow_call_secondsを超えた場合は低速として数える）"""
+        slow = seconds > self.slow_call_seconds
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                if slow:
+                    self._open(f"応答が遅い状態が続いています・{seconds:.0f}秒")
+                    return
+                # 回復したため、以前の結果を捨てて再開
+                self._state = STATE_CLOSED
+                self._reason = None
+                self._probe_in_flight = False
+                self._outcomes.clear()
+            self._outcomes.append((False, slow))
+            self._check()
+
+    def record_failure(self, error: BaseException = None):
+        """呼び出しの失敗（再試行しても成功しなかったもの）を記録"""
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._open(f"エラーが続いています・{type(error).__name__ if error else '不明'}")
+                return
+            self._outcomes.append((True, False))
+            self._check()
+
+    def record_ignored(self):
+        """allow_request()の後、LLMを呼び出さずに終わった場合（受付で断られた・取り消された）"""
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._probe_in_flight = False
+
+    def _check(self):
+        """直近の失敗率・低速率がしきい値を超えたら開く"""
+        if self._state != STATE_CLOSED or len(self._outcomes) < self.min_calls:
+            return
+        failure_rate, slow_rate = self._rates()
+        if failure_rate >= self.failure_rate_threshold:
+            self._open(f"エラーが続いています・直近の失敗率 {failure_rate:.0%}")
+        elif slow_rate >= self.slow_rate_threshold:
+            self._open(f"応答が遅い状態が続いています・直近の低速率 {slow_rate:.0%}")
+
+    def get_status(self) -> dict:
+        """状態・開いた理由・再開を試すまでの秒数・直近の失敗率と低速率"""
+        with self._lock:
+            failure_rate, slow_rate = self._rates()
+            retry_in = None
+            if self._state == STATE_OPEN:
+                retry_in = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+            return {
+                "state": self._state,
+                "reason": self._reason,
+                "retry_in_seconds": retry_in,
+                "failure_rate": failure_rate,
+                "slow_rate": slow_rate,
+                "calls": len(self._outcomes),
+                "opened": self.opened,
+                "short_circuited": self.short_circuited,
+            }
+
+
+# グローバルインスタンス（プロセス内の全セッションで共有）
+generation_breaker = CircuitBreaker()
+
+
+def _collect_breaker_metrics() -> dict:
+    """出力用の状態（停止中かどうかを数値で出せるようにする）"""
+    status = generation_breaker.get_status()
+    return {**status, "open": status["state"] != STATE_CLOSED}
+
+
+metrics_registry.register_collector("generation_breaker", _collect_breaker_metrics)
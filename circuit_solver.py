@@ -0,0 +1,286 @@
+"""
+回路計算ソルバーモジュール
+オームの法則・電力・直列/並列の合成抵抗の数値計算問題を、LLMを使わずに解く機能を提供
+"""
+
+import re
+from fractions import Fraction
+from query_canonicalizer import normalize_text
+
+try:
+    import sympy as sp
+    SYMPY_SUPPORT = True
+except ImportError:
+    SYMPY_SUPPORT = False
+
+
+# 量の記号・単位・名称
+QUANTITY_UNITS = {"V": "V", "I": "A", "R": "Ω", "P": "W"}
+QUANTITY_NAMES = {"V": "電圧", "I": "電流", "R": "抵抗", "P": "電力"}
+UNIT_TO_QUANTITY = {unit: quantity for quantity, unit in QUANTITY_UNITS.items()}
+
+# SI接頭辞
+PREFIX_FACTORS = {"": Fraction(1), "k": Fraction(1000), "K": Fraction(1000), "M": Fraction(10**6),
+                  "m": Fraction(1, 1000), "μ": Fraction(1, 10**6), "u": Fraction(1, 10**6)}
+
+QUANTITY_PATTERN = re.compile(r"(?<![A-Za-z0-9.])(\d+(?:\.\d+)?)\s*([kKMmμu]?)(Ω|V|A|W)(?![A-Za-z])")
+
+# 求める量を表す語（語の直後に数値が無い場合に「求める量」とみなす）
+TARGET_KEYWORDS = [
+    ("R", re.compile(r"合成抵抗|抵抗値|抵抗")),
+    ("P", re.compile(r"消費電力|電力")),
+    ("V", re.compile(r"電圧")),
+    ("I", re.compile(r"電流")),
+]
+GIVEN_VALUE_FOLLOWS = re.compile(r"\s*(?:の大きさ)?\s*(?:は|が|を|=|:)?\s*\d")
+ASKED_UNIT_PATTERN = re.compile(r"何\s*([kKMmμ]?)(Ω|V|A|W)(?![A-Za-z])")
+# 単位記号の前の接頭辞（PREFIX_FACTORSに無い接頭辞は換算できない）
+UNIT_PREFIX_PATTERN = re.compile(r"(?:\d|何)\s*([A-Za-zμ]*)(Ω|V|A|W)(?![A-Za-z])")
+# ソルバーで扱えない量・条件（時間・熱量・電力量・倍率・割合）
+UNSUPPORTED_PATTERN = re.compile(r"秒|時間|分間|熱量|電力量|ジュール|倍|割合|%|パーセント|\d\s*(?:J|Wh|h|s)(?![A-Za-z])")
+
+# 2つの既知量から目的の量を求める公式（表示用の式, sympyの式, 割る数に使う量）
+FORMULAS = {
+    ("V", ("I", "R")): ("V = I × R", lambda s: s["I"] * s["R"], ()),
+    ("I", ("R", "V")): ("I = V / R", lambda s: s["V"] / s["R"], ("R",)),
+    ("R", ("I", "V")): ("R = V / I", lambda s: s["V"] / s["I"], ("I",)),
+    ("P", ("I", "V")): ("P = V × I", lambda s: s["V"] * s["I"], ()),
+    ("P", ("I", "R")): ("P = I² × R", lambda s: s["I"] ** 2 * s["R"], ()),
+    ("P", ("R", "V")): ("P = V² / R", lambda s: s["V"] ** 2 / s["R"], ("R",)),
+    ("I", ("P", "V")): ("I = P / V", lambda s: s["P"] / s["V"], ("V",)),
+    ("V", ("I", "P")): ("V = P / I", lambda s: s["P"] / s["I"], ("I",)),
+    ("I", ("P", "R")): ("I = √(P / R)", lambda s: sp.sqrt(s["P"] / s["R"]), ("R",)),
+    ("V", ("P", "R")): ("V = √(P × R)", lambda s: sp.sqrt(s["P"] * s["R"]), ()),
+    ("R", ("I", "P")): ("R = P / I²", lambda s: s["P"] / s["I"] ** 2, ("I",)),
+    ("R", ("P", "V")): ("R = V² / P", lambda s: s["V"] ** 2 / s["P"], ("P",)),
+}
+
+
+def normalize_question(text: str) -> str:
+    """全角・半角や単位の読み方を統一"""
+    return normalize_text(text)
+
+
+def format_number(value) -> str:
+    """数値を有効数字4桁程度の読みやすい文字列に変換"""
+    value = float(value)
+    if value == int(value) and abs(value) < 1e9:
+        return str(int(value))
+    return f"{value:.4g}"
+
+
+def format_quantity(value, quantity: str) -> str:
+    """基本単位の値を、適切な接頭辞付きの表記に変換（例: 0.02A → 20mA）"""
+    unit = QUANTITY_UNITS[quantity]
+    magnitude = abs(float(value))
+    if magnitude >= 10**6 and quantity == "R":
+        return f"{format_number(value / 10**6)}M{unit}"
+    if magnitude >= 1000 and quantity in ("R", "V", "P"):
+        return f"{format_number(value / 1000)}k{unit}"
+    if 0 < magnitude < 1 and quantity in ("I", "V", "P"):
+        return f"{format_number(value * 1000)}m{unit}"
+    return f"{format_number(value)}{unit}"
+
+
+def parse_quantities(text: str) -> dict:
+    """問題文から単位付きの数値を抽出（量ごとのリスト）"""
+    quantities = {"V": [], "I": [], "R": [], "P": []}
+    for number, prefix, unit in QUANTITY_PATTERN.findall(text):
+        value = Fraction(number) * PREFIX_FACTORS[prefix]
+        quantities[UNIT_TO_QUANTITY[unit]].append({"value": value, "text": f"{number}{prefix}{unit}"})
+    return quantities
+
+
+def detect_target(text: str):
+    """問題文から求める量を判定"""
+    asked = ASKED_UNIT_PATTERN.search(text)
+    if asked:
+        return UNIT_TO_QUANTITY[asked.group(2)]
+
+    candidates = []
+    for quantity, pattern in TARGET_KEYWORDS:
+        for match in pattern.finditer(text):
+            if not GIVEN_VALUE_FOLLOWS.match(text, match.end()):
+                candidates.append((match.start(), quantity))
+    if not candidates:
+        return None
+    # 問題文の最後に現れる「数値を伴わない量」を求める量とする
+    return max(candidates)[1]
+
+
+def asked_prefix(text: str) -> str:
+    """「何kΩ」のように求める単位に接頭辞が指定されていれば、その接頭辞（無い場合は空文字）"""
+    asked = ASKED_UNIT_PATTERN.search(text)
+    return asked.group(1) if asked else ""
+
+
+def is_supported(text: str) -> bool:
+    """ソルバーで扱える問題か（扱えない量・条件、換算できない接頭辞を含む場合はFalse）"""
+    if UNSUPPORTED_PATTERN.search(text):
+        return False
+    return all(prefix in PREFIX_FACTORS for prefix, _ in UNIT_PREFIX_PATTERN.findall(text))
+
+
+def _given_lines(quantities: dict) -> tuple:
+    """「与えられた値」の行と単位換算の行を作成"""
+    lines = []
+    conversions = []
+    for quantity in ("V", "I", "R", "P"):
+        items = quantities[quantity]
+        for i, item in enumerate(items, 1):
+            symbol = f"{quantity}{i}" if len(items) > 1 else quantity
+            lines.append(f"- {QUANTITY_NAMES[quantity]}: ${symbol} = {item['text']}$")
+            base = f"{format_number(item['value'])}{QUANTITY_UNITS[quantity]}"
+            if base != item["text"]:
+                conversions.append(f"- ${item['text']} = {base}$")
+    return lines, conversions
+
+
+def _is_finite_real(value) -> bool:
+    """計算結果が有限の実数か（0での除算・負の数の平方根の結果はFalse）"""
+    return bool(value.is_real) and bool(value.is_finite)
+
+
+def _combined_resistance(resistances: list, connection: str):
+    """直列・並列の合成抵抗と計算過程を求める（0Ωを含む並列は1/0になるため、Noneを返す）"""
+    values = [sp.Rational(r["value"].numerator, r["value"].denominator) for r in resistances]
+    if connection == "並列" and any(v <= 0 for v in values):
+        return None
+    symbols = [f"R{i}" for i in range(1, len(values) + 1)]
+    texts = [f"{format_number(v)}Ω" for v in values]
+
+    if connection == "直列":
+        total = sum(values)
+        formulas = [f"$R = {' + '.join(symbols)}$"]
+        steps = [f"$R = {' + '.join(texts)} = {format_quantity(total, 'R')}$"]
+    else:
+        total = 1 / sum(1 / v for v in values)
+        formulas = [f"$1/R = {' + '.join(f'1/{s}' for s in symbols)}$"]
+        steps = [f"$1/R = {' + '.join(f'1/{t}' for t in texts)}$"]
+        if len(values) == 2:
+            formulas.append("2個の場合は $R = (R1 × R2) / (R1 + R2)$")
+            steps.append(f"$R = ({texts[0]} × {texts[1]}) / ({texts[0]} + {texts[1]}) = {format_quantity(total, 'R')}$")
+        else:
+            steps.append(f"$R = {format_quantity(total, 'R')}$")
+    return total, formulas, steps
+
+
+def _base_quantity(value, quantity: str) -> str:
+    """接頭辞を付けない基本単位での表記（例: 0.005A）"""
+    return f"{format_number(value)}{QUANTITY_UNITS[quantity]}"
+
+
+def solve_question(question: str):
+    """
+    回路計算の質問を解く
+
+    Args:
+        question: ユーザーの質問文
+
+    Returns:
+        解けた場合は {"answer": 解説付きの回答(Markdown), "value": 数値, "unit": 単位, "quantity": 量の記号}、
+        該当しない・判断できない場合はNone
+    """
+    if not SYMPY_SUPPORT:
+        return None
+
+    text = normalize_question(question)
+    if not is_supported(text):
+        return None
+    quantities = parse_quantities(text)
+    if sum(len(items) for items in quantities.values()) < 2:
+        return None
+
+    connection = "直列" if "直列" in text else "並列" if "並列" in text else None
+    target = detect_target(text)
+    # 求める量（「電圧は？」「何Ω」など）が書かれていない問題は推測しない
+    if target is None:
+        return None
+    resistances = quantities["R"]
+
+    # 抵抗以外の量が複数ある問題は対象外
+    if any(len(quantities[q]) > 1 for q in ("V", "I", "P")):
+        return None
+
+    # 既知量（sympyの有理数）
+    known = {q: sp.Rational(items[0]["value"].numerator, items[0]["value"].denominator)
+             for q, items in quantities.items() if len(items) == 1}
+    formula_lines = []
+    calc_lines = []
+    value = None
+
+    if len(resistances) >= 2:
+        # 複数の抵抗は接続方法が分からなければ解かない
+        if connection is None:
+            return None
+        combined = _combined_resistance(resistances, connection)
+        if combined is None:
+            return None
+        total, formulas, steps = combined
+        formula_lines.append(f"合成抵抗（{connection}接続）: " + "、".join(formulas))
+        calc_lines.extend(steps)
+        known["R"] = total
+        if target == "R":
+            value = total
+    elif target in known:
+        return None
+
+    if value is None:
+        formula_key = next(
+            (key for key in FORMULAS if key[0] == target and all(q in known for q in key[1])),
+            None
+        )
+        if formula_key is None:
+            return None
+        display, expression, divisors = FORMULAS[formula_key]
+        # 0以下で割る問題は解かない（検索とLLMの回答に任せる）
+        if any(known[q] <= 0 for q in divisors):
+            return None
+
+        def _substitute(match):
+            # 公式の記号を基本単位の数値に置き換える（二乗は括弧で囲む）
+            text = _base_quantity(known[match.group(1)], match.group(1))
+            return f"({text})²" if match.group(2) else text
+
+        value = sp.nsimplify(expression(known))
+        # 負の数の平方根・無限大などの計算結果も同様に扱う
+        if not _is_finite_real(value):
+            return None
+        substitution = re.sub(r"([VIRP])(²?)", _substitute, display.split(" = ", 1)[1])
+        formula_lines.append(f"${display}$")
+        calc_lines.append(f"${target} = {substitution} = {_base_quantity(value, target)}$")
+
+    given_lines, conversions = _given_lines(quantities)
+    unit = QUANTITY_UNITS[target]
+    prefix = asked_prefix(text)
+    if prefix:
+        # 求める単位が指定されている場合は、その単位で答える
+        answer_text = f"{format_number(value / sp.Rational(PREFIX_FACTORS[prefix]))}{prefix}{unit}"
+    else:
+        answer_text = format_quantity(value, target)
+    if answer_text != _base_quantity(value, target):
+        answer_text += f"（{_base_quantity(value, target)}）"
+
+    sections = [
+        "### 🔢 計算問題の解き方（自動計算）",
+        "**1. 与えられた値を整理**",
+        "\n".join(given_lines),
+    ]
+    if conversions:
+        sections += ["**単位の変換**", "\n".join(conversions)]
+    sections += [
+        "**2. 使用する公式**",
+        "\n\n".join(formula_lines),
+        "**3. 数値を代入して計算**",
+        "\n\n".join(calc_lines),
+        "**4. 単位を確認**",
+        f"求める{QUANTITY_NAMES[target]}の単位は {prefix}{unit} です。",
+        f"**✅ 答え: {QUANTITY_NAMES[target]}は {answer_text}**",
+    ]
+
+    return {
+        "answer": "\n\n".join(sections),
+        "value": float(value),
+        "unit": unit,
+        "quantity": target,
+    }
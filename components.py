@@ -6,9 +6,11 @@
 # ライブラリの読み込み
 ############################################################
 import streamlit as st
-import os
-import utils
+import llm_client
+import math_normalizer
 import constants as ct
+import index_loader as il
+from metrics import metrics_registry
 
 
 ############################################################
@@ -47,28 +49,55 @@ def display_initial_ai_message():
     st.session_state.messages.append(initial_message)
 
 
+def get_message_markdown(message):
+    """
+    会話ログの1メッセージを表示用のMarkdownに変換
+    問い合わせモードの回答は数式を表示用の$$…$$ブロックに整える（結果はメッセージに保存し、再実行時は変換しない）
+
+    Args:
+        message: 会話ログのメッセージ（role・content）
+
+    Returns:
+        表示用のMarkdown
+    """
+    content = message["content"]
+    if message["role"] == "user":
+        # ユーザー入力値はそのまま表示
+        return content
+    if content["mode"] != ct.ANSWER_MODE_2:
+        # 初期メッセージ・教科書検索の結果は変換しない
+        return content["message"] if content["mode"] == "initial" else content["answer"]
+
+    rendered = message.get("rendered")
+    if rendered is None:
+        rendered = message["rendered"] = math_normalizer.prepare_math_response(content["answer"])
+    return rendered
+
+
 def display_conversation_log():
     """
-    会話ログの一覧表示
+    会話ログの一覧表示（直近のやり取りのみ表示し、古いものは「以前の会話を表示」で読み込む）
     """
-    # 会話ログのループ処理
-    for message in st.session_state.messages:
+    if "log_visible_turns" not in st.session_state:
+        st.session_state.log_visible_turns = ct.CONVERSATION_LOG_WINDOW_TURNS
+
+    messages = st.session_state.messages
+    # 1回のやり取りは質問と回答の2メッセージ
+    visible_count = st.session_state.log_visible_turns * 2
+    hidden_count = max(0, len(messages) - visible_count)
+
+    if hidden_count:
+        if st.button(f"⬆️ 以前の会話を表示（残り{hidden_count}件）", key="load_older_messages"):
+            st.session_state.log_visible_turns += ct.CONVERSATION_LOG_PAGE_TURNS
+            st.rerun()
+
+    # 表示範囲のメッセージだけを描画（履歴の長さによらず再実行のコストを一定にする）
+    for index in range(hidden_count, len(messages)):
+        message = messages[index]
         # 「message」辞書の中の「role」キーには「user」か「assistant」が入っている
         with st.chat_message(message["role"]):
-
-            # ユーザー入力値の場合、そのままテキストを表示するだけ
-            if message["role"] == "user":
-                st.markdown(message["content"])
-            
-            # LLMからの回答の場合
-            else:
-                # 初期メッセージの場合
-                if message["content"]["mode"] == "initial":
-                    st.markdown(message["content"]["message"])
-                # 「問い合わせ」の場合の表示処理
-                else:
-                    # LLMからの回答を表示（LaTeX対応）
-                    st.markdown(message["content"]["answer"], unsafe_allow_html=True)
+            # LLMからの回答はLaTeX対応で表示
+            st.markdown(get_message_markdown(message), unsafe_allow_html=message["role"] == "assistant")
 
 
 def display_contact_llm_response(llm_response):
@@ -82,7 +111,7 @@ def display_contact_llm_response(llm_response):
         LLMからの回答を画面表示用に整形した辞書データ
     """
     # LaTeX数式の整形処理
-    answer = utils.format_latex_equations(llm_response["answer"])
+    answer = math_normalizer.format_latex_equations(llm_response["answer"])
     
     # LLMからの回答を表示（unsafe_allow_htmlでLaTeX処理を有効化）
     st.markdown(answer, unsafe_allow_html=True)
@@ -95,37 +124,67 @@ def display_contact_llm_response(llm_response):
     return content
 
 
-def display_faiss_initialization_sidebar():
+def display_index_status_sidebar():
     """
-    FAISS-RAG初期化ボタンを表示
-    
-    Returns:
-        bool: 初期化ボタンが押されたかどうか
+    インデックスの読み込み状態と、読み込みの開始・読み込み直しのボタンを表示
     """
     # 要件チェック
-    api_key_ok = bool(os.environ.get("OPENAI_API_KEY"))
-    
-    if not api_key_ok:
+    if not llm_client.is_openai_configured():
         st.error("OpenAI APIキーが設定されていません。")
-        return False
+        return
+    
+    status = il.index_loader.get_status()
+    if status["state"] == il.STATE_IDLE:
+        if st.button("🚀 RAG機能を初期化", help="教科書・教材データベースをバックグラウンドで読み込み"):
+            il.index_loader.start()
+            st.rerun()
+    elif status["state"] == il.STATE_LOADING:
+        st.info(f"⏳ 教科書データを読み込み中...（{status['elapsed_seconds']:.0f}秒経過）")
+        if status["message"]:
+            st.caption(status["message"])
+    elif status["state"] == il.STATE_READY:
+        source = "キャッシュから復元・API使用なし" if status["source"] == "cache" else "新規作成"
+        st.success(f"✅ RAG機能が有効です（{status['chunks']}チャンク）")
+        st.caption(f"読み込み時間: {status['elapsed_seconds']:.1f}秒（{source}）")
+        if status["version"]:
+            st.caption(f"インデックスのバージョン: {status['version']}")
+        if status["message"]:
+            st.warning(status["message"])
+        if status["reload_error"]:
+            st.warning(f"新しいバージョンの読み込みに失敗したため、前のインデックスで回答しています: {status['reload_error']}")
+        if st.button("🔄 RAG機能を再初期化"):
+            il.index_loader.start(force=True)
+            st.rerun()
     else:
-        if not st.session_state.get('rag_initialized', False):
-            return st.button("🚀 RAG機能を初期化", help="教科書・教材データベースを初期化")
-        else:
-            st.success("✅ RAG機能が有効です")
-            if st.button("🔄 RAG機能を再初期化"):
-                st.session_state.rag_initialized = False
-                st.rerun()
-            return False
+        st.error(f"RAG初期化エラー: {status['error']}")
+        if st.button("🔁 読み込みを再試行"):
+            il.index_loader.start(force=True)
+            st.rerun()
+
+
+@st.fragment(run_every=ct.INDEX_STATUS_POLL_SECONDS)
+def display_index_loading_progress():
+    """
+    読み込み中の進捗表示（一定間隔で更新し、読み込みが終わったら画面全体を再実行してインデックスを利用開始）
+    """
+    status = il.index_loader.get_status()
+    if status["state"] != il.STATE_LOADING:
+        st.rerun()
+    st.info(f"⏳ 教科書データを読み込み中です。完了すると自動的に質問できるようになります（{status['elapsed_seconds']:.0f}秒経過）")
 
 
 def display_faiss_rag_status():
     """
     FAISS-RAG機能のステータス表示
     """
+    state = il.index_loader.get_status()["state"]
     if st.session_state.get('rag_initialized', False):
         chunks_count = len(st.session_state.get('pdf_chunks', []))
         st.success(f"✅ RAG機能が有効です（{chunks_count}チャンク）")
+    elif state == il.STATE_LOADING:
+        display_index_loading_progress()
+    elif state == il.STATE_FAILED:
+        st.error("教科書データの読み込みに失敗しました。サイドバーから再試行してください。")
     else:
         st.info("⚡ RAG機能を初期化してから質問を開始してください。")
 
@@ -146,4 +205,42 @@ def display_faiss_search_results(search_results):
             st.markdown(f"- **類似度スコア**: {result['similarity_score']:.3f}")
             st.markdown(f"- **出典ファイル**: {result['metadata'].get('source_file', 'unknown')}")
             st.markdown(f"- **内容プレビュー**: {result['content'][:100]}...")
-            st.markdown("---")
\ No newline at end of file
+            st.markdown("---")
+
+
+def display_stage_metrics_sidebar():
+    """
+    処理段階ごとの所要時間（このワーカーのp50/p95/p99）とSLOの達成状況、Prometheus形式のダウンロードを表示（管理者向け）
+    """
+    summary = metrics_registry.get_stage_summary()
+    if not summary:
+        st.caption("まだ計測した処理がありません。")
+        return
+
+    # 表はMarkdownで表示（サイドバーの描画でpyarrow・numpyを読み込まない）
+    rows = ["| 段階 | 件数 | p50 | p95 | p99 | エラー |", "|---|---:|---:|---:|---:|---:|"]
+    for row in summary:
+        rows.append(
+            f"| {row['label']} | {row['count']} | {row['p50_seconds'] * 1000:.1f}ms"
+            f" | {row['p95_seconds'] * 1000:.1f}ms | {row['p99_seconds'] * 1000:.1f}ms | {row['errors']} |"
+        )
+    st.markdown("\n".join(rows))
+
+    # p95の目標を超えている段階
+    for row in summary:
+        if row["slo_met"] is False:
+            st.warning(f"⚠️ {row['label']}のp95が目標を超えています（{row['p95_seconds']:.2f}秒 / 目標 {row['slo_p95_seconds']:g}秒）")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button(
+            "📥 Prometheus形式",
+            metrics_registry.to_prometheus(),
+            file_name="metrics.prom",
+            mime="text/plain"
+        )
+    with col2:
+        if st.button("🧹 計測値をリセット"):
+            metrics_registry.reset()
+            st.rerun()
+    st.caption("値はこのワーカーのプロセスごとの集計です（APIサーバーは GET /metrics で取得できます）。")
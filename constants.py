@@ -5,10 +5,9 @@
 ############################################################
 # ライブラリの読み込み
 ############################################################
+import importlib
 import os
 import warnings
-from langchain_community.document_loaders import PyMuPDFLoader, Docx2txtLoader, TextLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
 
 # 環境変数の設定
 if not os.getenv("USER_AGENT"):
@@ -27,7 +26,7 @@ warnings.filterwarnings("ignore", category=UserWarning, module="langchain_commun
 # ==========================================
 APP_NAME = "生産技術授業支援アプリ"
 APP_VERSION = "1.0"
-ANSWER_MODE_1 = "問い合わせ"
+ANSWER_MODE_1 = "教科書検索"
 ANSWER_MODE_2 = "問い合わせ"
 CHAT_INPUT_HELPER_TEXT = "生産技術に関する質問を入力してください。"
 DOC_SOURCE_ICON = ":material/description: "
@@ -35,6 +34,9 @@ LINK_SOURCE_ICON = ":material/link: "
 WARNING_ICON = ":material/warning:"
 ERROR_ICON = ":material/error:"
 SPINNER_TEXT = "回答生成中..."
+# 会話ログは直近のやり取りだけを表示し、それより前は「以前の会話を表示」で段階的に読み込む
+CONVERSATION_LOG_WINDOW_TURNS = 10  # 初期表示するやり取り（質問＋回答）の数
+CONVERSATION_LOG_PAGE_TURNS = 10  # 「以前の会話を表示」1回で追加表示するやり取りの数
 
 
 # ==========================================
@@ -50,11 +52,21 @@ APP_BOOT_MESSAGE = f"{APP_NAME} v{APP_VERSION} が起動されました。"
 # RAG参照用のデータソース系
 # ==========================================
 RAG_TOP_FOLDER_PATH = "./data"
+
+
+def _lazy_loader(module_name, class_name, **kwargs):
+    """ドキュメントローダーを初回の利用時に読み込む（LangChainの読み込みで起動を待たせない）"""
+    def create_loader(path):
+        loader_class = getattr(importlib.import_module(module_name), class_name)
+        return loader_class(path, **kwargs)
+    return create_loader
+
+
 SUPPORTED_EXTENSIONS = {
-    ".pdf": PyMuPDFLoader,
-    ".docx": Docx2txtLoader,
-    ".csv": lambda path: CSVLoader(path, encoding="utf-8"),
-    ".txt": lambda path: TextLoader(path, encoding="utf-8")
+    ".pdf": _lazy_loader("langchain_community.document_loaders", "PyMuPDFLoader"),
+    ".docx": _lazy_loader("langchain_community.document_loaders", "Docx2txtLoader"),
+    ".csv": _lazy_loader("langchain_community.document_loaders.csv_loader", "CSVLoader", encoding="utf-8"),
+    ".txt": _lazy_loader("langchain_community.document_loaders", "TextLoader", encoding="utf-8")
 }
 
 # ==========================================
@@ -75,6 +87,13 @@ PDF_FILES = [
 VECTOR_STORE_PATH = "./data/vector_store/"  # ベクターストア保存ディレクトリ
 VECTOR_INDEX_FILE = "faiss_index"  # FAISSインデックスファイル名
 CHUNKS_CACHE_FILE = "chunks_cache.pkl"  # チャンクキャッシュファイル名
+VECTOR_STORE_CURRENT_FILE = "CURRENT"  # 公開中のインデックスのバージョンを記録するポインタファイル名
+INDEX_VERSION_CHECK_SECONDS = 10  # 他のプロセスが公開した新しいバージョンの確認間隔（秒）
+INDEX_VERSION_GC_GRACE_SECONDS = 600  # 切り替え後の古いバージョンを削除するまでの猶予（秒）
+INDEX_BUILD_LOCK_FILE = "build.lock"  # インデックス作成のプロセス間ロックファイル名（ベクターストア保存ディレクトリ内）
+INDEX_BUILD_LOCK_TIMEOUT_SECONDS = 1800  # 別のワーカーによる作成の完了を待つ最大秒数
+PRELOAD_INDEX_ON_START = True  # サーバー起動後の最初の表示でインデックスをバックグラウンドで読み込む（Falseの場合はボタンで開始）
+INDEX_STATUS_POLL_SECONDS = 1  # 読み込み中の状態表示の更新間隔（秒）
 EMBEDDINGS_CACHE_DIR = "./data/embeddings_cache/"  # 埋め込みキャッシュディレクトリ
 
 # チャンク分割設定（統一設定）
@@ -96,10 +115,155 @@ OPENAI_CHAT_MODEL = "gpt-4o-mini"  # コスト削減のためminiモデルに変
 OPENAI_TEMPERATURE = 0.1  # 計算問題の精度を高めるため低い値
 OPENAI_MAX_TOKENS = 1500  # トークン数削減でコスト削減
 
+# ローカルスタブサーバー設定（オフライン性能試験用、OPENAI_BASE_URLで接続先を切り替え）
+STUB_SERVER_HOST = "127.0.0.1"
+STUB_SERVER_PORT = 8001
+STUB_FIXTURES_DIR = "./data/stub_fixtures/"  # record/replayモードのフィクスチャ保存先
+STUB_EMBEDDING_DIMENSIONS = 1536  # text-embedding-3-smallと同じ次元数
+STUB_API_KEY = "sk-local-stub"  # スタブ接続時にAPIキー未設定の場合のダミー値
+
+# 複数ワーカー設定（run_workers.py、データディレクトリ・キャッシュは全ワーカーで共有）
+WORKER_COUNT = None  # ワーカープロセス数（NoneはCPUコア数）
+WORKER_PROXY_HOST = "0.0.0.0"  # 振り分けプロキシの待ち受けアドレス
+WORKER_PROXY_PORT = 8501  # 振り分けプロキシの待ち受けポート（利用者が接続するポート）
+WORKER_BASE_PORT = 8601  # ワーカーのポート（WORKER_BASE_PORTから順に割り当て、127.0.0.1で待ち受け）
+WORKER_STARTUP_TIMEOUT_SECONDS = 60  # ワーカーの起動を待つ最大秒数
+WORKER_AFFINITY_COOKIE = "seisan_worker"  # 振り分け先のワーカーを記録するCookieの名前（同じブラウザを同じワーカーに届ける）
+
+# HTTP API設定（api_server.py）
+API_HOST = "127.0.0.1"  # 待ち受けアドレス
+API_PORT = 8000  # 待ち受けポート
+API_MAX_QUESTION_CHARS = 2000  # 質問の最大文字数
+API_MAX_BATCH_QUERIES = 32  # /v1/search の1リクエストあたりの最大クエリ数
+API_MAX_SEARCH_K = 20  # /v1/search の取得件数の上限
+
 # コスト管理設定
-MAX_DAILY_API_CALLS = 100  # 1日あたりの最大API呼び出し数
+MAX_DAILY_API_CALLS = None  # 1日あたりの最大API呼び出し数（全体。Noneで無制限、利用者ごとの制限はADMISSION_*で行う）
+MAX_DAILY_TOKENS = 1_000_000  # 1日あたりの最大トークン数（入力+出力、Noneで無制限）
+MAX_DAILY_COST_USD = 1.0  # 1日あたりの推定コスト上限（USD、Noneで無制限）
+USAGE_DB_PATH = "./data/usage.db"  # API使用量の台帳（SQLite）
+
+# LLM呼び出しの受付制御（admission.py。1人の連続送信で全体の枠を使い切らないようにする）
+# 以下の制限はすべてワーカーのプロセスごとに判定し、全ワーカーでは共有しない（全体ではワーカー数倍になる）
+ENABLE_ADMISSION_CONTROL = True  # 受付制御の有効/無効
+ADMISSION_USER_RATE_PER_MINUTE = 2.0  # 利用者ごとの枠の回復速度（回/分・ワーカーごと）
+ADMISSION_USER_BURST = 5  # 利用者ごとに続けて送れる回数（ワーカーごと。授業開始時の一斉送信を受け止める）
+ADMISSION_MAX_CONCURRENT = 8  # 上流のLLMへの同時リクエスト数（ワーカーごと）
+ADMISSION_MAX_BACKGROUND_CONCURRENT = 2  # うちFAQ事前生成・会話履歴の要約・一括評価に使える数（ワーカーごと。残りは生徒の質問用）
+ADMISSION_MAX_QUEUE = 60  # 同時リクエスト数の上限を超えた分の待ち行列の上限（ワーカーごと）
+ADMISSION_MAX_WAIT_SECONDS = 90  # 待ち時間の見込みがこれを超える場合は受け付けず、再試行までの目安を表示
+ADMISSION_INITIAL_SERVICE_SECONDS = 5.0  # 待ち時間の見込みに使う1リクエストの処理時間の初期値（以降は実測の移動平均）
+ADMISSION_SERVICE_EMA_ALPHA = 0.2  # 処理時間の移動平均の重み
+ADMISSION_MAX_TRACKED_USERS = 10000  # 枠を記録する利用者数の上限（ワーカーごと。古いものから捨てる）
+LLM_INTERACTIVE_DEADLINE_SECONDS = 120  # 生徒の質問の期限（順番待ち＋LLMの呼び出し。残り時間をタイムアウトにする）
+LLM_BACKGROUND_DEADLINE_SECONDS = 600  # バックグラウンドの処理の期限
+
+# LLM呼び出しの再試行・ヘッジ（llm_resilience.py。応答の遅い・失敗したリクエストによる待ち時間の裾を抑える）
+LLM_MAX_ATTEMPTS = 3  # 1回の回答生成あたりの最大試行回数（再試行できるエラーのみ再試行）
+LLM_ATTEMPT_TIMEOUT_SECONDS = 45  # 1回の試行のタイムアウト（期限の残りの方が短い場合はそちら）
+LLM_RETRY_BASE_SECONDS = 0.5  # 再試行までの待ち時間の基準（試行ごとに2倍、0〜この値のランダム）
+LLM_RETRY_MAX_BACKOFF_SECONDS = 8  # 再試行までの待ち時間の上限（Retry-Afterヘッダーがあればそちらを優先）
+ENABLE_LLM_HEDGING = False  # 応答が遅い場合に2本目のリクエストを出す（速い方を使い、遅い方は取り消す。費用が増えるため既定は無効）
+LLM_HEDGE_PERCENTILE = 95  # この割合の応答時間を超えても返らない場合に2本目を出す
+LLM_HEDGE_MIN_SAMPLES = 20  # ヘッジを始めるのに必要な応答時間の実績数
+LLM_LATENCY_WINDOW = 200  # 応答時間のパーセンタイルの計算に使う直近の件数
+
+# 回答生成のサーキットブレーカー（circuit_breaker.py。LLMが遅い・失敗が続く間は教科書の抜粋ですぐに回答する）
+ENABLE_GENERATION_BREAKER = True  # サーキットブレーカーの有効/無効
+GENERATION_LATENCY_BUDGET_SECONDS = 30  # 生徒の質問の回答生成にかけてよい時間（超えたら教科書の抜粋で回答）
+BREAKER_WINDOW_SIZE = 20  # 失敗率・低速率を計算する直近の呼び出し数
+BREAKER_MIN_CALLS = 10  # 判定に必要な呼び出し数
+BREAKER_FAILURE_RATE_THRESHOLD = 0.5  # この失敗率以上で停止
+BREAKER_SLOW_CALL_SECONDS = 20  # これを超えた呼び出しを低速として数える
+BREAKER_SLOW_RATE_THRESHOLD = 0.5  # この低速率以上で停止
+BREAKER_OPEN_SECONDS = 30  # 停止してから、1件だけ試して再開を判断するまでの秒数
+
+# 処理段階ごとの所要時間の計測（metrics.py。サイドバーの管理者向けパネル・APIの/metrics・OpenTelemetryで確認する）
+ENABLE_STAGE_METRICS = True  # 計測の有効/無効
+METRICS_NAMESPACE = "seisan_rag"  # 出力する値の名前の接頭辞（OpenTelemetryのメーター名・既定のサービス名にも使う）
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # ヒストグラムの区切り（秒）
+METRICS_WINDOW = 1000  # p50/p95/p99の計算に使う直近の件数（段階ごと）
+ENABLE_OTEL_METRICS = True  # OpenTelemetryにも記録（送信はOTEL_EXPORTER_OTLP_ENDPOINTを設定し、SDKがある場合のみ）
+OTEL_EXPORT_INTERVAL_SECONDS = 30  # OpenTelemetryの送信間隔
+# 段階の名前と表示名（サイドバーの表示順）
+METRICS_STAGE_LABELS = {
+    "pdf_load": "PDF読み込み",
+    "split": "テキスト分割",
+    "preprocess": "チャンク前処理",
+    "embedding": "埋め込み・インデックス作成",
+    "index_save": "インデックス保存",
+    "index_load": "インデックス読み込み",
+    "query_embedding": "質問の埋め込み",
+    "faiss_search": "FAISS検索",
+    "question_rewrite": "質問の書き換え（会話履歴）",
+    "chain_retrieval": "検索（会話履歴のChain）",
+    "generation": "回答生成（LLM）",
+    "time_to_first_token": "最初の断片まで（ストリーミング）",
+    "math_postprocess": "数式の整形",
+    "math_display": "数式の表示",
+    "answer_total": "回答全体",
+}
+# 段階ごとのp95の目標（秒）。サイドバーで超えている段階を知らせる
+METRICS_STAGE_SLO_P95_SECONDS = {
+    "query_embedding": 1.0,
+    "faiss_search": 0.1,
+    "question_rewrite": 5.0,
+    "generation": GENERATION_LATENCY_BUDGET_SECONDS,
+    "math_postprocess": 0.05,
+    "math_display": 0.5,
+    "answer_total": 40.0,
+}
+USAGE_EVENT_RETENTION_DAYS = 30  # リクエストごとの明細の保存期間（日）。日次集計は残す
+# モデルごとの単価（USD / 100万トークン）。cached_inputはプロンプトキャッシュにヒットした入力の単価
+MODEL_PRICING = {
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+}
 CACHE_EXPIRY_HOURS = 24  # キャッシュの有効期限（時間）
 ENABLE_RESPONSE_CACHE = True  # レスポンスキャッシュの有効/無効
+RESPONSE_CACHE_DB_PATH = "./data/cache/response_cache.db"  # レスポンスキャッシュのSQLiteファイル
+CACHE_MAX_ENTRIES = 2000  # レスポンスキャッシュの最大件数
+CACHE_MAX_BYTES = 50 * 1024 * 1024  # レスポンスキャッシュの最大容量（バイト）
+CACHE_EVICTION_POLICY = "lru"  # 上限超過時の追い出し方式（"lru": 最終アクセスが古い順 / "lfu": アクセス回数が少ない順）
+CACHE_REFRESH_ON_ACCESS = True  # Trueの場合、キャッシュヒットのたびに有効期限（CACHE_EXPIRY_HOURS）を延長
+L1_CACHE_MAX_ENTRIES = 256  # プロセス内メモリキャッシュ（L1）の最大件数
+L1_CACHE_TTL_SECONDS = 300  # L1の有効期限（秒）。他プロセスでの保存・削除は参照のたびにSQLiteの世代番号で検出する
+L1_ACCESS_FLUSH_SECONDS = 60  # L1ヒットのアクセス情報・キャッシュミスの回数をSQLite（L2）へまとめて反映する間隔（秒）
+ENABLE_QUERY_EMBEDDING_CACHE = True  # 検索クエリの埋め込みをメモリにキャッシュ（同じ質問の再検索で埋め込みAPIを使わない）
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = 1024  # クエリ埋め込みキャッシュの最大件数
+QUERY_EMBEDDING_CACHE_TTL_SECONDS = 24 * 3600  # クエリ埋め込みキャッシュの有効期限（秒）
+QUERY_EMBEDDING_CACHE_DB_PATH = "./data/cache/query_embeddings.db"  # 全ワーカーで共有するクエリ埋め込みキャッシュ（SQLite）
+
+# 回路計算ソルバー設定（オームの法則・電力・合成抵抗の数値計算をLLMを使わずに解く）
+ENABLE_CIRCUIT_SOLVER = True  # 計算問題の高速回答の有効/無効
+CIRCUIT_SOLVER_LLM_EXPLANATION = False  # Trueの場合、計算結果に加えてLLMによる解説も生成
+
+# FAQ事前回答（アンサーバンク）設定
+ENABLE_ANSWER_BANK = True  # 事前生成した回答の利用の有効/無効
+ANSWER_BANK_PATH = "./data/answer_bank.json"  # 事前回答の保存先
+FAQ_FILE_PATH = "./data/faq_questions.txt"  # 1行1問のFAQ一覧（存在する場合はFAQ_QUESTIONSより優先）
+ANSWER_BANK_AUTO_WARM_UP = True  # インデックスの読み込み完了・新しいバージョンの公開のたびに、バックグラウンドで事前回答を作成
+
+# 会話履歴（メモリ）設定
+HISTORY_RECENT_TOKEN_BUDGET = 1500  # そのままプロンプトに含める直近のやり取りのトークン数の上限
+HISTORY_SUMMARY_TOKEN_BUDGET = 300  # それより古いやり取りをまとめた要約のトークン数の上限
+HISTORY_MIN_RECENT_TURNS = 1  # 上限を超えても要約せずに残す直近のやり取りの数（それだけで上限を超える場合は回答を切り詰める）
+
+# サイドバーに表示する入力例
+EXAMPLE_QUESTIONS = [
+    "キルヒホッフの法則を分かりやすく教えて",
+    "オームの法則で電流2A、抵抗5Ωの時の電圧は？",
+    "直列回路の合成抵抗の計算方法は？"
+]
+
+# 事前回答を作成するFAQ（入力例＋よくある質問）
+FAQ_QUESTIONS = EXAMPLE_QUESTIONS + [
+    "キルヒホッフの法則について",
+    "キルヒホッフの法則の計算方法を詳しく教えて",
+    "オームの法則について詳しく説明して",
+    "並列回路の合成抵抗の計算方法は？",
+    "電力の求め方を教えて"
+]
 
 # 互換性のための設定
 MODEL = OPENAI_CHAT_MODEL  # utils.pyとの互換性
@@ -116,11 +280,8 @@ SYSTEM_PROMPT_DOC_SEARCH = """
     以下の条件に基づき、ユーザー入力に対して回答してください。
 
     【条件】
-    1. ユーザー入力内容と以下の文脈との間に関連性がある場合、空文字「""」を返してください。
-    2. ユーザー入力内容と以下の文脈との関連性が明らかに低い場合、「該当資料なし」と回答してください。
-
-    【文脈】
-    {context}
+    1. ユーザー入力内容と【文脈】との間に関連性がある場合、空文字「""」を返してください。
+    2. ユーザー入力内容と【文脈】との関連性が明らかに低い場合、「該当資料なし」と回答してください。
 """
 
 SYSTEM_PROMPT_INQUIRY = """
@@ -136,8 +297,6 @@ SYSTEM_PROMPT_INQUIRY = """
     6. 複雑な質問の場合、各項目についてそれぞれ詳細に回答してください。
     7. 必要と判断した場合は、以下の文脈に基づかずとも、生産技術に関する一般的な情報を回答してください。
     8. 数式を表示する際は、必ず$記号で囲んでください（例：$V = I \\times R$）。
-
-    {context}
 """
 
 SYSTEM_PROMPT_STUDENT_FRIENDLY = """
@@ -191,7 +350,26 @@ SYSTEM_PROMPT_STUDENT_FRIENDLY = """
 5. 覚え方やコツ
 6. 実習での活用方法
 
-【生徒の質問】
+質問と教科書の関連内容はユーザーメッセージで渡されます。
+"""
+
+# プロンプトキャッシュを効かせるため、リクエストごとに変わる内容は
+# システムプロンプト（不変の接頭辞）の後ろのユーザーメッセージにまとめる
+USER_PROMPT_DOC_SEARCH = """【文脈】
+{context}
+
+【ユーザー入力】
+{input}
+"""
+
+USER_PROMPT_INQUIRY = """【文脈】
+{context}
+
+【ユーザー入力】
+{input}
+"""
+
+USER_PROMPT_STUDENT_FRIENDLY = """【生徒の質問】
 {query}
 
 【教科書の関連内容】
@@ -201,6 +379,22 @@ SYSTEM_PROMPT_STUDENT_FRIENDLY = """
 工業高校生が理解しやすいように、親切丁寧に回答してください。
 """
 
+# 会話履歴の要約用（古いやり取りを要約に畳み込む）
+SYSTEM_PROMPT_SUMMARIZE_HISTORY = """
+    あなたは生産技術教育のアシスタントです。
+    生徒との会話の要約と新しいやり取りをもとに、今後の質問に答えるために必要な情報だけを残した要約を作成してください。
+    生徒が質問した内容・扱った公式や数値・生徒がつまずいた点を優先し、日本語の箇条書きで簡潔にまとめてください。
+"""
+
+USER_PROMPT_SUMMARIZE_HISTORY = """【これまでの要約】
+{summary}
+
+【新しいやり取り】
+{conversation}
+"""
+
+HISTORY_SUMMARY_PREFIX = "これまでの会話の要約:\n"
+
 
 # ==========================================
 # LLMレスポンスの一致判定用
@@ -218,6 +412,8 @@ NO_DOC_MATCH_MESSAGE = """
     入力内容と関連する教科書・教材が見つかりませんでした。\n
     入力内容を変更してください。
 """
+NO_SEARCH_RESULTS_MESSAGE = "関連する情報が見つかりませんでした。質問を変えてみてください。"
+DEGRADED_ANSWER_BANNER = "⚠️ AIによる回答を作成できないため、教科書の該当箇所を抜き出して表示しています（{reason}）。しばらくすると通常の回答に戻ります。"
 CONVERSATION_LOG_ERROR_MESSAGE = "過去の会話履歴の表示に失敗しました。"
 GET_LLM_RESPONSE_ERROR_MESSAGE = "回答生成に失敗しました。"
 DISP_ANSWER_ERROR_MESSAGE = "回答表示に失敗しました。"
@@ -0,0 +1,230 @@
+"""
+会話履歴の管理モジュール
+直近のやり取りをトークン数の上限内でそのまま保持し、上限を超えた古いやり取りは
+バックグラウンドで要約に畳み込む機能を提供（要約の作成で回答のリクエストを待たせない）
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+import constants as ct
+import llm_client
+
+try:
+    import tiktoken
+    TIKTOKEN_SUPPORT = True
+except ImportError:
+    TIKTOKEN_SUPPORT = False
+
+
+# 要約の作成は全セッションで1スレッドを共有（APIへの同時リクエストを増やさない）
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    トークン数を数える（tiktokenを使えない場合は概算）
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        トークン数
+    """
+    global _encoding
+    if not text:
+        return 0
+    # 互換エンドポイント利用時はtiktokenの辞書ダウンロード（ネットワーク接続）を避ける
+    if TIKTOKEN_SUPPORT and _encoding is None and not llm_client.get_base_url():
+        try:
+            _encoding = tiktoken.encoding_for_model(ct.OPENAI_CHAT_MODEL)
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    # 英数字は4文字で1トークン、日本語等は1文字1トークンとして概算
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return max(1, ascii_chars // 4 + (len(text) - ascii_chars))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """テキストを先頭からmax_tokensトークン以内に切り詰める"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    # 文字数を二分探索で決める
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def summarize_turns(summary: str, turns: list, is_cancelled=None) -> str:
+    """
+    これまでの要約と古いやり取りから、新しい要約をLLMで作成
+    （バックグラウンドの優先度で受付制御を通し、生徒の質問への回答を待たせない）
+
+    Args:
+        summary: これまでの要約（無い場合は空文字）
+        turns: 要約に畳み込む (質問, 回答) のリスト
+        is_cancelled: セッションが終了した場合にTrueを返す関数（順番待ちの間に確認する）
+
+    Returns:
+        新しい要約
+    """
+    import rag_pipeline
+    from admission import PRIORITY_BACKGROUND
+    from cost_optimizer import cost_optimizer
+    from usage_callbacks import TokenUsageCallbackHandler
+
+    if not cost_optimizer.check_daily_limit():
+        raise RuntimeError("本日のAPI使用制限に達しました。")
+
+    conversation = "\n".join(f"質問: {question}\n回答: {answer}" for question, answer in turns)
+    with rag_pipeline.admit(priority=PRIORITY_BACKGROUND, is_cancelled=is_cancelled) as slot:
+        llm = llm_client.create_chat_llm(
+            model=ct.MODEL,
+            temperature=0,
+            max_tokens=ct.HISTORY_SUMMARY_TOKEN_BUDGET,
+            timeout=slot.remaining()
+        )
+        response = llm.invoke(
+            [
+                SystemMessage(content=ct.SYSTEM_PROMPT_SUMMARIZE_HISTORY),
+                HumanMessage(content=ct.USER_PROMPT_SUMMARIZE_HISTORY.format(
+                    summary=summary or "（なし）",
+                    conversation=conversation
+                ))
+            ],
+            config={"callbacks": [TokenUsageCallbackHandler(cost_optimizer)]}
+        )
+    return response.content.strip()
+
+
+def _fallback_summary(summary: str, turns: list) -> str:
+    """LLMで要約できない場合は、これまでの質問を並べたものを要約とする"""
+    questions = "\n".join(f"- {question}" for question, _ in turns)
+    return f"{summary}\n{questions}".strip() if summary else f"これまでの質問:\n{questions}"
+
+
+class ConversationMemory:
+    """
+    トークン数の上限付きの会話履歴
+    直近のやり取りはそのまま、上限を超えた古いやり取りは要約（1つのシステムメッセージ）としてプロンプトに含める
+    """
+
+    def __init__(self, recent_token_budget: int, summary_token_budget: int, min_recent_turns: int = 1,
+                 summarize=summarize_turns, is_cancelled=None):
+        self.recent_token_budget = recent_token_budget
+        self.summary_token_budget = summary_token_budget
+        self.min_recent_turns = min_recent_turns
+        self.summarize = summarize
+        # セッションが終了した場合にTrueを返す関数（終了したセッションの要約は作らない）
+        self.is_cancelled = is_cancelled
+        self._lock = threading.Lock()
+        self._turns = []  # (質問, 回答, トークン数)
+        self._recent_tokens = 0
+        self._pending = []  # 要約への畳み込み待ちのやり取り
+        self._summary = ""
+        self._summary_tokens = 0
+        self._future = None
+        self._generation = 0  # clear()のたびに増やし、消去前に始めた要約の結果を捨てる
+
+    def add_turn(self, question: str, answer: str):
+        """1回のやり取りを追加し、上限を超えた古いやり取りの要約をバックグラウンドで開始"""
+        tokens = count_tokens(question) + count_tokens(answer)
+        with self._lock:
+            self._turns.append((question, answer, tokens))
+            self._recent_tokens += tokens
+            while self._recent_tokens > self.recent_token_budget and len(self._turns) > self.min_recent_turns:
+                oldest = self._turns.pop(0)
+                self._recent_tokens -= oldest[2]
+                self._pending.append(oldest)
+            if self._recent_tokens > self.recent_token_budget:
+                self._truncate_recent_turns()
+            if self._pending and self._future is None:
+                self._future = _summary_executor.submit(self._fold_pending)
+
+    def _truncate_recent_turns(self):
+        """
+        要約せずに残す直近のやり取り（min_recent_turns）だけで上限を超える場合に、
+        古い順に回答（足りなければ質問も）を切り詰めて上限に収める（ロックを取得した状態で呼び出す）
+        """
+        for i, (question, answer, tokens) in enumerate(self._turns):
+            excess = self._recent_tokens - self.recent_token_budget
+            if excess <= 0:
+                break
+            answer_tokens = count_tokens(answer)
+            answer = truncate_to_tokens(answer, max(0, answer_tokens - excess))
+            excess -= answer_tokens - count_tokens(answer)
+            if excess > 0:
+                question = truncate_to_tokens(question, max(0, count_tokens(question) - excess))
+            truncated_tokens = count_tokens(question) + count_tokens(answer)
+            self._turns[i] = (question, answer, truncated_tokens)
+            self._recent_tokens += truncated_tokens - tokens
+
+    def _fold_pending(self):
+        """畳み込み待ちのやり取りを要約に反映（要約中に追加されたものも続けて反映）"""
+        while True:
+            with self._lock:
+                turns = [(question, answer) for question, answer, _ in self._pending]
+                summary = self._summary
+                generation = self._generation
+                if not turns or (self.is_cancelled and self.is_cancelled()):
+                    self._future = None
+                    return
+
+            try:
+                new_summary = self.summarize(summary, turns, is_cancelled=self.is_cancelled)
+            except Exception:
+                new_summary = _fallback_summary(summary, turns)
+            new_summary = truncate_to_tokens(new_summary, self.summary_token_budget)
+
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                self._summary = new_summary
+                self._summary_tokens = count_tokens(new_summary)
+                del self._pending[:len(turns)]
+
+    def get_messages(self) -> list:
+        """プロンプトに含める会話履歴（要約のシステムメッセージ＋直近のやり取り）"""
+        with self._lock:
+            messages = []
+            if self._summary:
+                messages.append(SystemMessage(content=ct.HISTORY_SUMMARY_PREFIX + self._summary))
+            for question, answer, _ in self._turns:
+                messages.extend([HumanMessage(content=question), AIMessage(content=answer)])
+            return messages
+
+    def get_token_counts(self) -> dict:
+        """プロンプトに含める会話履歴のトークン数（要約待ちのやり取りはプロンプトに含めない）"""
+        with self._lock:
+            return {
+                "summary_tokens": self._summary_tokens,
+                "recent_tokens": self._recent_tokens,
+                "history_tokens": self._summary_tokens + self._recent_tokens,
+                "recent_turns": len(self._turns),
+                "pending_turns": len(self._pending),
+            }
+
+    def wait_for_summary(self, timeout: float = None):
+        """実行中の要約の完了を待つ（終了処理・計測用）"""
+        future = self._future
+        if future is not None:
+            future.result(timeout=timeout)
+
+    def clear(self):
+        """会話履歴を消去（実行中の要約の結果は、消去後の履歴には反映しない）"""
+        with self._lock:
+            self._turns.clear()
+            self._recent_tokens = 0
+            self._pending.clear()
+            self._summary = ""
+            self._summary_tokens = 0
+            self._generation += 1
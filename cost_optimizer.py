@@ -3,86 +3,135 @@
 RAGシステムのAPI使用量とコストを削減するための機能を提供
 """
 
+import logging
 import os
-import json
 import pickle
 import hashlib
-from datetime import datetime, timedelta
+import shutil
+import time
+import uuid
+from datetime import datetime
 from pathlib import Path
-import streamlit as st
 import constants as ct
+from response_cache import SQLiteResponseCache, TieredResponseCache
+from usage_ledger import UsageLedger, EMPTY_DAY, estimate_cost
+from query_canonicalizer import canonicalize_query
+from chunk_preprocessor import preprocess_chunks
+from file_lock import FileLock
+
+# 画面の有無（Streamlit・APIサーバー）によらず使うため、失敗はログに記録し、画面への表示は呼び出し元で行う
+logger = logging.getLogger(ct.LOGGER_NAME)
+
+
+def extract_token_usage(message) -> dict:
+    """LLMレスポンスからトークン使用量（プロンプトキャッシュ分を含む）を取り出す"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    input_details = usage.get("input_token_details") or {}
+    return {
+        "prompt_tokens": usage.get("input_tokens", 0) or 0,
+        "completion_tokens": usage.get("output_tokens", 0) or 0,
+        "cached_tokens": input_details.get("cache_read", 0) or 0,
+    }
+
+
+def extract_model_name(message, default: str = None) -> str:
+    """LLMレスポンスから実際に応答したモデル名を取り出す"""
+    metadata = getattr(message, "response_metadata", None) or {}
+    return metadata.get("model_name") or default
 
 
 class CostOptimizer:
     """コスト最適化クラス"""
     
     def __init__(self):
-        self.usage_file = "./data/api_usage.json"
+        # API使用量の台帳（SQLite）を用意し、旧形式のapi_usage.jsonがあれば取り込む
+        self.usage_ledger = UsageLedger(ct.USAGE_DB_PATH, retention_days=ct.USAGE_EVENT_RETENTION_DAYS)
+        self.usage_ledger.migrate_json_file("./data/api_usage.json")
+        self.usage_ledger.prune()
         self.cache_dir = Path("./data/cache/")
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         
+        # レスポンスキャッシュ（L1: プロセス内メモリ、L2: SQLite単一ファイル）を用意し、旧形式のJSONファイルがあれば取り込む
+        self.response_cache = TieredResponseCache(
+            SQLiteResponseCache(
+                ct.RESPONSE_CACHE_DB_PATH,
+                max_entries=ct.CACHE_MAX_ENTRIES,
+                max_bytes=ct.CACHE_MAX_BYTES,
+                eviction_policy=ct.CACHE_EVICTION_POLICY,
+                refresh_ttl_seconds=ct.CACHE_EXPIRY_HOURS * 3600 if ct.CACHE_REFRESH_ON_ACCESS else None,
+                stats_flush_interval_seconds=ct.L1_ACCESS_FLUSH_SECONDS
+            ),
+            l1_max_entries=ct.L1_CACHE_MAX_ENTRIES,
+            l1_ttl_seconds=ct.L1_CACHE_TTL_SECONDS,
+            flush_interval_seconds=ct.L1_ACCESS_FLUSH_SECONDS
+        )
+        self.response_cache.migrate_json_files(self.cache_dir, self.get_cache_key)
+        
     def get_cache_key(self, text: str) -> str:
-        """テキストからキャッシュキーを生成"""
-        return hashlib.md5(text.encode()).hexdigest()
-    
-    def load_usage_data(self) -> dict:
-        """API使用量データを読み込み"""
-        try:
-            if os.path.exists(self.usage_file):
-                with open(self.usage_file, 'r') as f:
-                    return json.load(f)
-        except Exception:
-            pass
-        return {"daily_calls": {}, "total_calls": 0}
+        """テキストからキャッシュキーを生成（表記ゆれを正規化してからハッシュ化）"""
+        return hashlib.md5(canonicalize_query(text).encode()).hexdigest()
     
-    def save_usage_data(self, data: dict):
-        """API使用量データを保存"""
+    def get_daily_limit_message(self) -> str:
+        """1日あたりのAPI呼び出し回数・トークン数・推定コストの制限に達していれば、その内容（達していない場合はNone）"""
         try:
-            os.makedirs(os.path.dirname(self.usage_file), exist_ok=True)
-            with open(self.usage_file, 'w') as f:
-                json.dump(data, f)
+            today = self.usage_ledger.get_day()
         except Exception as e:
-            st.warning(f"使用量データの保存に失敗: {e}")
-    
-    def check_daily_limit(self) -> bool:
-        """1日あたりのAPI呼び出し制限をチェック"""
-        data = self.load_usage_data()
-        today = datetime.now().strftime("%Y-%m-%d")
-        daily_calls = data["daily_calls"].get(today, 0)
+            logger.warning(f"使用量データの読み込みに失敗: {e}")
+            return None
         
-        if daily_calls >= ct.MAX_DAILY_API_CALLS:
-            st.error(f"本日のAPI使用制限（{ct.MAX_DAILY_API_CALLS}回）に達しました。明日お試しください。")
-            return False
+        if ct.MAX_DAILY_API_CALLS is not None and today["calls"] >= ct.MAX_DAILY_API_CALLS:
+            return f"本日のAPI使用制限（{ct.MAX_DAILY_API_CALLS}回）に達しました。明日お試しください。"
         
-        return True
-    
-    def increment_usage(self):
-        """API使用量をインクリメント"""
-        data = self.load_usage_data()
-        today = datetime.now().strftime("%Y-%m-%d")
+        today_tokens = today["prompt_tokens"] + today["completion_tokens"]
+        if ct.MAX_DAILY_TOKENS is not None and today_tokens >= ct.MAX_DAILY_TOKENS:
+            return f"本日のトークン使用制限（{ct.MAX_DAILY_TOKENS:,}トークン）に達しました。明日お試しください。"
         
-        data["daily_calls"][today] = data["daily_calls"].get(today, 0) + 1
-        data["total_calls"] = data.get("total_calls", 0) + 1
+        if ct.MAX_DAILY_COST_USD is not None and today["cost"] >= ct.MAX_DAILY_COST_USD:
+            return f"本日の推定コスト上限（${ct.MAX_DAILY_COST_USD:.2f}）に達しました。明日お試しください。"
         
-        # 古いデータを削除（7日以上前）
-        cutoff_date = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-        data["daily_calls"] = {
-            date: count for date, count in data["daily_calls"].items()
-            if date >= cutoff_date
-        }
+        return None
+    
+    def check_daily_limit(self) -> bool:
+        """1日あたりのAPI呼び出し回数・トークン数・推定コストの制限をチェック（制限内ならTrue）"""
+        return self.get_daily_limit_message() is None
+    
+    def record_usage(self, usage: dict, model: str = None, latency_ms: float = None):
+        """1回のAPI呼び出しの使用量（トークン数・モデル・レイテンシ・推定コスト）を記録"""
+        model = model or ct.OPENAI_CHAT_MODEL
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        cached_tokens = usage.get("cached_tokens", 0)
         
-        self.save_usage_data(data)
+        try:
+            self.usage_ledger.record(
+                model=model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cached_tokens=cached_tokens,
+                latency_ms=latency_ms,
+                cost=estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens, ct.MODEL_PRICING)
+            )
+        except Exception as e:
+            logger.warning(f"使用量データの保存に失敗: {e}")
     
     def get_usage_stats(self) -> dict:
         """使用統計を取得"""
-        data = self.load_usage_data()
-        today = datetime.now().strftime("%Y-%m-%d")
-        today_calls = data["daily_calls"].get(today, 0)
+        try:
+            today = self.usage_ledger.get_day()
+            total_calls = self.usage_ledger.get_total_calls()
+        except Exception:
+            today = dict(EMPTY_DAY)
+            total_calls = 0
         
         return {
-            "today_calls": today_calls,
-            "remaining_calls": max(0, ct.MAX_DAILY_API_CALLS - today_calls),
-            "total_calls": data.get("total_calls", 0)
+            "today_calls": today["calls"],
+            "remaining_calls": max(0, ct.MAX_DAILY_API_CALLS - today["calls"]) if ct.MAX_DAILY_API_CALLS is not None else None,
+            "total_calls": total_calls,
+            "today_prompt_tokens": today["prompt_tokens"],
+            "today_completion_tokens": today["completion_tokens"],
+            "today_cached_tokens": today["cached_tokens"],
+            "today_cost": today["cost"],
+            "today_avg_latency_ms": today["avg_latency_ms"]
         }
     
     def cache_response(self, query: str, response: str):
@@ -91,20 +140,11 @@ class CostOptimizer:
             return
             
         cache_key = self.get_cache_key(query)
-        cache_file = self.cache_dir / f"{cache_key}.json"
-        
-        cache_data = {
-            "query": query,
-            "response": response,
-            "timestamp": datetime.now().isoformat(),
-            "expires": (datetime.now() + timedelta(hours=ct.CACHE_EXPIRY_HOURS)).isoformat()
-        }
         
         try:
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False)
+            self.response_cache.set(cache_key, query, response, ct.CACHE_EXPIRY_HOURS * 3600)
         except Exception as e:
-            st.warning(f"レスポンスキャッシュの保存に失敗: {e}")
+            logger.warning(f"レスポンスキャッシュの保存に失敗: {e}")
     
     def get_cached_response(self, query: str) -> str:
         """キャッシュされたレスポンスを取得"""
@@ -112,104 +152,193 @@ class CostOptimizer:
             return None
             
         cache_key = self.get_cache_key(query)
-        cache_file = self.cache_dir / f"{cache_key}.json"
         
         try:
-            if cache_file.exists():
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                
-                # 有効期限をチェック
-                expires = datetime.fromisoformat(cache_data["expires"])
-                if datetime.now() < expires:
-                    return cache_data["response"]
-                else:
-                    # 期限切れのキャッシュを削除
-                    cache_file.unlink()
+            return self.response_cache.get(cache_key)
         except Exception:
-            pass
-        
-        return None
+            return None
     
-    def clean_old_cache(self):
-        """古いキャッシュファイルを削除"""
+    def get_cache_stats(self) -> dict:
+        """レスポンスキャッシュの件数・容量・ヒット率・追い出し数（全ワーカーの合計）と、このワーカーのL1の統計を取得"""
         try:
-            for cache_file in self.cache_dir.glob("*.json"):
-                try:
-                    with open(cache_file, 'r', encoding='utf-8') as f:
-                        cache_data = json.load(f)
-                    
-                    expires = datetime.fromisoformat(cache_data["expires"])
-                    if datetime.now() >= expires:
-                        cache_file.unlink()
-                except Exception:
-                    # 破損したキャッシュファイルを削除
-                    cache_file.unlink()
-        except Exception as e:
-            st.warning(f"キャッシュクリーンアップに失敗: {e}")
+            return self.response_cache.get_stats()
+        except Exception:
+            return {"entries": 0, "bytes": 0, "hits": 0, "misses": 0, "hit_ratio": 0.0,
+                    "evictions": 0, "expirations": 0, "l1_entries": 0, "l1_hits": 0, "l1_misses": 0, "l1_hit_ratio": 0.0}
+    
+    def clean_old_cache(self) -> int:
+        """期限切れのキャッシュを一括削除（失敗した場合は例外を送出）"""
+        return self.response_cache.evict_expired()
 
 
 class VectorStoreManager:
-    """ベクターストア永続化マネージャー"""
+    """
+    ベクターストア永続化マネージャー
+    インデックスとチャンクはバージョンごとのディレクトリ（versions/<バージョン>/）に書き込み、
+    完成後にポインタファイル（CURRENT）を置き換えて公開する（読み込み中のプロセスが書きかけのファイルを読まない）
+    """
     
-    def __init__(self):
-        self.vector_store_dir = Path(ct.VECTOR_STORE_PATH)
-        self.vector_store_dir.mkdir(parents=True, exist_ok=True)
-        
-        self.index_path = self.vector_store_dir / ct.VECTOR_INDEX_FILE
-        self.chunks_path = self.vector_store_dir / ct.CHUNKS_CACHE_FILE
+    def __init__(self, vector_store_dir=ct.VECTOR_STORE_PATH):
+        self.vector_store_dir = Path(vector_store_dir)
+        self.versions_dir = self.vector_store_dir / "versions"
+        self.versions_dir.mkdir(parents=True, exist_ok=True)
         
+        self.current_path = self.vector_store_dir / ct.VECTOR_STORE_CURRENT_FILE
+        # インデックスの作成・書き込みは全ワーカーで1プロセスずつ
+        self.build_lock = FileLock(self.vector_store_dir / ct.INDEX_BUILD_LOCK_FILE)
+        self._adopt_flat_layout()
+    
+    def _adopt_flat_layout(self):
+        """バージョン管理前の形式（ディレクトリ直下のファイル）のインデックスを1つのバージョンとして取り込む"""
+        flat_files = [self.vector_store_dir / f"{ct.VECTOR_INDEX_FILE}.faiss",
+                      self.vector_store_dir / f"{ct.VECTOR_INDEX_FILE}.pkl",
+                      self.vector_store_dir / ct.CHUNKS_CACHE_FILE]
+        if self.current_path.exists() or not all(path.exists() for path in flat_files):
+            return
+        # 別のワーカーが取り込み・作成中の場合は任せる
+        if not self.build_lock.acquire(blocking=False):
+            return
+        try:
+            version = self._new_version_id(datetime.fromtimestamp(flat_files[0].stat().st_mtime))
+            staging = self.versions_dir / f".tmp-{version}"
+            staging.mkdir()
+            for path in flat_files:
+                os.replace(path, staging / path.name)
+            os.replace(staging, self.versions_dir / version)
+            self._publish(version)
+        except OSError:
+            # 別のプロセスが先に取り込んだ場合など（取り込めなければ次回作成し直す）
+            pass
+        finally:
+            self.build_lock.release()
+    
+    @staticmethod
+    def _new_version_id(created_at: datetime = None) -> str:
+        """作成日時＋ランダムな接尾辞のバージョン名（名前順が作成順になる）"""
+        return f"{(created_at or datetime.now()).strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    
+    def _version_dir(self, version: str) -> Path:
+        return self.versions_dir / version
+    
+    def _publish(self, version: str):
+        """ポインタファイルを一時ファイルへの書き込み＋置き換えで更新（読み込み側は常に完全な内容を読む）"""
+        temp_path = self.current_path.with_name(f".{ct.VECTOR_STORE_CURRENT_FILE}.{uuid.uuid4().hex}")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.current_path)
+    
     def save_vector_store(self, vectorstore, chunks):
-        """ベクターストアとチャンクを永続化"""
+        """
+        ベクターストアとチャンクを新しいバージョンとして永続化し、書き込み完了後に公開
+        
+        Returns:
+            公開したバージョン（失敗した場合はNone）
+        """
+        version = self._new_version_id()
+        staging = self.versions_dir / f".tmp-{version}"
         try:
+            staging.mkdir()
+            
             # FAISSインデックスを保存
-            vectorstore.save_local(str(self.vector_store_dir), ct.VECTOR_INDEX_FILE)
+            vectorstore.save_local(str(staging), ct.VECTOR_INDEX_FILE)
             
             # チャンクデータを保存
-            with open(self.chunks_path, 'wb') as f:
+            with open(staging / ct.CHUNKS_CACHE_FILE, 'wb') as f:
                 pickle.dump(chunks, f)
-                
-            st.success("✅ ベクターストアを永続化しました")
-            return True
+                f.flush()
+                os.fsync(f.fileno())
+            
+            # 完成したディレクトリを所定の名前に移し、ポインタを切り替える
+            os.replace(staging, self._version_dir(version))
+            self._publish(version)
+            self.collect_garbage()
+            return version
             
         except Exception as e:
-            st.error(f"ベクターストア保存エラー: {e}")
-            return False
+            shutil.rmtree(staging, ignore_errors=True)
+            logger.error(f"ベクターストア保存エラー: {e}")
+            return None
     
     def load_vector_store(self, embeddings):
-        """永続化されたベクターストアとチャンクを読み込み"""
+        """
+        公開中のバージョンのベクターストアとチャンクを読み込み
+        
+        Returns:
+            (vectorstore, chunks, バージョン) のタプル（無い場合はすべてNone）
+        """
+        version = self.get_index_version()
+        if version is None:
+            return None, None, None
+        
+        version_dir = self._version_dir(version)
+        # 読み込み中はリースファイルを置き、古いバージョンの削除から保護する
+        lease_path = version_dir / f".lease-{uuid.uuid4().hex}"
         try:
             from langchain_community.vectorstores import FAISS
             
-            # FAISSインデックスが存在するかチェック
-            if not (self.vector_store_dir / f"{ct.VECTOR_INDEX_FILE}.faiss").exists():
-                return None, None
+            lease_path.touch()
             
             # ベクターストアを読み込み
             vectorstore = FAISS.load_local(
-                str(self.vector_store_dir), 
+                str(version_dir), 
                 embeddings,
                 ct.VECTOR_INDEX_FILE,
                 allow_dangerous_deserialization=True
             )
             
             # チャンクデータを読み込み
-            chunks = None
-            if self.chunks_path.exists():
-                with open(self.chunks_path, 'rb') as f:
-                    chunks = pickle.load(f)
+            with open(version_dir / ct.CHUNKS_CACHE_FILE, 'rb') as f:
+                chunks = pickle.load(f)
             
-            return vectorstore, chunks
+            return vectorstore, chunks, version
             
         except Exception as e:
-            st.warning(f"永続化データの読み込みに失敗: {e}")
-            return None, None
+            logger.warning(f"永続化データの読み込みに失敗: {e}")
+            return None, None, None
+        finally:
+            lease_path.unlink(missing_ok=True)
+    
+    def refresh_preprocessed_chunks(self, vectorstore, chunks, version: str):
+        """
+        保存時から前処理のルール（PREPROCESS_VERSION）が上がったチャンクの整形テキスト・重要ポイントを再計算し、
+        新しいバージョンとして永続化し直す
+        新しいバージョンの公開はFAQ事前回答の作り直しと全ワーカーの再読み込みを伴うため、
+        保存済みのメタデータが最新の場合、別のワーカーが既に保存し直した場合は公開しない
+        
+        Args:
+            version: 読み込んだインデックスのバージョン
+        
+        Returns:
+            永続化し直したバージョン（公開しなかった・保存に失敗した場合はNone）
+        """
+        # 検索結果はFAISSのドキュメントストアから返るため、チャンクの一覧と両方を更新する
+        stored_docs = [vectorstore.docstore.search(doc_id) for doc_id in vectorstore.index_to_docstore_id.values()]
+        refreshed_chunks = preprocess_chunks(chunks)
+        refreshed_docs = preprocess_chunks(doc for doc in stored_docs if hasattr(doc, "metadata"))
+        if refreshed_chunks + refreshed_docs == 0:
+            return None
+        # 保存は1ワーカーだけが行う（他のワーカーはメモリ上で再計算したものを使い、保存されたバージョンに切り替わる）
+        if not self.build_lock.acquire(blocking=False):
+            return None
+        try:
+            # ロックを待たずに済んだ場合も、読み込んだ後に別のワーカーが保存し直していれば重ねて公開しない
+            if self.get_index_version() != version:
+                return None
+            return self.save_vector_store(vectorstore, chunks)
+        finally:
+            self.build_lock.release()
     
     def is_cache_valid(self) -> bool:
-        """キャッシュが有効かどうかチェック"""
+        """公開中のバージョンが有効期限内かどうかチェック"""
         try:
+            version = self.get_index_version()
+            if version is None:
+                return False
+            
             # FAISSファイルの存在確認
-            faiss_file = self.vector_store_dir / f"{ct.VECTOR_INDEX_FILE}.faiss"
+            faiss_file = self._version_dir(version) / f"{ct.VECTOR_INDEX_FILE}.faiss"
             if not faiss_file.exists():
                 return False
             
@@ -222,18 +351,54 @@ class VectorStoreManager:
         except Exception:
             return False
     
-    def clear_cache(self):
-        """キャッシュをクリア"""
+    def get_index_version(self) -> str:
+        """公開中のインデックスのバージョン（無い場合はNone）"""
         try:
-            # FAISSファイルを削除
-            for file_pattern in [f"{ct.VECTOR_INDEX_FILE}.*", ct.CHUNKS_CACHE_FILE]:
-                for file_path in self.vector_store_dir.glob(file_pattern):
-                    file_path.unlink()
-            
-            st.success("キャッシュをクリアしました")
-            
-        except Exception as e:
-            st.error(f"キャッシュクリアに失敗: {e}")
+            version = self.current_path.read_text(encoding="utf-8").strip()
+        except OSError:
+            return None
+        return version or None
+    
+    def collect_garbage(self) -> int:
+        """
+        参照されなくなった古いバージョンと、作成途中で中断した一時ディレクトリを削除
+        公開中のバージョン、読み込み中（リースあり）のバージョン、
+        切り替えから猶予時間（INDEX_VERSION_GC_GRACE_SECONDS）が経っていないバージョンは残す
+        
+        Returns:
+            削除したディレクトリ数
+        """
+        current = self.get_index_version()
+        now = time.time()
+        grace = ct.INDEX_VERSION_GC_GRACE_SECONDS
+        try:
+            # ポインタの切り替え直後は、切り替え前に古いバージョンを読み始めたプロセスがあり得る
+            switched_recently = now - self.current_path.stat().st_mtime < grace
+        except OSError:
+            switched_recently = False
+        
+        removed = 0
+        for path in self.versions_dir.iterdir():
+            try:
+                if not path.is_dir() or path.name == current:
+                    continue
+                if path.name.startswith(".tmp-"):
+                    # 作成中のディレクトリは、猶予時間を過ぎたもの（中断したもの）だけ削除
+                    if now - path.stat().st_mtime < grace:
+                        continue
+                elif switched_recently or any(now - lease.stat().st_mtime < grace
+                                              for lease in path.glob(".lease-*")):
+                    continue
+                shutil.rmtree(path)
+                removed += 1
+            except OSError:
+                continue
+        return removed
+    
+    def clear_cache(self):
+        """キャッシュをクリア（公開を取り消し、読み込み中でないバージョンを削除。失敗した場合は例外を送出）"""
+        self.current_path.unlink(missing_ok=True)
+        self.collect_garbage()
 
 
 # グローバルインスタンス
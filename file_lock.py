@@ -0,0 +1,95 @@
+"""
+プロセス間のファイルロックモジュール
+複数のワーカープロセスが同じデータディレクトリを共有する場合に、インデックスの作成や
+JSONファイルの読み書きを1プロセスずつに制限する機能を提供（POSIXはfcntl、Windowsはmsvcrtを使用）
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+    FCNTL_SUPPORT = True
+except ImportError:
+    import msvcrt
+    FCNTL_SUPPORT = False
+
+
+class FileLock:
+    """
+    ロックファイルによる排他ロック（同じプロセス内の別スレッドとも排他になる）
+    with文で使う場合は取得できるまで待つ
+    """
+
+    def __init__(self, path, poll_interval: float = 0.1):
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def _try_lock(self, fd) -> bool:
+        try:
+            if FCNTL_SUPPORT:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        """
+        ロックを取得
+
+        Args:
+            blocking: Falseの場合、他のプロセスが保持していればすぐにFalseを返す
+            timeout: 待つ最大秒数（Noneの場合は取得できるまで待つ）
+
+        Returns:
+            取得できた場合はTrue
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._thread_lock.acquire(blocking, -1 if timeout is None else timeout):
+            return False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        while not self._try_lock(fd):
+            if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                os.close(fd)
+                self._thread_lock.release()
+                return False
+            time.sleep(self.poll_interval)
+        self._fd = fd
+        return True
+
+    def release(self):
+        """ロックを解放（ロックファイルは他のプロセスが待っている可能性があるため削除しない）"""
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if FCNTL_SUPPORT:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+            self._thread_lock.release()
+
+    def is_locked(self) -> bool:
+        """他のプロセス・スレッドがロックを保持しているか（確認のために一瞬だけ取得を試みる）"""
+        if not self.acquire(blocking=False):
+            return True
+        self.release()
+        return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
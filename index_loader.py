@@ -0,0 +1,335 @@
+"""
+インデックスの事前読み込みモジュール
+サーバープロセスで1度だけ、バックグラウンドのスレッドで永続化済みのFAISSインデックスを読み込み（無い場合は作成し）、
+読み込み状態（loading / ready / failed）と所要時間を全セッションで共有する機能を提供
+（各セッションは読み込み完了後のインデックスを自動的に利用する。ボタン操作で待たせない）
+新しいバージョンが公開された場合も、読み込みが完了するまでは前のインデックスで回答を続ける
+"""
+
+import os
+import threading
+import time
+
+import constants as ct
+import llm_client
+from chunk_preprocessor import preprocess_chunks
+from metrics import metrics_registry
+
+
+# 読み込み状態
+STATE_IDLE = "idle"
+STATE_LOADING = "loading"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+
+
+def count_by_source(chunks) -> dict:
+    """ファイル別のチャンク数"""
+    file_distribution = {}
+    for chunk in chunks:
+        source = chunk.metadata.get('source_file', 'unknown')
+        file_distribution[source] = file_distribution.get(source, 0) + 1
+    return file_distribution
+
+
+def load_pdf_documents(pdf_paths, report) -> list:
+    """
+    PDFを読み込み、ページごとのドキュメントにファイル名（source_file）を付けて返す
+
+    Args:
+        pdf_paths: PDFファイルのパスのリスト
+        report: 進捗メッセージを受け取る関数（読み込めないファイルは知らせて飛ばす）
+
+    Returns:
+        全ファイルのページのドキュメントのリスト
+    """
+    from langchain_community.document_loaders import PyMuPDFLoader
+
+    all_documents = []
+    for i, pdf_path in enumerate(pdf_paths, 1):
+        report(f"📚 PDFファイル {i}/{len(pdf_paths)} を読み込み中: {os.path.basename(pdf_path)}")
+        try:
+            with metrics_registry.timer("pdf_load"):
+                documents = PyMuPDFLoader(pdf_path).load()
+        except Exception as e:
+            report(f"❌ {os.path.basename(pdf_path)}の読み込みエラー: {e}")
+            continue
+
+        # メタデータにファイル名を追加
+        for doc in documents:
+            doc.metadata['source_file'] = os.path.basename(pdf_path)
+        all_documents.extend(documents)
+        metrics_registry.increment("pdf_pages_total", len(documents))
+    return all_documents
+
+
+def split_documents(documents, chunk_size: int = ct.CHUNK_SIZE, chunk_overlap: int = ct.CHUNK_OVERLAP) -> list:
+    """ページのドキュメントを改行区切りでチャンクに分割（チャンク数の上限・前処理は呼び出し元で行う）"""
+    from langchain.text_splitter import CharacterTextSplitter
+
+    text_splitter = CharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separator="\n"
+    )
+    with metrics_registry.timer("split"):
+        return text_splitter.split_documents(documents)
+
+
+def build_index(embeddings, report):
+    """
+    PDFを読み込んでチャンクに分割し、FAISSインデックスを作成して永続化（埋め込みAPIを使用）
+
+    Args:
+        embeddings: 埋め込みモデル
+        report: 進捗メッセージを受け取る関数
+
+    Returns:
+        (vectorstore, chunks, 公開したバージョン) のタプル
+    """
+    from langchain_community.vectorstores import FAISS
+    from cost_optimizer import vector_manager
+
+    # 存在するファイルのみを選択
+    existing_files = [pdf_path for pdf_path in ct.PDF_FILES if os.path.exists(pdf_path)]
+    if not existing_files:
+        raise ValueError("利用可能なPDFファイルがありません。")
+
+    # 全PDFファイルの読み込み
+    all_documents = load_pdf_documents(existing_files, report)
+    if not all_documents:
+        raise ValueError("PDFファイルの読み込みに失敗しました。")
+
+    # テキスト分割
+    report(f"📝 {len(all_documents)}ページのテキストを分割中...")
+    split_docs = split_documents(all_documents)
+
+    # チャンク数制限
+    chunks = split_docs[:min(ct.MAX_CHUNKS, len(split_docs))]
+
+    # 整形テキスト・重要ポイントを事前計算（検索時はメタデータを参照するだけにする）
+    with metrics_registry.timer("preprocess"):
+        preprocess_chunks(chunks)
+    metrics_registry.increment("chunks_indexed_total", len(chunks))
+
+    # 埋め込みベクター作成（API使用）
+    report(f"🤖 {len(chunks)}チャンクの埋め込みベクターを作成中...（OpenAI API使用）")
+    with metrics_registry.timer("embedding"):
+        vectorstore = FAISS.from_documents(chunks, embeddings)
+
+    # ベクターストアを永続化（次回からAPI不要）
+    report("💾 ベクターストアを永続化中...")
+    with metrics_registry.timer("index_save"):
+        version = vector_manager.save_vector_store(vectorstore, chunks)
+
+    return vectorstore, chunks, version
+
+
+def load_index(report):
+    """
+    永続化されたインデックスを読み込む（無い・期限切れの場合は作成）
+
+    Args:
+        report: 進捗メッセージを受け取る関数
+
+    Returns:
+        (vectorstore, chunks, 読み込み元（"cache" / "built"）, バージョン) のタプル
+    """
+    from cost_optimizer import vector_manager
+
+    # OpenAI APIキー（またはスタブサーバーの接続先）の確認
+    if not llm_client.is_openai_configured():
+        raise ValueError("OpenAI APIキーが設定されていません。")
+
+    embeddings = llm_client.create_embeddings(cache_queries=True)
+
+    loaded = load_published_index(embeddings, report)
+    if loaded is not None:
+        return loaded
+
+    # 作成は全ワーカーで1プロセスだけが行い、他のワーカーは完了を待って同じものを読み込む
+    # （待つ間も、各セッションは読み込み済みの前のインデックスで回答を続ける）
+    if not vector_manager.build_lock.acquire(blocking=False):
+        report("⏳ 別のワーカーがベクターストアを作成中です。完了を待っています...")
+        if not vector_manager.build_lock.acquire(timeout=ct.INDEX_BUILD_LOCK_TIMEOUT_SECONDS):
+            raise TimeoutError("別のワーカーによるベクターストアの作成が時間内に終わりませんでした。")
+    try:
+        # 待っている間に別のワーカーが作成した場合はそれを読み込む
+        loaded = load_published_index(embeddings, report)
+        if loaded is not None:
+            return loaded
+
+        report("🆕 新しいベクターストアを作成中...（API使用）")
+        vectorstore, chunks, version = build_index(embeddings, report)
+        return vectorstore, chunks, "built", version
+    finally:
+        vector_manager.build_lock.release()
+
+
+def load_published_index(embeddings, report):
+    """公開中の有効なインデックスを読み込む（無い・期限切れ・読み込み失敗の場合はNone）"""
+    from cost_optimizer import vector_manager
+
+    if not vector_manager.is_cache_valid():
+        return None
+
+    report("🔄 永続化されたベクターストアを読み込み中...")
+    with metrics_registry.timer("index_load"):
+        vectorstore, chunks, version = vector_manager.load_vector_store(embeddings)
+    if vectorstore is None or chunks is None:
+        return None
+
+    # 前処理のルールが変わっていれば整形テキスト・重要ポイントを再計算（API使用なし）
+    version = vector_manager.refresh_preprocessed_chunks(vectorstore, chunks, version) or version
+    return vectorstore, chunks, "cache", version
+
+
+def get_published_version() -> str:
+    """永続化ディレクトリで公開中のインデックスのバージョン"""
+    from cost_optimizer import vector_manager
+    return vector_manager.get_index_version()
+
+
+def warm_answer_bank(index: dict):
+    """
+    読み込んだインデックスでFAQの事前回答をバックグラウンドで作成（作成済み・同じバージョンのものは飛ばす）
+    インデックスは期限切れで定期的に作り直されるため、読み込みのたびに新しいバージョンの回答を用意する
+    """
+    if not ct.ENABLE_ANSWER_BANK or not ct.ANSWER_BANK_AUTO_WARM_UP:
+        return
+    from functools import partial
+    import rag_pipeline
+    from answer_bank import answer_bank
+
+    answer_bank.start_warm_up(partial(rag_pipeline.answer_faq_question, index["vectorstore"]), index["version"])
+
+
+class IndexLoader:
+    """プロセス内で共有するインデックスの読み込み管理"""
+
+    def __init__(self, load=load_index, published_version=get_published_version, on_ready=warm_answer_bank):
+        self.load = load
+        self.published_version = published_version
+        self.on_ready = on_ready  # 読み込み完了時（新しいバージョンの読み込み直しを含む）に呼ぶ関数
+        self._lock = threading.Lock()
+        self._state = STATE_IDLE
+        self._message = None
+        self._error = None
+        self._reload_error = None  # 新しいバージョンの読み込み直しに失敗した理由（前のインデックスで回答を続ける）
+        self._started_at = None
+        self._finished_at = None
+        self._index = None
+        self._generation = 0
+        self._last_version_check = 0.0
+
+    def start(self, force: bool = False) -> bool:
+        """
+        バックグラウンドでの読み込みを開始
+
+        Args:
+            force: Trueの場合、読み込み済み・失敗済みでも読み込み直す（読み込み中は何もしない）
+
+        Returns:
+            読み込みを開始した場合はTrue
+        """
+        with self._lock:
+            if self._state == STATE_LOADING or (self._state != STATE_IDLE and not force):
+                return False
+            self._state = STATE_LOADING
+            self._message = None
+            self._error = None
+            self._started_at = time.time()
+            self._finished_at = None
+        threading.Thread(target=self._run, name="index-preload", daemon=True).start()
+        return True
+
+    def _report(self, message: str):
+        with self._lock:
+            self._message = message
+
+    def _run(self):
+        try:
+            vectorstore, chunks, source, version = self.load(self._report)
+        except Exception as e:
+            with self._lock:
+                if self._index is None:
+                    self._state = STATE_FAILED
+                    self._error = str(e)
+                else:
+                    # 読み込み直しの失敗は前のインデックスで回答を続け、次のバージョン確認で再試行する
+                    self._state = STATE_READY
+                    self._reload_error = str(e)
+                self._message = None
+                self._finished_at = time.time()
+            return
+
+        with self._lock:
+            self._generation += 1
+            self._index = index = {
+                "vectorstore": vectorstore,
+                "chunks": chunks,
+                "file_distribution": count_by_source(chunks),
+                "source": source,
+                "version": version,
+                "generation": self._generation,
+            }
+            self._state = STATE_READY
+            self._message = None
+            self._reload_error = None
+            self._finished_at = time.time()
+
+        if self.on_ready is not None:
+            try:
+                self.on_ready(index)
+            except Exception as e:
+                # 事前回答が作れなくてもインデックスは利用できるため、読み込み状態は変えない
+                self._report(f"⚠️ 読み込み完了後の処理に失敗しました: {e}")
+
+    def check_for_update(self) -> bool:
+        """
+        他のプロセス（またはキャッシュクリア後の再作成）が新しいバージョンを公開していれば、バックグラウンドで読み込み直す
+        確認は INDEX_VERSION_CHECK_SECONDS ごとに1回だけ行い、読み込み直す間も各セッションは前のインデックスで回答を続ける
+        （読み込み直しに失敗した場合も、次の確認で公開中のバージョンが読み込み済みのものと違えば再試行する）
+
+        Returns:
+            読み込み直しを開始した場合はTrue
+        """
+        with self._lock:
+            now = time.time()
+            if (self._state == STATE_LOADING or self._index is None
+                    or now - self._last_version_check < ct.INDEX_VERSION_CHECK_SECONDS):
+                return False
+            self._last_version_check = now
+            loaded_version = self._index["version"]
+
+        published = self.published_version()
+        # 公開が取り消された場合（キャッシュクリア直後）は、作成し直されるまで読み込み済みのものを使い続ける
+        if published is None or published == loaded_version:
+            return False
+        return self.start(force=True)
+
+    def get_index(self) -> dict:
+        """最後に読み込みが完了したインデックス（読み込み直し中も前回のものを返す。未完了の場合はNone）"""
+        with self._lock:
+            return self._index
+
+    def get_status(self) -> dict:
+        """読み込み状態・進捗メッセージ・エラー（読み込み直しの失敗は reload_error）・所要時間（読み込み中は経過時間）"""
+        with self._lock:
+            elapsed = None
+            if self._started_at is not None:
+                elapsed = (self._finished_at or time.time()) - self._started_at
+            return {
+                "state": self._state,
+                "message": self._message,
+                "error": self._error,
+                "reload_error": self._reload_error,
+                "elapsed_seconds": elapsed,
+                "chunks": len(self._index["chunks"]) if self._index else 0,
+                "source": self._index["source"] if self._index else None,
+                "version": self._index["version"] if self._index else None,
+            }
+
+
+# グローバルインスタンス（全セッションで共有）
+index_loader = IndexLoader()
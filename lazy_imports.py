@@ -0,0 +1,75 @@
+"""
+重いライブラリの遅延読み込みモジュール
+LangChain・FAISS・OpenAIクライアントなどの読み込みを初回の利用時まで遅らせ、
+画面の初回表示を待たせないための機能を提供（読み込み可否の判定と、バックグラウンドでの事前読み込み）
+"""
+
+import importlib
+import importlib.util
+import threading
+import time
+
+
+# 検索機能（PDF読み込み・分割・埋め込み・FAISS）に必要なパッケージ（判定はパッケージを読み込まずに行う）
+VECTOR_PACKAGES = ["langchain", "langchain_community", "langchain_openai", "faiss", "fitz"]
+
+# 初回表示の後にバックグラウンドで読み込んでおくモジュール
+PRELOAD_MODULES = [
+    "langchain_core.messages",
+    "langchain_core.callbacks",
+    "langchain_core.prompts",
+    "langchain_openai",
+    "langchain_community.vectorstores",
+    "langchain_community.document_loaders",
+    "langchain.text_splitter",
+    "langchain.chains",
+]
+
+_preload_lock = threading.Lock()
+_preload_thread = None
+_preload_seconds = None
+
+
+def find_missing(packages: list) -> list:
+    """インストールされていないパッケージ名の一覧（パッケージ自体は読み込まない）"""
+    return [name for name in packages if importlib.util.find_spec(name) is None]
+
+
+def check_vector_support():
+    """
+    検索機能に必要なパッケージがそろっているか確認
+
+    Returns:
+        (利用可否, エラーメッセージ) のタプル
+    """
+    missing = find_missing(VECTOR_PACKAGES)
+    if missing:
+        return False, f"No module named {', '.join(repr(name) for name in missing)}"
+    return True, None
+
+
+def _preload():
+    global _preload_seconds
+    started = time.perf_counter()
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            # 読み込めないモジュールは利用時にエラーを表示する
+            continue
+    _preload_seconds = time.perf_counter() - started
+
+
+def preload_in_background():
+    """検索用のモジュールをバックグラウンドで読み込む（プロセスで1回だけ開始）"""
+    global _preload_thread
+    with _preload_lock:
+        if _preload_thread is None:
+            _preload_thread = threading.Thread(target=_preload, name="module-preload", daemon=True)
+            _preload_thread.start()
+    return _preload_thread
+
+
+def get_preload_seconds():
+    """バックグラウンド読み込みにかかった時間（秒、未完了の場合はNone）"""
+    return _preload_seconds
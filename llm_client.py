@@ -0,0 +1,153 @@
+"""
+このファイルは、OpenAIクライアント（ChatOpenAI / OpenAIEmbeddings）の生成を一元化するファイルです。
+環境変数「OPENAI_BASE_URL」を設定すると、ローカルのスタブサーバー（mock_openai_server.py）などの
+OpenAI互換エンドポイントに接続先を切り替えられます。
+同期の呼び出し元（画面のスクリプト）からの非同期の呼び出しは、プロセスで1つのイベントループのスレッドと
+1つのHTTPクライアントで行い、接続（TLSのハンドシェイク済みの接続プール）を呼び出し間で再利用します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import os
+import threading
+import constants as ct
+
+
+# プロセスで共有するイベントループ（専用のスレッドで動かし続ける）と、そのループで使うHTTPクライアント
+_event_loop = None
+_event_loop_lock = threading.Lock()
+_async_http_client = None
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_base_url():
+    """
+    OpenAI互換エンドポイントのベースURLを取得
+
+    Returns:
+        環境変数「OPENAI_BASE_URL」の値（未設定の場合はNone = OpenAI本番API）
+    """
+    return os.getenv("OPENAI_BASE_URL") or None
+
+
+def is_openai_configured():
+    """
+    OpenAI（または互換エンドポイント）を利用できる設定かどうか
+
+    Returns:
+        APIキーまたはベースURLが設定されていればTrue
+    """
+    return bool(os.getenv("OPENAI_API_KEY") or get_base_url())
+
+
+def _client_kwargs():
+    """
+    接続先に応じたクライアント共通の引数を作成
+    """
+    kwargs = {}
+    base_url = get_base_url()
+    if base_url:
+        kwargs["base_url"] = base_url
+        # スタブサーバーはAPIキーを検証しないが、openaiクライアントは空のキーを受け付けない
+        if not os.getenv("OPENAI_API_KEY"):
+            kwargs["api_key"] = ct.STUB_API_KEY
+    return kwargs
+
+
+def create_chat_llm(**kwargs):
+    """
+    チャットモデルのオブジェクトを作成
+
+    Args:
+        kwargs: ChatOpenAIに渡す追加の引数（既定値を上書き）
+
+    Returns:
+        ChatOpenAIのオブジェクト
+    """
+    from langchain_openai import ChatOpenAI
+
+    params = {
+        "model": ct.OPENAI_CHAT_MODEL,
+        "temperature": ct.OPENAI_TEMPERATURE,
+    }
+    params.update(_client_kwargs())
+    params.update(kwargs)
+    return ChatOpenAI(**params)
+
+
+def create_embeddings(cache_queries=False, **kwargs):
+    """
+    埋め込みモデルのオブジェクトを作成
+
+    Args:
+        cache_queries: Trueの場合、検索クエリの埋め込みをメモリにキャッシュする
+        kwargs: OpenAIEmbeddingsに渡す追加の引数（既定値を上書き）
+
+    Returns:
+        OpenAIEmbeddingsのオブジェクト（cache_queries=Trueの場合はCachedQueryEmbeddingsで包んだもの）
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    params = {"model": ct.OPENAI_EMBEDDING_MODEL}
+    params.update(_client_kwargs())
+    if get_base_url():
+        # 互換エンドポイントではtiktokenの辞書ダウンロード（ネットワーク接続）を避け、文字列のまま送信する
+        params["check_embedding_ctx_length"] = False
+    params.update(kwargs)
+    embeddings = OpenAIEmbeddings(**params)
+    if cache_queries and ct.ENABLE_QUERY_EMBEDDING_CACHE:
+        from cached_embeddings import CachedQueryEmbeddings
+        return CachedQueryEmbeddings(embeddings)
+    return embeddings
+
+
+def _get_event_loop():
+    """
+    プロセスで共有するイベントループを取得（初回に専用のスレッドで起動）
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+            _event_loop = loop
+    return _event_loop
+
+
+def run_async(coro):
+    """
+    コルーチンをプロセスで共有するイベントループで実行し、結果を待つ（同期の呼び出し元用）
+
+    Args:
+        coro: 実行するコルーチン
+
+    Returns:
+        コルーチンの戻り値（例外はそのまま送出）
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _get_event_loop())
+    try:
+        return future.result()
+    except BaseException:
+        # 呼び出し元が中断された場合は、ループ側の処理も取り消す
+        future.cancel()
+        raise
+
+
+def get_async_http_client():
+    """
+    共有のイベントループで使うHTTPクライアントを取得（run_asyncで実行するコルーチンの中から呼び出す）
+
+    Returns:
+        openai.DefaultAsyncHttpxClientのオブジェクト（プロセスで1つ。閉じずに使い続ける）
+    """
+    global _async_http_client
+    # 共有のイベントループのスレッドからだけ呼び出されるため、ロックは不要
+    if _async_http_client is None:
+        import openai
+        _async_http_client = openai.DefaultAsyncHttpxClient()
+    return _async_http_client
@@ -0,0 +1,261 @@
+"""
+LLM呼び出しの再試行・ヘッジモジュール
+1回ごとのタイムアウト、再試行できるエラー（タイムアウト・接続エラー・429・5xx）のジッター付き指数バックオフ、
+応答時間がp95を超えた場合に2本目のリクエストを出して先に返った方を使う（遅い方は取り消す）機能を提供
+再試行・ヘッジの回数と応答時間の分布を記録し、効果（p99の改善）を確認できるようにする
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import constants as ct
+from metrics import metrics_registry, percentile
+
+try:
+    import openai
+    OPENAI_SUPPORT = True
+except ImportError:
+    OPENAI_SUPPORT = False
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    再試行で成功する見込みのあるエラーか
+
+    Args:
+        error: LLMの呼び出しで発生した例外
+
+    Returns:
+        タイムアウト・接続エラー・レート制限（残高不足を除く）・サーバーエラーの場合はTrue
+    """
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    if not OPENAI_SUPPORT:
+        return False
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        # 残高不足のRateLimitErrorは待っても解消しない
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def get_retry_after(error: BaseException):
+    """レスポンスのRetry-Afterヘッダーの秒数（無い場合はNone）"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientInvoker:
+    """
+    LLM呼び出しの再試行・ヘッジ（プロセス内で共有し、応答時間の分布と回数を記録）
+    呼び出しは「1回のタイムアウト秒数を受け取りawaitableを返す関数」として渡す（ヘッジでは2回呼ばれる）
+    """
+
+    def __init__(self, max_attempts: int = ct.LLM_MAX_ATTEMPTS,
+                 attempt_timeout_seconds: float = ct.LLM_ATTEMPT_TIMEOUT_SECONDS,
+                 backoff_base_seconds: float = ct.LLM_RETRY_BASE_SECONDS,
+                 backoff_max_seconds: float = ct.LLM_RETRY_MAX_BACKOFF_SECONDS,
+                 enable_hedging: bool = ct.ENABLE_LLM_HEDGING,
+                 hedge_percentile: float = ct.LLM_HEDGE_PERCENTILE,
+                 hedge_min_samples: int = ct.LLM_HEDGE_MIN_SAMPLES,
+                 latency_window: int = ct.LLM_LATENCY_WINDOW):
+        self.max_attempts = max_attempts
+        self.attempt_timeout_seconds = attempt_timeout_seconds
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.enable_hedging = enable_hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._lock = threading.Lock()
+        # 1回の呼び出しの応答時間（成功したもの）。ヘッジを出すまでの時間に使う
+        self._attempt_latencies = deque(maxlen=latency_window)
+        # 再試行・ヘッジを含めた、呼び出し元から見た応答時間
+        self._call_latencies = deque(maxlen=latency_window)
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+
+    def _record_attempt(self, seconds: float):
+        with self._lock:
+            self._attempt_latencies.append(seconds)
+
+    def hedge_delay(self):
+        """2本目のリクエストを出すまでの秒数（ヘッジしない・応答時間の実績が足りない場合はNone）"""
+        if not self.enable_hedging:
+            return None
+        with self._lock:
+            if len(self._attempt_latencies) < self.hedge_min_samples:
+                return None
+            return percentile(list(self._attempt_latencies), self.hedge_percentile)
+
+    def backoff(self, attempt: int) -> float:
+        """attempt回目（1始まり）の失敗後に待つ秒数（フルジッター）"""
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (attempt - 1)))
+
+    async def _timed(self, call, timeout: float):
+        """1回の呼び出し（タイムアウト付き）。成功した場合は応答時間を記録"""
+        started = time.monotonic()
+        response = await asyncio.wait_for(call(timeout), timeout)
+        self._record_attempt(time.monotonic() - started)
+        return response
+
+    async def _attempt(self, call, timeout: float):
+        """1回分の呼び出し（p95を超えても返らない場合は2本目を出し、先に成功した方を使う）"""
+        delay = self.hedge_delay()
+        primary = asyncio.ensure_future(self._timed(call, timeout))
+        if delay is None or delay >= timeout:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self.hedges += 1
+        hedge = asyncio.ensure_future(self._timed(call, timeout - delay))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # 遅い方のリクエストは取り消す（接続を閉じ、生成を打ち切らせる）
+            for task in (primary, hedge):
+                if task.done():
+                    if not task.cancelled():
+                        task.exception()  # 失敗していた方の例外は確認済みとして扱う
+                else:
+                    task.cancel()
+
+    async def ainvoke(self, call, deadline: float = None):
+        """
+        再試行・ヘッジ付きでLLMを呼び出す
+
+        Args:
+            call: 1回のタイムアウト秒数を受け取り、LLMの応答のawaitableを返す関数
+            deadline: 期限（time.monotonic()の値。Noneの場合は1回のタイムアウト×試行回数）
+
+        Returns:
+            LLMの応答
+
+        Raises:
+            最後の試行のエラー（再試行できないエラーはすぐに、期限までに成功しない場合は最後のもの）
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.attempt_timeout_seconds * self.max_attempts
+        started = time.monotonic()
+        with self._lock:
+            self.calls += 1
+
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = min(self.attempt_timeout_seconds, deadline - time.monotonic())
+            with self._lock:
+                self.attempts += 1
+            try:
+                response = await self._attempt(call, timeout)
+                with self._lock:
+                    self._call_latencies.append(time.monotonic() - started)
+                return response
+            except Exception as e:
+                if isinstance(e, (TimeoutError, asyncio.TimeoutError)) or (
+                        OPENAI_SUPPORT and isinstance(e, openai.APITimeoutError)):
+                    with self._lock:
+                        self.timeouts += 1
+                wait = max(self.backoff(attempt), get_retry_after(e) or 0)
+                if attempt >= self.max_attempts or not is_retryable(e) or time.monotonic() + wait >= deadline:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+            with self._lock:
+                self.retries += 1
+            await asyncio.sleep(wait)
+
+    async def astream(self, stream, deadline: float = None):
+        """
+        再試行付きでストリーミングする（最初の断片を返す前のエラーのみ再試行し、ヘッジはしない）
+
+        Args:
+            stream: 1回のタイムアウト秒数を受け取り、断片の非同期イテレーターを返す関数
+            deadline: 期限（time.monotonic()の値）
+
+        Yields:
+            LLMの応答の断片
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.attempt_timeout_seconds * self.max_attempts
+        started = time.monotonic()
+        with self._lock:
+            self.calls += 1
+
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = min(self.attempt_timeout_seconds, deadline - time.monotonic())
+            with self._lock:
+                self.attempts += 1
+            yielded = False
+            try:
+                async for chunk in stream(timeout):
+                    yielded = True
+                    yield chunk
+                with self._lock:
+                    self._call_latencies.append(time.monotonic() - started)
+                return
+            except Exception as e:
+                wait = max(self.backoff(attempt), get_retry_after(e) or 0)
+                if (yielded or attempt >= self.max_attempts or not is_retryable(e)
+                        or time.monotonic() + wait >= deadline):
+                    with self._lock:
+                        self.failures += 1
+                    raise
+            with self._lock:
+                self.retries += 1
+            await asyncio.sleep(wait)
+
+    def get_stats(self) -> dict:
+        """呼び出し・試行・再試行・タイムアウト・ヘッジの回数と、応答時間のパーセンタイル（秒）"""
+        with self._lock:
+            stats = {
+                "calls": self.calls,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "failures": self.failures,
+            }
+            latencies = list(self._call_latencies)
+        for percent in (50, 95, 99):
+            stats[f"p{percent}_seconds"] = percentile(latencies, percent) if latencies else None
+        return stats
+
+
+# グローバルインスタンス（プロセス内の全セッションで共有）
+resilient_invoker = ResilientInvoker()
+metrics_registry.register_collector("llm", resilient_invoker.get_stats)
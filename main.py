@@ -4,26 +4,23 @@ FAISS-RAGと既存のコンポーネント構造を統合
 """
 
 import streamlit as st
-import os
 import re
+import uuid
+from functools import partial
 from dotenv import load_dotenv
 
 # 内部モジュールのインポート
 import components
 import constants as ct
-import utils
-
-# PDF処理とベクターストアのためのインポート
-try:
-    from langchain_community.document_loaders import PyMuPDFLoader
-    from langchain.text_splitter import CharacterTextSplitter
-    from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-    from langchain_community.vectorstores import FAISS
-    import numpy as np
-    VECTOR_SUPPORT = True
-except ImportError as e:
-    VECTOR_SUPPORT = False
-    IMPORT_ERROR = str(e)
+from index_loader import index_loader
+import lazy_imports
+from math_normalizer import prepare_math_response, split_display_math
+from metrics import configure_otel_exporter, metrics_registry
+import rag_pipeline
+
+# PDF処理とベクターストアに必要なライブラリの確認
+# （LangChain・FAISSは初回の利用時に読み込み、画面の初回表示を待たせない）
+VECTOR_SUPPORT, IMPORT_ERROR = lazy_imports.check_vector_support()
 
 # 環境変数読み込み
 load_dotenv()
@@ -47,253 +44,59 @@ if "pdf_chunks" not in st.session_state:
 if "mode" not in st.session_state:
     st.session_state.mode = ct.ANSWER_MODE_1
 
+# 受付制御（利用者ごとの質問の枠）で使う利用者の識別子
+if "user_id" not in st.session_state:
+    st.session_state.user_id = uuid.uuid4().hex
+
+# インデックスの読み込みをバックグラウンドで開始（プロセスで1回だけ。状態は全セッションで共有）
+if VECTOR_SUPPORT and ct.PRELOAD_INDEX_ON_START:
+    index_loader.start()
+
+# 処理時間の計測値をOpenTelemetryで送信（送信先が設定されている場合のみ。プロセスで1回だけ）
+configure_otel_exporter()
+
 
 ############################################################
 # FAISS-RAG機能
 ############################################################
 
-def load_pdf_with_faiss():
-    """コスト最適化されたFAISS RAG初期化"""
-    from cost_optimizer import cost_optimizer, vector_manager
+def attach_shared_index():
+    """バックグラウンドで読み込み済みのインデックスを、このセッションで利用する（読み込み直した場合も切り替える）"""
+    # 新しいバージョンが公開されていれば読み込み直しを開始（完了するまでは今のインデックスを使う）
+    index_loader.check_for_update()
+    index = index_loader.get_index()
+    if index is None or st.session_state.get("index_generation") == index["generation"]:
+        return
     
-    try:
-        # OpenAI APIキーの確認
-        if not os.getenv("OPENAI_API_KEY"):
-            st.error("OpenAI APIキーが設定されていません。")
-            return False
-        
-        # 埋め込みオブジェクトを作成
-        embeddings = OpenAIEmbeddings(
-            model=ct.OPENAI_EMBEDDING_MODEL,
-            show_progress_bar=True
-        )
-        
-        # 永続化データの確認
-        if vector_manager.is_cache_valid():
-            st.info("🔄 永続化されたベクターストアを読み込み中...")
-            vectorstore, cached_chunks = vector_manager.load_vector_store(embeddings)
-            
-            if vectorstore is not None and cached_chunks is not None:
-                # キャッシュから復元
-                st.session_state.vectorstore = vectorstore
-                st.session_state.pdf_chunks = cached_chunks
-                
-                # ファイル別分布を再計算
-                file_distribution = {}
-                for chunk in cached_chunks:
-                    source = chunk.metadata.get('source_file', 'unknown')
-                    file_distribution[source] = file_distribution.get(source, 0) + 1
-                st.session_state.file_distribution = file_distribution
-                
-                st.success(f"✅ キャッシュから復元: {len(cached_chunks)}チャンク（API使用なし）")
-                return True
-        
-        # 新規作成の場合
-        st.warning("🆕 新しいベクターストアを作成します（API使用）")
-        
-        # 存在するファイルのみを選択
-        existing_files = [pdf_path for pdf_path in ct.PDF_FILES if os.path.exists(pdf_path)]
-        
-        if not existing_files:
-            st.error("利用可能なPDFファイルがありません。")
-            return False
-        
-        st.info(f"📄 {len(existing_files)}個のPDFファイルを読み込み中...")
-        
-        # 全PDFファイルの読み込み
-        all_documents = []
-        for i, pdf_path in enumerate(existing_files, 1):
-            st.info(f"📚 PDFファイル {i}/{len(existing_files)} を読み込み中: {os.path.basename(pdf_path)}")
-            
-            try:
-                loader = PyMuPDFLoader(pdf_path)
-                documents = loader.load()
-                
-                # メタデータにファイル名を追加
-                for doc in documents:
-                    doc.metadata['source_file'] = os.path.basename(pdf_path)
-                
-                all_documents.extend(documents)
-                st.success(f"✅ {os.path.basename(pdf_path)}: {len(documents)}ページ")
-                
-            except Exception as e:
-                st.error(f"❌ {os.path.basename(pdf_path)}の読み込みエラー: {str(e)}")
-                continue
-        
-        if not all_documents:
-            st.error("PDFファイルの読み込みに失敗しました。")
-            return False
-        
-        st.info(f"📚 合計 {len(all_documents)} ページを読み込み完了")
-        
-        # テキスト分割
-        st.info("📝 テキストを分割中...")
-        text_splitter = CharacterTextSplitter(
-            chunk_size=ct.CHUNK_SIZE,
-            chunk_overlap=ct.CHUNK_OVERLAP,
-            separator="\n"
-        )
-        
-        # ドキュメント分割
-        split_docs = text_splitter.split_documents(all_documents)
-        
-        # チャンク数制限
-        max_chunks = min(ct.MAX_CHUNKS, len(split_docs))
-        test_chunks = split_docs[:max_chunks]
-        st.info(f"🧪 {len(test_chunks)} チャンクを使用 (全{len(split_docs)}チャンクから)")
-        
-        # ファイル別の分布を表示
-        file_distribution = {}
-        for chunk in test_chunks:
-            source = chunk.metadata.get('source_file', 'unknown')
-            file_distribution[source] = file_distribution.get(source, 0) + 1
-        
-        # 埋め込みベクター作成（API使用）
-        st.info("🤖 埋め込みベクターを作成中... (OpenAI API使用)")
-        vectorstore = FAISS.from_documents(test_chunks, embeddings)
-        
-        # ベクターストアを永続化（次回からAPI不要）
-        st.info("💾 ベクターストアを永続化中...")
-        vector_manager.save_vector_store(vectorstore, test_chunks)
-        
-        # セッション状態に保存
-        st.session_state.vectorstore = vectorstore
-        st.session_state.pdf_chunks = test_chunks
-        st.session_state.file_distribution = file_distribution
-        
-        st.success(f"✅ FAISS-RAG初期化完了: {len(test_chunks)}チャンク ({len(existing_files)}ファイル)")
-        
-        return True
-        
-    except Exception as e:
-        st.error(f"FAISS-RAG初期化エラー: {str(e)}")
-        return False
+    st.session_state.vectorstore = index["vectorstore"]
+    st.session_state.pdf_chunks = index["chunks"]
+    st.session_state.file_distribution = index["file_distribution"]
+    st.session_state.index_generation = index["generation"]
+    st.session_state.index_version = index["version"]
+    st.session_state.rag_initialized = True
 
 
 def faiss_search(query, k=ct.FAISS_SEARCH_K):
     """FAISS検索"""
     try:
-        if st.session_state.vectorstore is None:
-            return []
-        
-        # 類似度検索
-        results = st.session_state.vectorstore.similarity_search_with_score(query, k=k)
-        
-        # 結果を整形
-        formatted_results = []
-        for doc, score in results:
-            formatted_results.append({
-                'content': doc.page_content,
-                'metadata': doc.metadata,
-                'similarity_score': score,
-                'search_type': 'FAISS similarity'
-            })
-        
-        return formatted_results
-        
+        return rag_pipeline.search(st.session_state.vectorstore, query, k=k)
     except Exception as e:
         st.error(f"FAISS検索エラー: {str(e)}")
         return []
 
 
-def clean_and_format_text(text):
-    """教科書テキストを読みやすく整形"""
-    # 改行を適切に処理
-    text = re.sub(r'\n+', '\n', text)  # 複数改行を1つに
-    text = re.sub(r'\s+', ' ', text)   # 複数スペースを1つに
-    
-    # 不要な文字を削除
-    text = re.sub(r'[^\w\s\.\,\!\?\(\)\[\]\{\}\-\+\=\×\÷\°\%\：\；\、\。\（\）\「\」\『\』]', '', text)
-    
-    # 句読点の後にスペースを追加
-    text = re.sub(r'([。\.])\s*', r'\1 ', text)
-    text = re.sub(r'([、\,])\s*', r'\1 ', text)
-    
-    # 数式を見やすく
-    text = re.sub(r'([A-Z])\s*=\s*', r'\n**\1 = ', text)
-    text = re.sub(r'(\d+)\s*\.', r'\n\1. ', text)
-    
-    return text.strip()
-
-
-def extract_key_points(content):
-    """教科書内容から重要ポイントを抽出"""
-    key_points = []
-    
-    # 数式を抽出
-    formulas = re.findall(r'[A-Z]\s*=\s*[^。\n]+', content)
-    for formula in formulas:
-        key_points.append(f"📐 **公式**: {formula.strip()}")
-    
-    # 重要な概念を抽出
-    concepts = re.findall(r'([ア-ン]{2,}の法則|[ア-ン]{2,}の定理)', content)
-    for concept in concepts:
-        key_points.append(f"🔑 **重要概念**: {concept}")
-    
-    # 定義を抽出
-    definitions = re.findall(r'([^。\n]*とは[^。\n]*)', content)
-    for definition in definitions[:2]:  # 最大2つ
-        key_points.append(f"💡 **定義**: {definition.strip()}")
-    
-    return key_points
+@metrics_registry.timed("math_display")
+def display_math_enhanced_response(response):
+    """数式表示を強化したレスポンス表示（整理済みのテキストを返し、会話ログの表示に再利用する）"""
+    processed_response = prepare_math_response(response)
+    display_prepared_math_response(processed_response)
+    return processed_response
 
 
-def display_math_enhanced_response(response):
-    """数式表示を強化したレスポンス表示"""
-    import re
-    
-    # 各パターンを順次処理
-    processed_response = response
-    
-    # まず [ ] パターンを処理
-    bracket_pattern = r'\[\s*([^]]+)\s*\]'
-    def replace_bracket_latex(match):
-        formula = match.group(1)
-        # LaTeX記法を整理
-        clean_formula = (formula
-                        .replace('\\times', '×')
-                        .replace('\\text{A}', 'A')
-                        .replace('\\text{V}', 'V')
-                        .replace('\\text{Ω}', 'Ω')
-                        .replace('\\text{W}', 'W')
-                        .replace('\\text{', '')
-                        .replace('}', '')
-                        .replace('\\Omega', 'Ω')
-                        .replace('\\,', ' ')
-                        .replace('\\dots', '…')
-                        .replace(',', '')
-                        .replace('R2S', 'R2')  # R2Sの修正
-                        .replace('\\', '')
-                        .strip())
-        return f"\n\n$${clean_formula}$$\n\n"
-    
-    processed_response = re.sub(bracket_pattern, replace_bracket_latex, processed_response)
-    
-    # $ $ パターンを処理
-    dollar_pattern = r'\$([^$]+)\$'
-    def replace_dollar_latex(match):
-        formula = match.group(1)
-        clean_formula = (formula
-                        .replace('\\times', '×')
-                        .replace('\\text{A}', 'A')
-                        .replace('\\text{V}', 'V')
-                        .replace('\\text{Ω}', 'Ω')
-                        .replace('\\text{W}', 'W')
-                        .replace('\\text{', '')
-                        .replace('}', '')
-                        .replace('\\Omega', 'Ω')
-                        .replace('\\,', ' ')
-                        .replace('\\dots', '…')
-                        .replace(',', '')
-                        .replace('R2S', 'R2')  # R2Sの修正
-                        .replace('\\', '')
-                        .strip())
-        return f"\n\n$${clean_formula}$$\n\n"
-    
-    processed_response = re.sub(dollar_pattern, replace_dollar_latex, processed_response)
-    
+def display_prepared_math_response(processed_response):
+    """整理済みテキストの数式を検出して表示"""
     # $$ で囲まれた数式を検出して表示
-    parts = re.split(r'\$\$([^$]+)\$\$', processed_response)
+    parts = split_display_math(processed_response)
     
     for i, part in enumerate(parts):
         if i % 2 == 0:  # 通常のテキスト
@@ -343,61 +146,6 @@ def display_math_enhanced_response(response):
                     st.markdown(f"**数式**: {part}")
 
 
-def enhance_math_display(text):
-    """数式表示を強化するための後処理"""
-    import re
-    
-    # \text{A}、\text{V}、\text{Ω}などのLaTeX記法を通常の文字に変換
-    text = re.sub(r'\\text\{([^}]+)\}', r'\1', text)
-    text = text.replace('\\,', ' ')  # LaTeX空白を通常空白に
-    text = text.replace('\\dots', '…')  # \dotsを省略記号に変換
-    
-    # 一般的な物理公式パターンを検出して$記号で囲む
-    math_patterns = [
-        # 基本的な公式
-        (r'\bV\s*=\s*I\s*[×*]\s*R\b', r'$V = I × R$'),
-        (r'\bP\s*=\s*V\s*[×*]\s*I\b', r'$P = V × I$'),
-        (r'\bP\s*=\s*I\s*[²2]\s*[×*]\s*R\b', r'$P = I² × R$'),
-        (r'\bP\s*=\s*V\s*[²2]\s*/\s*R\b', r'$P = V²/R$'),
-        
-        # 抵抗の接続（省略記号付き）
-        (r'\bR\s*=\s*R1\s*\+\s*R2\s*\+\s*R3\s*\+\s*[…\\dots]+\s*\+\s*Rn\b', r'$R = R1 + R2 + R3 + … + Rn$'),
-        (r'\bR\s*=\s*R1\s*\+\s*R2S?\s*\+\s*R3\s*\+\s*[…\\dots]+\s*\+\s*Rn\b', r'$R = R1 + R2 + R3 + … + Rn$'),
-        (r'\bR\s*=\s*R1\s*\+\s*R2\b', r'$R = R1 + R2$'),
-        (r'\b1/R\s*=\s*1/R1\s*\+\s*1/R2\s*\+\s*[…\\dots]+\s*\+\s*1/Rn\b', r'$1/R = 1/R1 + 1/R2 + … + 1/Rn$'),
-        (r'\b1/R\s*=\s*1/R1\s*\+\s*1/R2\b', r'$1/R = 1/R1 + 1/R2$'),
-        
-        # キルヒホッフの法則
-        (r'\bΣV\s*=\s*0\b', r'$ΣV = 0$'),
-        (r'\bΣI\s*=\s*0\b', r'$ΣI = 0$'),
-        
-        # 数値を含む計算式（より詳細に）
-        (r'V\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[A]\s*[×*]\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[ΩΩ]\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[V]', r'$V = \1A × \2Ω = \3V$'),
-        (r'P\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[V]\s*[×*]\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[A]\s*=\s*(\d+(?:\.\d+)?)\s*[,，]?\s*[W]', r'$P = \1V × \2A = \3W$'),
-    ]
-    
-    # 各パターンを適用
-    for pattern, replacement in math_patterns:
-        text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
-    
-    # 既存の$記号が含まれている部分の清理
-    text = re.sub(r'\$([^$]*),\s*\\text\{([^}]+)\}([^$]*)\$', r'$\1\2\3$', text)
-    
-    # LaTeX記法の問題を修正
-    text = re.sub(r'\$([^$]*R2S[^$]*)\$', lambda m: m.group(0).replace('R2S', 'R2'), text)
-    text = re.sub(r'\$([^$]*\\dots[^$]*)\$', lambda m: m.group(0).replace('\\dots', '…'), text)
-    
-    # 残っているLaTeX記法を清理
-    text = text.replace('\\times', '×')
-    text = text.replace('\\Omega', 'Ω')
-    
-    return text
-    text = text.replace('\\times', '×')
-    text = text.replace('\\Omega', 'Ω')
-    
-    return text
-
-
 def process_latex_in_text(text):
     """テキスト内のLaTeX記法を処理"""
     # 様々なLaTeX記法を統一
@@ -431,63 +179,34 @@ def safe_latex_format(text):
 
 def generate_openai_student_answer(query, context_text):
     """コスト最適化されたOpenAI API回答生成"""
-    from cost_optimizer import cost_optimizer
+    from admission import AdmissionRejected, RequestCancelled
+    from utils import get_session_cancel_check
     
+    # 順番待ち・生成中の表示は同じ場所で切り替える
+    status_area = st.empty()
     try:
-        # キャッシュされた回答をチェック
-        cached_response = cost_optimizer.get_cached_response(query)
-        if cached_response:
-            st.info("💰 キャッシュから回答を取得（API使用なし）")
-            return cached_response
-        
-        # 日次制限をチェック
-        if not cost_optimizer.check_daily_limit():
-            return "本日のAPI使用制限に達しました。キャッシュされた回答のみ利用可能です。"
-        
-        # 入力パラメータの検証
-        if not query:
-            query = "質問内容なし"
-        if not context_text:
-            context_text = "関連する教科書の内容が見つかりませんでした。"
-        
-        # OpenAI ChatGPTモデルを初期化（コスト最適化済み）
-        llm = ChatOpenAI(
-            model=ct.OPENAI_CHAT_MODEL,  # gpt-4o-miniに変更済み
-            temperature=ct.OPENAI_TEMPERATURE,
-            max_tokens=ct.OPENAI_MAX_TOKENS  # 1500に削減済み
+        return rag_pipeline.generate_student_answer(
+            query, context_text, notify=status_area.info, user_id=st.session_state.user_id,
+            is_cancelled=get_session_cancel_check()
         )
         
-        # プロンプト作成（LaTeX記法を避けてシンプルに）
-        try:
-            prompt = ct.SYSTEM_PROMPT_STUDENT_FRIENDLY.format(
-                query=query,
-                context=context_text
-            )
-        except Exception as format_error:
-            st.error(f"プロンプトフォーマットエラー: {format_error}")
-            # フォールバック用の簡単なプロンプト
-            prompt = f"""工業高校生向けに分かりやすく回答してください。
-            
-質問: {query}
-
-教科書の内容: {context_text}
-
-数式は$記号で囲んで表示してください（例：$V = I × R$）。"""
-        
-        # API使用量をインクリメント
-        cost_optimizer.increment_usage()
+    except (rag_pipeline.DailyLimitError, rag_pipeline.CircuitOpenError):
+        # 呼び出し元が教科書の抜粋で回答する
+        status_area.empty()
+        raise
         
-        # OpenAI APIで回答生成
-        st.info("🤖 GPT-4o-miniで回答生成中...")
-        response = llm.invoke(prompt)
+    except AdmissionRejected as e:
+        status_area.warning(f"⏳ {e}")
+        return f"⏳ {e}"
         
-        # レスポンスをキャッシュ
-        cost_optimizer.cache_response(query, response.content)
-        
-        return response.content
+    except RequestCancelled:
+        # セッションが終了しているため表示先が無い
+        raise
         
     except Exception as e:
-        error_message = str(e)
+        status_area.empty()
+        cause = e.__cause__ if isinstance(e, rag_pipeline.GenerationFailed) and e.__cause__ else e
+        error_message = str(cause)
         st.error(f"OpenAI API エラー: {error_message}")
         
         # エラーの種類に応じて対処法を提示
@@ -497,89 +216,65 @@ def generate_openai_student_answer(query, context_text):
             st.warning("リクエストに問題があります。プロンプトを簡略化して再試行します。")
         elif "authentication" in error_message.lower():
             st.error("OpenAI APIキーの認証に失敗しました。設定を確認してください。")
+        elif "timed out" in error_message.lower():
+            st.warning(f"回答の生成が制限時間（{ct.GENERATION_LATENCY_BUDGET_SECONDS}秒）内に終わりませんでした。もう一度お試しください。")
         
-        # フォールバック応答
-        return f"""申し訳ございませんが、回答生成中にエラーが発生しました。
-
-**エラー詳細**: {error_message}
-
-**教科書の関連内容**:
-{context_text[:500] if context_text else "内容が見つかりませんでした"}...
-
-教科書の内容をもとに、手動で回答を確認してください。"""
+        # 呼び出し元が教科書の抜粋で回答する
+        if isinstance(e, rag_pipeline.GenerationFailed):
+            raise
+        raise rag_pipeline.GenerationFailed(f"回答の生成に失敗しました: {type(e).__name__}") from e
 
 
 def generate_faiss_response(query, search_results, mode):
     """FAISS検索結果から応答生成"""
     if not search_results:
-        return "関連する情報が見つかりませんでした。質問を変えてみてください。"
+        return ct.NO_SEARCH_RESULTS_MESSAGE
     
     if mode == ct.ANSWER_MODE_1:  # 教科書検索
-        response = f"## 📚「{query}」に関連する教科書の内容\n\n"
-        
-        for i, result in enumerate(search_results, 1):
-            # テキストを読みやすく整形
-            cleaned_content = clean_and_format_text(result['content'])
-            
-            # 重要ポイントを抽出
-            key_points = extract_key_points(result['content'])
-            
-            score = result['similarity_score']
-            source_file = result['metadata'].get('source_file', 'unknown')
-            
-            response += f"### 📖 検索結果 {i} (類似度: {score:.3f})\n"
-            response += f"**出典**: {source_file}\n\n"
-            
-            # 重要ポイントがあれば最初に表示
-            if key_points:
-                response += "**重要ポイント**:\n"
-                for point in key_points[:3]:  # 最大3つ
-                    response += f"- {point}\n"
-                response += "\n"
-            
-            # 整形されたテキスト
-            if len(cleaned_content) > 400:
-                response += f"**内容**: {cleaned_content[:400]}...\n\n"
-            else:
-                response += f"**内容**: {cleaned_content}\n\n"
-            
-            response += "---\n\n"
-        
-        return response
+        return rag_pipeline.format_search_answer(query, search_results)
     
-    else:  # 問い合わせモード
-        # 検索結果から関連コンテンツを抽出
-        context_content = []
-        for result in search_results[:3]:  # 最大3つの結果を使用
-            cleaned_content = clean_and_format_text(result['content'])
-            source_file = result['metadata'].get('source_file', 'unknown')
-            context_content.append(f"【出典: {source_file}】\n{cleaned_content}")
-        
-        # 教科書コンテンツを結合
-        context_text = "\n\n".join(context_content)
-        
-        # OpenAI APIを使って工業高校生向けの回答を生成
+    # 問い合わせモード：OpenAI APIを使って工業高校生向けの回答を生成
+    context_text = rag_pipeline.build_context(search_results)
+    try:
         answer = generate_openai_student_answer(query, context_text)
-        
-        # 数式表示を強化するための後処理
-        answer = enhance_math_display(answer)
-        
-        # 追加の数式パターンマッチング
-        if '=' in answer and ('V' in answer or 'I' in answer or 'R' in answer or 'P' in answer):
-            # 数式が含まれている可能性が高い場合は、さらに処理
-            answer = re.sub(r'([VIRPvipr])\s*=\s*([^$\n]+?)(?=\n|$)', 
-                          lambda m: f"${m.group(1)} = {m.group(2).strip()}$" if '$' not in m.group(0) else m.group(0), 
-                          answer)
-        
-        # 参考情報を追加
-        answer += "\n\n---\n\n**📚 参考にした教科書の内容**:\n"
-        for i, result in enumerate(search_results[:2], 1):
-            source_file = result['metadata'].get('source_file', 'unknown')
-            score = result['similarity_score']
-            preview = clean_and_format_text(result['content'])[:150] + "..."
-            answer += f"\n{i}. **{source_file}** (関連度: {score:.1f})\n{preview}\n"
-        
-        return answer
+    except rag_pipeline.GenerationUnavailable as e:
+        # LLMが使えない間（失敗・遅延の継続、日次の上限）は、教科書検索モードと同じ抜粋ですぐに回答する
+        return rag_pipeline.format_degraded_answer(query, search_results, e)
+    
+    # 数式表示の後処理と参考情報の追加
+    return rag_pipeline.finish_student_answer(answer, search_results)
+
+
+def generate_circuit_solver_response(query, solution):
+    """回路計算ソルバーの計算結果から応答を作成（設定によりLLMの解説を追加）"""
+    if not ct.CIRCUIT_SOLVER_LLM_EXPLANATION:
+        return rag_pipeline.finish_solver_answer(solution)
+    
+    # 計算はソルバーの結果を正とし、LLMには解説のみを依頼する
+    search_results = faiss_search(query, k=ct.FAISS_SEARCH_K)
+    context_text = rag_pipeline.build_solver_context(solution, search_results)
+    try:
+        explanation = generate_openai_student_answer(query, context_text)
+    except rag_pipeline.GenerationUnavailable:
+        # 計算結果はソルバーで求めているため、解説なしで回答する
+        return rag_pipeline.finish_solver_answer(solution)
+    return rag_pipeline.finish_solver_answer(solution, explanation)
+
+
+def display_answer_bank_response(entry):
+    """事前生成済みの回答を表示"""
+    st.caption("⚡ よくある質問のため、事前に生成した回答を表示しています（API使用なし）")
+    display_prepared_math_response(entry["rendered"])
+    
+    try:
+        components.display_faiss_search_results(entry["sources"])
+    except Exception as e:
+        st.warning(f"検索結果表示エラー: {e}")
+    
+    return {
+        "mode": ct.ANSWER_MODE_2,
+        "answer": entry["answer"]
+    }
 
 
 ############################################################
@@ -589,6 +284,9 @@ def generate_faiss_response(query, search_results, mode):
 def main():
     """メインアプリケーション"""
     
+    # 読み込み済みのインデックスがあれば自動的に利用
+    attach_shared_index()
+    
     # タイトル表示
     components.display_app_title()
     st.markdown("**統合版 - FAISS高精度検索対応**")
@@ -606,9 +304,8 @@ def main():
             st.code("キルヒホッフの法則について", language=None)
         else:
             st.info("工業高校生向けの分かりやすい回答をGPT-4o-miniで提供します。計算問題も詳細に解説します。")
-            st.code("キルヒホッフの法則を分かりやすく教えて", language=None)
-            st.code("オームの法則で電流2A、抵抗5Ωの時の電圧は？", language=None)
-            st.code("直列回路の合成抵抗の計算方法は？", language=None)
+            for example in ct.EXAMPLE_QUESTIONS:
+                st.code(example, language=None)
         
         # コスト管理パネル
         st.markdown("---")
@@ -622,42 +319,135 @@ def main():
         with col1:
             st.metric("本日の使用", f"{usage_stats['today_calls']}")
         with col2:
-            st.metric("残り回数", f"{usage_stats['remaining_calls']}")
+            if usage_stats['remaining_calls'] is not None:
+                st.metric("残り回数", f"{usage_stats['remaining_calls']}")
+            elif ct.ENABLE_ADMISSION_CONTROL:
+                from admission import admission_controller
+                user_status = admission_controller.get_user_status(st.session_state.user_id)
+                st.metric("あなたの残り", f"{user_status['available']}/{user_status['burst']}",
+                          help=f"{user_status['seconds_per_token']:.0f}秒ごとに1回分回復します")
+        
+        # プログレスバー（回数の制限が無い場合は推定コストの上限に対する割合）
+        if ct.MAX_DAILY_API_CALLS is not None:
+            progress = min(1.0, usage_stats['today_calls'] / ct.MAX_DAILY_API_CALLS)
+            st.progress(progress, text=f"日次制限: {usage_stats['today_calls']}/{ct.MAX_DAILY_API_CALLS}")
+        elif ct.MAX_DAILY_COST_USD is not None:
+            progress = min(1.0, usage_stats['today_cost'] / ct.MAX_DAILY_COST_USD)
+            st.progress(progress, text=f"日次のコスト上限: ${usage_stats['today_cost']:.4f}/${ct.MAX_DAILY_COST_USD:.2f}")
+        
+        # 混雑状況（上流のLLMへの同時リクエスト数と待ち行列）
+        if ct.ENABLE_ADMISSION_CONTROL:
+            from admission import admission_controller
+            admission_stats = admission_controller.get_stats()
+            st.caption(
+                f"混雑状況: 実行中 {admission_stats['in_flight']}/{admission_stats['max_concurrent']}"
+                f"・順番待ち {admission_stats['queued']}件・平均待ち時間 {admission_stats['avg_wait_seconds']:.1f}秒"
+                f"（バックグラウンド: 実行中 {admission_stats['background_in_flight']}件・待ち {admission_stats['background_queued']}件）"
+            )
+        
+        # サーキットブレーカーが回答生成を止めている間は、抜粋での回答になることを知らせる
+        if ct.ENABLE_GENERATION_BREAKER:
+            from circuit_breaker import STATE_CLOSED, generation_breaker
+            breaker_status = generation_breaker.get_status()
+            if breaker_status["state"] != STATE_CLOSED:
+                st.warning(f"⚠️ AIによる回答生成を一時停止しています（{breaker_status['reason']}）。教科書の抜粋で回答します。")
+        
+        # LLMの応答時間と再試行・ヘッジの回数（このワーカーの直近の呼び出し）
+        from llm_resilience import resilient_invoker
+        resilience_stats = resilient_invoker.get_stats()
+        if resilience_stats["calls"]:
+            st.caption(
+                f"LLM応答時間: p50 {resilience_stats['p50_seconds']:.1f}秒・p99 {resilience_stats['p99_seconds']:.1f}秒"
+                f"・再試行 {resilience_stats['retries']}回・ヘッジ {resilience_stats['hedges']}回（採用 {resilience_stats['hedge_wins']}回）"
+            )
+        
+        # 処理段階ごとの所要時間（管理者向け）
+        if ct.ENABLE_STAGE_METRICS:
+            with st.expander("📈 処理時間の計測（管理者向け）"):
+                components.display_stage_metrics_sidebar()
+        
+        # トークン数・推定コスト
+        today_tokens = usage_stats['today_prompt_tokens'] + usage_stats['today_completion_tokens']
+        token_limit = f" / {ct.MAX_DAILY_TOKENS:,}" if ct.MAX_DAILY_TOKENS is not None else ""
+        cost_limit = f" / ${ct.MAX_DAILY_COST_USD:.2f}" if ct.MAX_DAILY_COST_USD is not None else ""
+        avg_latency = usage_stats['today_avg_latency_ms']
+        st.caption(
+            f"本日のトークン: {today_tokens:,}{token_limit}・推定コスト: ${usage_stats['today_cost']:.4f}{cost_limit}"
+            + (f"・平均応答時間: {avg_latency / 1000:.1f}秒" if avg_latency is not None else "")
+        )
         
-        # プログレスバー
-        progress = usage_stats['today_calls'] / ct.MAX_DAILY_API_CALLS
-        st.progress(progress, text=f"日次制限: {usage_stats['today_calls']}/{ct.MAX_DAILY_API_CALLS}")
+        # プロンプトキャッシュの効き具合
+        prompt_tokens = usage_stats['today_prompt_tokens']
+        cached_tokens = usage_stats['today_cached_tokens']
+        cached_ratio = cached_tokens / prompt_tokens if prompt_tokens else 0
+        st.caption(f"本日の入力トークン: {prompt_tokens}（キャッシュ済み {cached_tokens} / {cached_ratio:.0%}）")
         
         # キャッシュ管理
         st.markdown("**🗄️ キャッシュ管理**")
+        cache_stats = cost_optimizer.get_cache_stats()
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("応答キャッシュ", f"{cache_stats['entries']}件", help=f"上限 {ct.CACHE_MAX_ENTRIES}件")
+        with col2:
+            st.metric("ヒット率", f"{cache_stats['hit_ratio']:.0%}", help="SQLite(L2)での判定。全ワーカーの合計")
+        st.caption(
+            f"容量: {cache_stats['bytes'] / 1024:.0f}KB / {ct.CACHE_MAX_BYTES / 1024 / 1024:.0f}MB"
+            f"・追い出し: {cache_stats['evictions']}件（{ct.CACHE_EVICTION_POLICY.upper()}）"
+            f"・期限切れ: {cache_stats['expirations']}件"
+        )
+        st.caption(
+            f"SQLite(L2・全ワーカー): ヒット {cache_stats['hits']}件・ミス {cache_stats['misses']}件"
+            f" / メモリ(L1・このワーカー): ヒット {cache_stats['l1_hits']}件（{cache_stats['l1_hit_ratio']:.0%}）"
+            f"・保持 {cache_stats['l1_entries']}件"
+        )
         col1, col2 = st.columns(2)
         with col1:
             if st.button("🧹 応答キャッシュクリア"):
-                cost_optimizer.clean_old_cache()
-                st.success("古いキャッシュを削除しました")
+                try:
+                    removed = cost_optimizer.clean_old_cache()
+                    st.success(f"古いキャッシュを削除しました（{removed}件）")
+                except Exception as e:
+                    st.warning(f"キャッシュクリーンアップに失敗: {e}")
         with col2:
             if st.button("🔄 ベクターキャッシュクリア"):
-                vector_manager.clear_cache()
-                st.session_state.rag_initialized = False
-                st.rerun()
-        
-        # FAISS-RAG初期化
+                try:
+                    vector_manager.clear_cache()
+                except Exception as e:
+                    st.error(f"キャッシュクリアに失敗: {e}")
+                else:
+                    # 作成し直すまでは読み込み済みのインデックスで回答を続ける
+                    index_loader.start(force=True)
+                    st.rerun()
+        
+        # FAQ事前回答
+        if ct.ENABLE_ANSWER_BANK and st.session_state.rag_initialized:
+            from answer_bank import answer_bank
+            bank_stats = answer_bank.get_stats(st.session_state.get("index_version"))
+            warm_status = answer_bank.get_warm_up_status()
+            st.caption(f"📚 FAQ事前回答: {bank_stats['fresh']}件")
+            if warm_status["running"]:
+                st.caption("⏳ FAQ回答をバックグラウンドで事前生成中...")
+            elif warm_status["error"]:
+                st.warning(f"FAQ回答の事前生成に失敗しました: {warm_status['error']}")
+            # 事前生成はインデックスの読み込み完了時に自動で行う。ボタンは設定の変更後などにすぐ作り直す場合に使う
+            # （バックグラウンドで生成し、押した人の画面を待たせない）
+            if st.button("📚 FAQ回答を事前生成", disabled=warm_status["running"]):
+                index = index_loader.get_index()
+                if index and answer_bank.start_warm_up(
+                    partial(rag_pipeline.answer_faq_question, index["vectorstore"]), index["version"]
+                ):
+                    st.success("FAQ回答の事前生成をバックグラウンドで開始しました")
+                else:
+                    st.info("別のワーカーがFAQ回答を事前生成中です")
+        
+        # FAISS-RAGの読み込み状態
         st.markdown("---")
-        st.markdown("**🧠 RAG機能の初期化**")
+        st.markdown("**🧠 RAG機能の状態**")
         
         try:
-            if components.display_faiss_initialization_sidebar():
-                with st.spinner(ct.SPINNER_TEXT):
-                    success = load_pdf_with_faiss()
-                    if success:
-                        st.session_state.rag_initialized = True
-                        st.success("FAISS-RAG機能の初期化が完了しました！")
-                        st.rerun()
-                    else:
-                        st.session_state.rag_initialized = False
+            components.display_index_status_sidebar()
         except Exception as e:
-            st.error(f"RAG初期化エラー: {e}")
-            st.session_state.rag_initialized = False
+            st.error(f"RAG状態表示エラー: {e}")
     
     # FAISS-RAG機能のステータス表示
     try:
@@ -681,58 +471,91 @@ def main():
             with st.chat_message("user"):
                 st.write(prompt)
             st.session_state.messages.append({"role": "user", "content": prompt})
+            # 新しい質問をしたら、会話ログの表示範囲を直近のやり取りに戻す
+            st.session_state.log_visible_turns = ct.CONVERSATION_LOG_WINDOW_TURNS
+            
+            # 事前生成済みのFAQ回答を確認
+            from answer_bank import answer_bank
+            bank_entry = None
+            if st.session_state.mode == ct.ANSWER_MODE_2:
+                bank_entry = answer_bank.lookup(prompt, st.session_state.get("index_version"))
             
-            # AI応答を生成
-            with st.chat_message("assistant"):
-                with st.spinner(ct.SPINNER_TEXT):
-                    # FAISS検索実行
-                    search_results = faiss_search(prompt, k=ct.FAISS_SEARCH_K)
+            # 計算問題（オームの法則・電力・合成抵抗）はLLMを使わずに解く
+            solution = None
+            if bank_entry is None and st.session_state.mode == ct.ANSWER_MODE_2 and ct.ENABLE_CIRCUIT_SOLVER:
+                import circuit_solver
+                solution = circuit_solver.solve_question(prompt)
+            
+            # AI応答を生成（表示までの所要時間を計測）
+            # 数式を整理した表示用のテキストは会話ログに保存し、再実行時の表示で再計算しない
+            rendered = None
+            with st.chat_message("assistant"), metrics_registry.timer("answer_total"):
+                if bank_entry:
+                    content = display_answer_bank_response(bank_entry)
+                    rendered = bank_entry["rendered"]
+                elif solution:
+                    with st.spinner(ct.SPINNER_TEXT):
+                        response = generate_circuit_solver_response(prompt, solution)
+                    if not ct.CIRCUIT_SOLVER_LLM_EXPLANATION:
+                        st.caption("🔢 計算問題のため、自動計算で回答しています（API使用なし）")
+                    rendered = display_math_enhanced_response(response)
+                    content = {
+                        "mode": ct.ANSWER_MODE_2,
+                        "answer": response
+                    }
+                else:
+                    with st.spinner(ct.SPINNER_TEXT):
+                        # FAISS検索実行
+                        search_results = faiss_search(prompt, k=ct.FAISS_SEARCH_K)
                     
-                    # 応答生成
-                    response = generate_faiss_response(prompt, search_results, st.session_state.mode)
+                        # 応答生成
+                        response = generate_faiss_response(prompt, search_results, st.session_state.mode)
                     
-                    # 応答形式に応じて表示
-                    if st.session_state.mode == ct.ANSWER_MODE_1:
-                        # 教科書検索モード：そのまま表示
-                        st.write(response)
-                        content = {
-                            "mode": ct.ANSWER_MODE_1,
-                            "answer": response
-                        }
-                    else:
-                        # 問い合わせモード：数式強化表示
-                        with st.expander("🔧 数式処理情報（デバッグ用）", expanded=False):
-                            st.text("元の回答:")
-                            st.text(response[:200] + "..." if len(response) > 200 else response)
+                        # 応答形式に応じて表示
+                        if st.session_state.mode == ct.ANSWER_MODE_1:
+                            # 教科書検索モード：そのまま表示
+                            st.write(response)
+                            content = {
+                                "mode": ct.ANSWER_MODE_1,
+                                "answer": response
+                            }
+                        else:
+                            # 問い合わせモード：数式強化表示
+                            with st.expander("🔧 数式処理情報（デバッグ用）", expanded=False):
+                                st.text("元の回答:")
+                                st.text(response[:200] + "..." if len(response) > 200 else response)
                             
-                            # 数式パターンの検出状況
-                            math_found = []
-                            if '$' in response:
-                                math_found.append("$記号あり")
-                            if 'V = I' in response:
-                                math_found.append("オームの法則")
-                            if 'P = V' in response:
-                                math_found.append("電力公式")
+                                # 数式パターンの検出状況
+                                math_found = []
+                                if '$' in response:
+                                    math_found.append("$記号あり")
+                                if 'V = I' in response:
+                                    math_found.append("オームの法則")
+                                if 'P = V' in response:
+                                    math_found.append("電力公式")
                             
-                            st.text(f"検出された数式パターン: {', '.join(math_found) if math_found else 'なし'}")
+                                st.text(f"検出された数式パターン: {', '.join(math_found) if math_found else 'なし'}")
                         
-                        display_math_enhanced_response(response)
-                        content = {
-                            "mode": ct.ANSWER_MODE_2,
-                            "answer": response
-                        }
+                            rendered = display_math_enhanced_response(response)
+                            content = {
+                                "mode": ct.ANSWER_MODE_2,
+                                "answer": response
+                            }
                     
-                    # 検索結果詳細表示
-                    try:
-                        components.display_faiss_search_results(search_results)
-                    except Exception as e:
-                        st.warning(f"検索結果表示エラー: {e}")
+                        # 検索結果詳細表示
+                        try:
+                            components.display_faiss_search_results(search_results)
+                        except Exception as e:
+                            st.warning(f"検索結果表示エラー: {e}")
             
             # 会話ログに追加
-            st.session_state.messages.append({
+            assistant_message = {
                 "role": "assistant", 
                 "content": content
-            })
+            }
+            if rendered is not None:
+                assistant_message["rendered"] = rendered
+            st.session_state.messages.append(assistant_message)
     
     else:
         st.info("⚡ FAISS-RAG機能を初期化してから質問を開始してください。")
@@ -758,7 +581,7 @@ def main():
         **コスト最適化版の特徴:**
         - **🏦 永続化ストレージ**: ベクターストアをローカル保存（再embeddingなし）
         - **💾 レスポンスキャッシュ**: 同じ質問の回答をキャッシュ（24時間）
-        - **📊 使用量制限**: 日次API呼び出し制限（{ct.MAX_DAILY_API_CALLS}回/日）
+        - **📊 使用量制限**: 1人あたり連続{ct.ADMISSION_USER_BURST}回まで（{ct.ADMISSION_USER_RATE_PER_MINUTE:g}回/分で回復）、混雑時は順番待ち
         - **🤖 軽量モデル**: GPT-4o-miniでコスト削減（従来の1/10の料金）
         - **⚡ 高速検索**: FAISS意味的類似度検索
         - **📐 LaTeX数式**: 美しい数式レンダリング
@@ -781,6 +604,10 @@ def main():
         - チャンクサイズ: {ct.FAISS_CHUNK_SIZE}
         - 最大チャンク数: {ct.FAISS_MAX_CHUNKS}
         """)
+    
+    # 画面の表示が終わってから、検索用のモジュールをバックグラウンドで読み込んでおく
+    if VECTOR_SUPPORT:
+        lazy_imports.preload_in_background()
 
 
 if __name__ == "__main__":
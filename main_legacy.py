@@ -9,12 +9,12 @@
 from dotenv import load_dotenv
 # ログ出力を行うためのモジュール
 import logging
-# OS機能を使用するためのモジュール
-import os
 # streamlitアプリの表示を担当するモジュール
 import streamlit as st
 # （自作）画面表示以外の様々な関数が定義されているモジュール
 import utils
+# （自作）OpenAIクライアントの生成・接続先設定を担当するモジュール
+import llm_client
 # （自作）アプリ起動時に実行される初期化処理が記述された関数
 from app_init import initialize
 # （自作）画面表示系の関数が定義されているモジュール
@@ -76,7 +76,7 @@ with st.sidebar:
     st.markdown("**🧠 RAG機能の初期化**")
     
     # 要件チェック
-    api_key_ok = bool(os.environ.get("OPENAI_API_KEY"))
+    api_key_ok = llm_client.is_openai_configured()
     
     if not api_key_ok:
         st.error("OpenAI APIキーが設定されていません。")
@@ -172,7 +172,8 @@ if chat_message:
             content = cn.display_contact_llm_response(llm_response)
             
             # AIメッセージのログ出力
-            logger.info({"message": content, "application_mode": st.session_state.mode})
+            logger.info({"message": content, "application_mode": st.session_state.mode,
+                         "history_tokens": llm_response.get("history_tokens")})
         except Exception as e:
             # エラーログの出力
             logger.error(f"{ct.DISP_ANSWER_ERROR_MESSAGE}\n{e}")
@@ -0,0 +1,207 @@
+"""
+数式表示の正規化モジュール
+LLMの回答に含まれるLaTeX記法・物理公式を表示用の形式に書き換える機能を提供
+（パターンはモジュール読み込み時に1度だけコンパイルし、数式の部分を1回の走査で書き換える）
+"""
+
+import re
+
+
+# 変換のルールを変更したら上げる（保存済みの整形済みの回答（FAQ事前回答）は作り直される）
+NORMALIZER_VERSION = 1
+
+# LaTeXのエスケープ（公式の検出より前に処理する）
+LATEX_ESCAPE_PATTERN = re.compile(r"\\text\{([^}]+)\}|\\,|\\dots")
+LATEX_ESCAPES = {"\\,": " ", "\\dots": "…"}
+
+# 一般的な物理公式のパターン（大文字・小文字を区別せず検出し、$記号で囲んだ表記に統一。{名前}は数値のグループ）
+FORMULA_PATTERNS = [
+    # 基本的な公式
+    (r"\bV\s*=\s*I\s*[×*]\s*R\b", "$V = I × R$"),
+    (r"\bP\s*=\s*V\s*[×*]\s*I\b", "$P = V × I$"),
+    (r"\bP\s*=\s*I\s*[²2]\s*[×*]\s*R\b", "$P = I² × R$"),
+    (r"\bP\s*=\s*V\s*[²2]\s*/\s*R\b", "$P = V²/R$"),
+
+    # 抵抗の接続（省略記号付きの一般形を、先頭2項だけの形より先に検出する）
+    (r"\bR\s*=\s*R1\s*\+\s*R2S?\s*\+\s*R3\s*\+\s*[…\\dots]+\s*\+\s*Rn\b", "$R = R1 + R2 + R3 + … + Rn$"),
+    (r"\bR\s*=\s*R1\s*\+\s*R2\b", "$R = R1 + R2$"),
+    (r"\b1/R\s*=\s*1/R1\s*\+\s*1/R2\s*\+\s*[…\\dots]+\s*\+\s*1/Rn\b", "$1/R = 1/R1 + 1/R2 + … + 1/Rn$"),
+    (r"\b1/R\s*=\s*1/R1\s*\+\s*1/R2\b", "$1/R = 1/R1 + 1/R2$"),
+
+    # キルヒホッフの法則
+    (r"\bΣV\s*=\s*0\b", "$ΣV = 0$"),
+    (r"\bΣI\s*=\s*0\b", "$ΣI = 0$"),
+
+    # 数値を含む計算式
+    (r"V\s*=\s*(?P<ohm_i>\d+(?:\.\d+)?)\s*[,，]?\s*[A]\s*[×*]\s*(?P<ohm_r>\d+(?:\.\d+)?)\s*[,，]?\s*[Ω]"
+     r"\s*=\s*(?P<ohm_v>\d+(?:\.\d+)?)\s*[,，]?\s*[V]",
+     "$V = {ohm_i}A × {ohm_r}Ω = {ohm_v}V$"),
+    (r"P\s*=\s*(?P<power_v>\d+(?:\.\d+)?)\s*[,，]?\s*[V]\s*[×*]\s*(?P<power_i>\d+(?:\.\d+)?)\s*[,，]?\s*[A]"
+     r"\s*=\s*(?P<power_p>\d+(?:\.\d+)?)\s*[,，]?\s*[W]",
+     "$P = {power_v}V × {power_i}A = {power_p}W$"),
+]
+
+# 公式の検出後に置き換える記号
+LATEX_SYMBOLS = {"\\times": "×", "\\Omega": "Ω"}
+
+# 「V = …」のような代入式（行末まで、$を含まないもの）
+ASSIGNMENT = r"[VIRPvipr]\s*=\s*[^$\n]+?(?=\n|$)"
+ASSIGNMENT_PATTERN = re.compile(r"([VIRPvipr])\s*=\s*([^$\n]+?)(?=\n|$)")
+
+
+# 公式・$・LaTeX記号・代入式の先頭になりうる文字（公式は大文字・小文字を区別しない）
+SCANNER_FIRST_CHARS = r"VIRPvipr1Σσς$\\"
+
+
+def _build_scanner(with_assignments: bool):
+    """公式・$で囲まれた部分・LaTeX記号（と代入式）を1つの正規表現にまとめる"""
+    alternatives = [f"(?P<f{i}>(?i:{pattern}))" for i, (pattern, _) in enumerate(FORMULA_PATTERNS)]
+    alternatives += [r"\$(?P<math>[^$]+)\$", r"(?P<symbol>\\times|\\Omega)"]
+    if with_assignments:
+        alternatives.append(rf"(?P<assign>{ASSIGNMENT})")
+    # 先頭になりうる文字の先読みで、数式と無関係な位置（日本語の本文など）をすぐに読み飛ばす
+    return re.compile(rf"(?=[{SCANNER_FIRST_CHARS}])(?:" + "|".join(alternatives) + ")")
+
+
+FORMULA_SCANNER = _build_scanner(with_assignments=False)
+ANSWER_SCANNER = _build_scanner(with_assignments=True)
+FORMULA_REPLACEMENTS = {f"f{i}": replacement for i, (_, replacement) in enumerate(FORMULA_PATTERNS)}
+
+# 表示用: $$…$$・[…]・$…$ の数式部分
+DISPLAY_SCANNER = re.compile(r"\$\$(?P<display>[^$]+)\$\$|\[\s*(?P<bracket>[^]]+)\s*\]|\$(?P<inline>[^$]+)\$")
+# 表示用の数式から取り除く・置き換えるLaTeX記法（この順に置き換える）
+DISPLAY_CLEANUP = (("\\times", "×"), ("\\text{", ""), ("}", ""), ("\\Omega", "Ω"), ("\\,", " "),
+                   ("\\dots", "…"), (",", ""), ("R2S", "R2"), ("\\", ""))
+DISPLAY_MATH_SPLIT = re.compile(r"\$\$([^$]+)\$\$")
+
+# Markdown用: $$…$$・[…]・$…$ の数式部分と、空の$$$$
+MARKDOWN_SCANNER = re.compile(
+    r"\$\$(?P<display>[^$]+?)\$\$|(?P<empty>\$\$\s*\$\$)|\[\s*(?P<bracket>[^\[\]]+?)\s*\]"
+    r"|(?<!\$)\$(?!\$)(?P<inline>[^$]+?)(?<!\$)\$(?!\$)"
+)
+SUBSCRIPT_PATTERN = re.compile(r"([A-Za-z])_([0-9]+)")
+
+
+def _replace_latex_escape(match):
+    text = match.group(1)
+    if text is None:
+        return LATEX_ESCAPES[match.group(0)]
+    return text.replace("\\,", " ").replace("\\dots", "…")
+
+
+def _rewrite(text: str, scanner, start: int = 0, end: int = None) -> str:
+    """
+    textのstart〜endの範囲を1回走査し、公式の統一・$で囲まれた部分とLaTeX記号の整理（・代入式の囲み）を行う
+    （範囲の外側の文字も単語境界の判定に使うため、部分文字列ではなく位置で範囲を指定する）
+    """
+    end = len(text) if end is None else end
+    pieces = []
+    position = start
+    for match in scanner.finditer(text, start, end):
+        pieces.append(text[position:match.start()])
+        kind = match.lastgroup
+        if kind == "math":
+            # 既に$で囲まれた部分も公式を統一し、R2Sの表記揺れを直す
+            inner = _rewrite(text, FORMULA_SCANNER, match.start("math"), match.end("math"))
+            pieces.append("$" + inner.replace("R2S", "R2") + "$")
+        elif kind == "symbol":
+            pieces.append(LATEX_SYMBOLS[match.group(0)])
+        elif kind == "assign":
+            # 行内の公式・記号を先に整理し、$を含まない代入式だけを囲む
+            inner = _rewrite(text, FORMULA_SCANNER, match.start(), match.end())
+            pieces.append(ASSIGNMENT_PATTERN.sub(_wrap_assignment, inner))
+        else:
+            pieces.append(FORMULA_REPLACEMENTS[kind].format_map(match.groupdict()))
+        position = match.end()
+    pieces.append(text[position:end])
+    return "".join(pieces)
+
+
+def _wrap_assignment(match):
+    return f"${match.group(1)} = {match.group(2).strip()}$"
+
+
+def enhance_math_display(text: str) -> str:
+    """
+    回答中の物理公式を検出して$記号で囲み、LaTeX記法を通常の文字に置き換える
+
+    Args:
+        text: LLMの回答
+
+    Returns:
+        表示用に整えた回答
+    """
+    if "\\" in text:
+        text = LATEX_ESCAPE_PATTERN.sub(_replace_latex_escape, text)
+    return _rewrite(text, FORMULA_SCANNER)
+
+
+def normalize_answer_math(text: str) -> str:
+    """
+    enhance_math_displayに加え、行末までの代入式（例: R = 10Ω）も$記号で囲む
+
+    Args:
+        text: LLMの回答
+
+    Returns:
+        表示用に整えた回答
+    """
+    if "\\" in text:
+        text = LATEX_ESCAPE_PATTERN.sub(_replace_latex_escape, text)
+    if "=" not in text:
+        return _rewrite(text, FORMULA_SCANNER)
+
+    if any(letter in text for letter in "VIRP"):
+        return _rewrite(text, ANSWER_SCANNER)
+
+    # 大文字の量記号は公式の統一（v = i × r → $V = I × R$）で初めて現れることがある
+    text = _rewrite(text, FORMULA_SCANNER)
+    if any(letter in text for letter in "VIRP"):
+        text = ASSIGNMENT_PATTERN.sub(_wrap_assignment, text)
+    return text
+
+
+def _clean_display_formula(formula: str) -> str:
+    for old, new in DISPLAY_CLEANUP:
+        formula = formula.replace(old, new)
+    return formula.strip()
+
+
+def prepare_math_response(response: str) -> str:
+    """
+    数式部分（$$…$$・[…]・$…$）のLaTeX記法を整理し、表示用の$$…$$ブロックに変換
+
+    Args:
+        response: 回答テキスト
+
+    Returns:
+        数式を前後の改行付き$$…$$に統一したテキスト
+    """
+    def _replace(match):
+        return f"\n\n$${_clean_display_formula(match.group(match.lastgroup))}$$\n\n"
+
+    return DISPLAY_SCANNER.sub(_replace, response)
+
+
+def split_display_math(processed_response: str) -> list:
+    """prepare_math_responseの結果を、通常のテキスト（偶数番目）と数式（奇数番目）に分割"""
+    return DISPLAY_MATH_SPLIT.split(processed_response)
+
+
+def format_latex_equations(text: str) -> str:
+    """
+    Markdown表示用に数式（$$…$$・[…]・$…$）を前後に改行を入れた$$…$$に統一し、添字をLaTeX形式にする（I_1 → I_{1}）
+
+    Args:
+        text: 回答テキスト
+
+    Returns:
+        整形したテキスト
+    """
+    def _replace(match):
+        if match.lastgroup == "empty":
+            return "$$"
+        formula = SUBSCRIPT_PATTERN.sub(r"\1_{\2}", match.group(match.lastgroup))
+        return f"\n\n$${formula}$$\n\n"
+
+    return MARKDOWN_SCANNER.sub(_replace, text)
@@ -0,0 +1,278 @@
+"""
+処理段階ごとの所要時間の計測モジュール
+PDF読み込み・テキスト分割・埋め込み・FAISS検索・質問の書き換え・回答生成・数式の整形などの段階ごとに、
+所要時間のヒストグラム（p50/p95/p99）と回数・エラー数を記録し、Prometheusのテキスト形式で出力する機能を提供
+OpenTelemetryのAPIがある場合は同じ値を記録し、SDKとOTLPの送信先が設定されていれば定期的に送信する
+（値はプロセスごと。複数ワーカーの場合はワーカーごとに集計される）
+"""
+
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+import constants as ct
+
+try:
+    from opentelemetry import metrics as otel_metrics
+    OTEL_SUPPORT = True
+except ImportError:
+    OTEL_SUPPORT = False
+
+
+def percentile(values: list, percent: float) -> float:
+    """値の一覧のパーセンタイル（最近傍法）"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+class Histogram:
+    """所要時間のヒストグラム（バケットごとの件数・合計・件数と、パーセンタイル用の直近の値）"""
+
+    def __init__(self, buckets: tuple, window: int):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def cumulative_counts(self) -> list:
+        """Prometheusの形式（その値以下の件数）のバケットごとの件数"""
+        counts, total = [], 0
+        for count in self.bucket_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class MetricsRegistry:
+    """
+    処理段階ごとの所要時間・カウンターの記録（プロセス内で共有）
+    with metrics_registry.timer("faiss_search"): のように計測したい処理を囲む（関数には@metrics_registry.timed()）
+    """
+
+    def __init__(self, buckets: tuple = ct.METRICS_LATENCY_BUCKETS, window: int = ct.METRICS_WINDOW,
+                 enabled: bool = ct.ENABLE_STAGE_METRICS):
+        self.buckets = buckets
+        self.window = window
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._histograms = {}  # 段階 -> Histogram
+        self._counters = {}  # (名前, ラベルのタプル) -> 値
+        self._collectors = {}  # 名前 -> 数値の辞書を返す関数（出力時に値を読む）
+        self._otel_histogram = None
+        self._otel_counters = {}
+        if OTEL_SUPPORT and ct.ENABLE_OTEL_METRICS:
+            # SDKが設定されるまではAPIの既定（何もしない）の実装に記録され、設定後はそちらに切り替わる
+            self._meter = otel_metrics.get_meter(ct.METRICS_NAMESPACE)
+            self._otel_histogram = self._meter.create_histogram(
+                f"{ct.METRICS_NAMESPACE}.stage.duration", unit="s", description="処理段階ごとの所要時間"
+            )
+
+    def observe(self, stage: str, seconds: float, error: bool = False):
+        """
+        段階の所要時間を記録
+
+        Args:
+            stage: 段階の名前（ct.METRICS_STAGE_LABELSのキー）
+            seconds: 所要時間（秒）
+            error: 例外で終わった場合はTrue（エラー数も数える）
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.buckets, self.window)
+            histogram.observe(seconds)
+        if self._otel_histogram is not None:
+            self._otel_histogram.record(seconds, {"stage": stage, "error": error})
+        if error:
+            self.increment("stage_errors_total", stage=stage)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """カウンターを増やす（例: increment("answers_total", answered_by="cache")）"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            counter = self._otel_counters.get(name)
+            if counter is None and self._otel_histogram is not None:
+                counter = self._otel_counters[name] = self._meter.create_counter(f"{ct.METRICS_NAMESPACE}.{name}")
+        if counter is not None:
+            counter.add(value, labels)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """囲んだ処理の所要時間を記録（例外で終わった場合はエラーとしても数え、画面の再実行などの中断は記録しない）"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.observe(stage, time.perf_counter() - started, error=True)
+            raise
+        self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage: str):
+        """関数の所要時間を記録するデコレーター"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_collector(self, name: str, collect):
+        """
+        出力時に値を読む状態（同時実行数・失敗率など）を登録（数値・真偽値以外の値は出力しない）
+
+        Args:
+            name: 出力する名前の接頭辞（例: "admission" → rag_admission_in_flight）
+            collect: 値の辞書を返す関数
+        """
+        self._collectors[name] = collect
+        if self._otel_histogram is not None:
+            def callback(options, collect=collect):
+                return [
+                    otel_metrics.Observation(float(value), {"field": key})
+                    for key, value in collect().items() if isinstance(value, (int, float))
+                ]
+            self._meter.create_observable_gauge(f"{ct.METRICS_NAMESPACE}.{name}", callbacks=[callback])
+
+    def get_stage_summary(self) -> list:
+        """
+        段階ごとの件数・エラー数・平均とp50/p95/p99（秒）とSLOの達成状況
+        （ct.METRICS_STAGE_LABELSの順、それ以外の段階は後ろに並べる）
+        """
+        with self._lock:
+            histograms = {stage: (histogram.count, histogram.sum, list(histogram.recent))
+                          for stage, histogram in self._histograms.items()}
+            errors = {dict(labels).get("stage"): value for (name, labels), value in self._counters.items()
+                      if name == "stage_errors_total"}
+
+        order = list(ct.METRICS_STAGE_LABELS)
+        summary = []
+        for stage in sorted(histograms, key=lambda stage: (order.index(stage) if stage in order else len(order), stage)):
+            count, total, recent = histograms[stage]
+            p95 = percentile(recent, 95)
+            slo = ct.METRICS_STAGE_SLO_P95_SECONDS.get(stage)
+            summary.append({
+                "stage": stage,
+                "label": ct.METRICS_STAGE_LABELS.get(stage, stage),
+                "count": count,
+                "errors": errors.get(stage, 0),
+                "mean_seconds": total / count,
+                "p50_seconds": percentile(recent, 50),
+                "p95_seconds": p95,
+                "p99_seconds": percentile(recent, 99),
+                "slo_p95_seconds": slo,
+                "slo_met": None if slo is None else p95 <= slo,
+            })
+        return summary
+
+    def to_prometheus(self) -> str:
+        """記録した値をPrometheusのテキスト形式（バージョン0.0.4）で出力"""
+        prefix = ct.METRICS_NAMESPACE
+        lines = []
+        with self._lock:
+            histograms = [(stage, histogram.cumulative_counts(), histogram.count, histogram.sum)
+                          for stage, histogram in sorted(self._histograms.items())]
+            counters = sorted(self._counters.items())
+
+        name = f"{prefix}_stage_duration_seconds"
+        lines.append(f"# HELP {name} 処理段階ごとの所要時間（秒）")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, cumulative, count, total in histograms:
+            for bound, bucket_count in zip(self.buckets, cumulative):
+                lines.append(f"{name}_bucket{_format_labels({'stage': stage, 'le': f'{bound:g}'})} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels({'stage': stage, 'le': '+Inf'})} {count}")
+            lines.append(f"{name}_sum{_format_labels({'stage': stage})} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels({'stage': stage})} {count}")
+
+        typed = set()
+        for (counter_name, labels), value in counters:
+            name = f"{prefix}_{counter_name}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(dict(labels))} {value:g}")
+
+        for collector_name, collect in sorted(self._collectors.items()):
+            try:
+                values = collect()
+            except Exception:
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{collector_name}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """記録した所要時間・カウンターを消去（登録した状態の読み出しは残す）"""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+_otel_configured = False
+
+
+def configure_otel_exporter() -> bool:
+    """
+    環境変数OTEL_EXPORTER_OTLP_ENDPOINTが設定され、OpenTelemetryのSDKとOTLPエクスポーターがある場合に、
+    記録した値を定期的に送信するよう設定（プロセスで1回だけ。設定した場合はTrue）
+    """
+    global _otel_configured
+    if _otel_configured:
+        return True
+    if not OTEL_SUPPORT or not ct.ENABLE_OTEL_METRICS or not os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return False
+    try:
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+    except ImportError:
+        return False
+
+    reader = PeriodicExportingMetricReader(
+        OTLPMetricExporter(), export_interval_millis=ct.OTEL_EXPORT_INTERVAL_SECONDS * 1000
+    )
+    resource = Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", ct.METRICS_NAMESPACE)})
+    otel_metrics.set_meter_provider(MeterProvider(resource=resource, metric_readers=[reader]))
+    _otel_configured = True
+    return True
+
+
+# グローバルインスタンス（プロセス内の全セッションで共有）
+metrics_registry = MetricsRegistry()
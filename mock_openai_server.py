@@ -0,0 +1,436 @@
+"""
+このファイルは、オフラインでの性能試験用のOpenAI互換スタブサーバーです。
+アプリが利用するチャット（/v1/chat/completions）と埋め込み（/v1/embeddings）のエンドポイントを実装します。
+
+起動例:
+    python mock_openai_server.py --port 8001 --latency-ms 300 --tokens-per-sec 60 --error-rate 0.02
+
+アプリ側は環境変数「OPENAI_BASE_URL=http://127.0.0.1:8001/v1」を設定すると、このサーバーに接続します。
+
+動作モード:
+    synthetic: 決定的な合成レスポンスを返す（既定）
+    record:    上流のOpenAI APIに転送し、レスポンスをフィクスチャとして保存する
+    replay:    保存済みのフィクスチャを返す（見つからない場合は --replay-miss に従う）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import constants as ct
+
+
+############################################################
+# 共通処理
+############################################################
+
+def estimate_tokens(text):
+    """
+    トークン数の概算（英数字は4文字で1トークン、日本語等は1文字1トークン）
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return max(1, ascii_chars // 4 + (len(text) - ascii_chars))
+
+
+def message_text(message):
+    """
+    チャットメッセージの本文を文字列として取得（content配列形式にも対応）
+    """
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content)
+
+
+def hash_embedding(text, dimensions):
+    """
+    文字バイグラムのハッシュから決定的な埋め込みベクトルを作成（語彙が近い文ほど類似度が高くなる）
+    """
+    vector = [0.0] * dimensions
+    text = text or " "
+    grams = [text[i:i + 2] for i in range(max(1, len(text) - 1))]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dimensions
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def fixture_key(endpoint, body):
+    """
+    リクエスト内容からフィクスチャのキーを作成（ストリーミング指定の有無は区別しない）
+    """
+    normalized = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+    payload = json.dumps({"endpoint": endpoint, "body": normalized}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StubError(Exception):
+    """スタブサーバーが返すOpenAI形式のエラー"""
+
+    def __init__(self, status, message, error_type="server_error"):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.error_type = error_type
+
+
+############################################################
+# スタブサーバー本体
+############################################################
+
+class StubBackend:
+    """レスポンス生成（合成・記録・再生）と遅延・エラー注入を担当するクラス"""
+
+    def __init__(self, config):
+        self.config = config
+        self.fixtures_dir = Path(config.fixtures)
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.seen_prefixes = set()
+        self.stats = {"requests": 0, "errors_injected": 0, "fixtures_recorded": 0, "fixtures_replayed": 0}
+
+    # ------------------------------------------
+    # 遅延・エラー注入
+    # ------------------------------------------
+    def _chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def inject_faults(self):
+        """設定された確率でエラーを発生させる"""
+        with self.lock:
+            self.stats["requests"] += 1
+        if self.config.error_rate and self._chance(self.config.error_rate):
+            with self.lock:
+                self.stats["errors_injected"] += 1
+                status = self.random.choice(self.config.error_statuses)
+            if status == 429:
+                raise StubError(429, "Rate limit reached (injected by stub)", "rate_limit_exceeded")
+            raise StubError(status, f"Injected upstream failure ({status})")
+
+    def first_token_delay(self):
+        """最初のトークンまでの待ち時間（秒）"""
+        with self.lock:
+            jitter = self.random.uniform(0, self.config.latency_jitter_ms)
+            slow = self.config.slow_rate and self.random.random() < self.config.slow_rate
+        delay_ms = self.config.latency_ms + jitter + (self.config.slow_ms if slow else 0)
+        return delay_ms / 1000
+
+    def token_interval(self):
+        """トークン1個あたりの生成時間（秒）"""
+        if self.config.tokens_per_sec <= 0:
+            return 0.0
+        return 1.0 / self.config.tokens_per_sec
+
+    # ------------------------------------------
+    # フィクスチャ（記録・再生）
+    # ------------------------------------------
+    def _fixture_path(self, endpoint, body):
+        return self.fixtures_dir / endpoint.strip("/").replace("/", "_") / f"{fixture_key(endpoint, body)}.json"
+
+    def load_fixture(self, endpoint, body):
+        path = self._fixture_path(endpoint, body)
+        if not path.exists():
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            fixture = json.load(f)
+        with self.lock:
+            self.stats["fixtures_replayed"] += 1
+        return fixture["response"]
+
+    def save_fixture(self, endpoint, body, response):
+        path = self._fixture_path(endpoint, body)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"endpoint": endpoint, "request": body, "response": response}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.stats["fixtures_recorded"] += 1
+
+    def forward_upstream(self, endpoint, body):
+        """上流のOpenAI APIへ非ストリーミングで転送"""
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise StubError(500, "record mode requires OPENAI_API_KEY for the upstream API")
+        upstream_body = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+        request = urllib.request.Request(
+            self.config.upstream.rstrip("/") + endpoint,
+            data=json.dumps(upstream_body).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.config.upstream_timeout) as res:
+                return json.loads(res.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            raise StubError(e.code, e.read().decode("utf-8", "replace"), "upstream_error")
+
+    def resolve(self, endpoint, body, synthesize):
+        """モードに応じてレスポンスを取得（記録・再生・合成）"""
+        if self.config.mode == "record":
+            response = self.forward_upstream(endpoint, body)
+            self.save_fixture(endpoint, body, response)
+            return response
+        if self.config.mode == "replay":
+            response = self.load_fixture(endpoint, body)
+            if response is not None:
+                return response
+            if self.config.replay_miss == "error":
+                raise StubError(404, f"No fixture recorded for this request ({fixture_key(endpoint, body)})", "fixture_not_found")
+        return synthesize(body)
+
+    # ------------------------------------------
+    # 合成レスポンス
+    # ------------------------------------------
+    def synthesize_chat(self, body):
+        messages = body.get("messages") or []
+        question = message_text(messages[-1]) if messages else ""
+        prompt_tokens = sum(estimate_tokens(message_text(m)) for m in messages)
+
+        # プロンプトキャッシュの模擬（先頭メッセージが同一で1024トークン以上なら128トークン単位でキャッシュ扱い）
+        cached_tokens = 0
+        if messages:
+            prefix = message_text(messages[0])
+            prefix_tokens = estimate_tokens(prefix)
+            prefix_hash = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+            with self.lock:
+                seen = prefix_hash in self.seen_prefixes
+                self.seen_prefixes.add(prefix_hash)
+            if seen and prompt_tokens >= 1024:
+                cached_tokens = (prefix_tokens // 128) * 128
+
+        summary = " ".join(question.split())[:80]
+        content = (
+            f"（スタブ応答）ご質問「{summary}」について回答します。\n\n"
+            "### 重要ポイント\n"
+            "オームの法則は $V = I × R$ で表されます。\n"
+            "例えば電流2A、抵抗5Ωのとき、$V = 2A × 5Ω = 10V$ です。\n\n"
+            "電力は $P = V × I$ で求められます。"
+        )
+        completion_tokens = estimate_tokens(content)
+        return {
+            "id": f"chatcmpl-stub-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", ct.OPENAI_CHAT_MODEL),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    def synthesize_embeddings(self, body):
+        inputs = body.get("input")
+        # 文字列・文字列リスト・トークンID配列のいずれにも対応
+        if isinstance(inputs, str) or (isinstance(inputs, list) and inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimensions = body.get("dimensions") or self.config.dimensions
+        data = []
+        total_tokens = 0
+        for i, item in enumerate(inputs or []):
+            text = item if isinstance(item, str) else " ".join(str(t) for t in item)
+            total_tokens += estimate_tokens(text) if isinstance(item, str) else len(item)
+            data.append({"object": "embedding", "index": i, "embedding": hash_embedding(text, dimensions)})
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", ct.OPENAI_EMBEDDING_MODEL),
+            "usage": {"prompt_tokens": total_tokens, "total_tokens": total_tokens},
+        }
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """OpenAI互換APIのHTTPハンドラ"""
+
+    protocol_version = "HTTP/1.1"
+    backend = None
+
+    def log_message(self, format, *args):
+        if not self.backend.config.quiet:
+            super().log_message(format, *args)
+
+    # ------------------------------------------
+    # 送信処理
+    # ------------------------------------------
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, error):
+        self._send_json(error.status, {
+            "error": {"message": error.message, "type": error.error_type, "param": None, "code": error.error_type}
+        })
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        return json.loads(raw.decode("utf-8"))
+
+    # ------------------------------------------
+    # エンドポイント
+    # ------------------------------------------
+    def do_GET(self):
+        if self.path.rstrip("/") in ("/health", "/v1/health"):
+            self._send_json(200, {"status": "ok", "mode": self.backend.config.mode, "stats": self.backend.stats})
+        elif self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [
+                {"id": ct.OPENAI_CHAT_MODEL, "object": "model", "owned_by": "stub"},
+                {"id": ct.OPENAI_EMBEDDING_MODEL, "object": "model", "owned_by": "stub"},
+            ]})
+        else:
+            self._send_error(StubError(404, f"Unknown path: {self.path}", "not_found"))
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        endpoint = path[len("/v1"):] if path.startswith("/v1") else path
+        try:
+            body = self._read_body()
+            self.backend.inject_faults()
+            if endpoint == "/chat/completions":
+                self._handle_chat(endpoint, body)
+            elif endpoint == "/embeddings":
+                self._handle_embeddings(endpoint, body)
+            else:
+                raise StubError(404, f"Unknown path: {self.path}", "not_found")
+        except StubError as e:
+            self._send_error(e)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            self._send_error(StubError(500, f"Stub server error: {e}"))
+
+    def _handle_embeddings(self, endpoint, body):
+        time.sleep(self.backend.first_token_delay())
+        response = self.backend.resolve(endpoint, body, self.backend.synthesize_embeddings)
+        if body.get("encoding_format") == "base64":
+            # openaiクライアントの既定形式（float32リトルエンディアンのbase64）
+            for item in response["data"]:
+                if isinstance(item["embedding"], list):
+                    vector = item["embedding"]
+                    item["embedding"] = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+        self._send_json(200, response)
+
+    def _handle_chat(self, endpoint, body):
+        time.sleep(self.backend.first_token_delay())
+        response = self.backend.resolve(endpoint, body, self.backend.synthesize_chat)
+        interval = self.backend.token_interval()
+        content = response["choices"][0]["message"].get("content") or ""
+
+        if not body.get("stream"):
+            time.sleep(interval * response.get("usage", {}).get("completion_tokens", estimate_tokens(content)))
+            self._send_json(200, response)
+            return
+
+        # ストリーミング（Server-Sent Events）で1トークンずつ送信
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        base_chunk = {
+            "id": response.get("id", f"chatcmpl-stub-{uuid.uuid4().hex[:12]}"),
+            "object": "chat.completion.chunk",
+            "created": response.get("created", int(time.time())),
+            "model": response.get("model", body.get("model")),
+        }
+
+        def send_event(payload):
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        send_event({**base_chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        step = 2  # 日本語はおおよそ1〜2文字で1トークン
+        for i in range(0, len(content), step):
+            time.sleep(interval)
+            send_event({**base_chunk, "choices": [{"index": 0, "delta": {"content": content[i:i + step]}, "finish_reason": None}]})
+        send_event({**base_chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send_event({**base_chunk, "choices": [], "usage": response.get("usage")})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+############################################################
+# 起動処理
+############################################################
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="OpenAI互換スタブサーバー（オフライン性能試験用）")
+    parser.add_argument("--host", default=ct.STUB_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=ct.STUB_SERVER_PORT)
+    parser.add_argument("--mode", choices=["synthetic", "record", "replay"], default="synthetic")
+    parser.add_argument("--fixtures", default=ct.STUB_FIXTURES_DIR, help="フィクスチャの保存ディレクトリ")
+    parser.add_argument("--replay-miss", choices=["synthetic", "error"], default="synthetic",
+                        help="replayモードでフィクスチャが無い場合の動作")
+    parser.add_argument("--upstream", default="https://api.openai.com/v1", help="recordモードの転送先")
+    parser.add_argument("--upstream-timeout", type=float, default=60.0)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="最初のトークンまでの基本遅延")
+    parser.add_argument("--latency-jitter-ms", type=float, default=100.0, help="遅延に加える一様乱数の幅")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="低速応答（テール遅延）を発生させる確率")
+    parser.add_argument("--slow-ms", type=float, default=3000.0, help="低速応答時に追加する遅延")
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0, help="生成トークンの速度（0で待ち時間なし）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラーを注入する確率")
+    parser.add_argument("--error-statuses", type=lambda s: [int(x) for x in s.split(",")], default=[429, 500, 503])
+    parser.add_argument("--dimensions", type=int, default=ct.STUB_EMBEDDING_DIMENSIONS)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--quiet", action="store_true", help="アクセスログを出力しない")
+    return parser
+
+
+def create_server(config):
+    """
+    設定からHTTPサーバーを作成（ベンチマーク等からスレッドで起動する場合にも利用）
+    """
+    handler = type("ConfiguredStubRequestHandler", (StubRequestHandler,), {"backend": StubBackend(config)})
+    server = ThreadingHTTPServer((config.host, config.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    config = build_arg_parser().parse_args(argv)
+    server = create_server(config)
+    print(f"OpenAIスタブサーバーを起動しました: http://{config.host}:{server.server_port}/v1 (mode={config.mode})")
+    print(f"アプリ側の設定例: OPENAI_BASE_URL=http://{config.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+質問文の正規化モジュール
+全角・半角、単位の読み方、丁寧語・つなぎの言葉の違いを吸収し、キャッシュの検索キーを統一する機能を提供
+"""
+
+import re
+import unicodedata
+
+
+# 単位・接頭辞の読み方を記号に統一（数値の直後のみ）
+UNIT_WORDS = [
+    (re.compile(r"(\d)\s*キロ"), r"\1k"),
+    (re.compile(r"(\d)\s*メガ"), r"\1M"),
+    (re.compile(r"(\d)\s*ミリ"), r"\1m"),
+    (re.compile(r"(\d)\s*マイクロ"), r"\1μ"),
+    (re.compile(r"([\dkMmμ])\s*オーム"), r"\1Ω"),
+    (re.compile(r"([\dkMmμ])\s*ボルト"), r"\1V"),
+    (re.compile(r"([\dkMmμ])\s*アンペア"), r"\1A"),
+    (re.compile(r"([\dkMmμ])\s*ワット"), r"\1W"),
+]
+
+# 数値と単位の間の空白を除き、キロの接頭辞「K」を「k」に統一（例: 2 KΩ → 2kΩ）
+UNIT_SPACING = re.compile(r"(\d)\s+(?=[kKMmμu]?(?:Ω|V|A|W)(?![A-Za-z]))")
+UPPER_KILO = re.compile(r"(?<=\d)K(?=Ω|V|W)")
+
+# 文頭のつなぎの言葉
+LEADING_FILLERS = re.compile(
+    r"^(?:(?:すみません|すいません|あの|えっと|えーと|ちょっと|質問です|質問があります|先生)[、,。\s]*)+"
+)
+
+# 文末の丁寧語・依頼表現・記号（文末から繰り返し取り除く）
+TRAILING_FILLERS = re.compile(
+    r"(?:"
+    r"について(?:教えて|知りたい)[^、。]*"
+    r"|を?教えて(?:ください|下さい|くれませんか|もらえますか|いただけますか|ほしい|欲しい)?"
+    r"|を?説明して(?:ください|下さい|もらえますか|いただけますか)?"
+    r"|とは何ですか|とはなんですか|って何ですか|ってなんですか|とは何|とは"
+    r"|でしょうか|ですか|ますか|ですね|です|ください|下さい|お願いします|よろしく"
+    r"|(?<=\S)[はを]"
+    r"|[?？!！。.、,\s]+"
+    r")$"
+)
+
+INNER_SPACES = re.compile(r"\s+")
+# 日本語の文字の間の空白は意味を持たないため除く
+CJK_SPACES = re.compile(r"(?<=[^\x00-\x7F])\s+|\s+(?=[^\x00-\x7F])")
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角と単位の読み方を統一（数値や単位の意味は変えない）"""
+    text = unicodedata.normalize("NFKC", text)
+    for pattern, replacement in UNIT_WORDS:
+        text = pattern.sub(replacement, text)
+    text = UNIT_SPACING.sub(r"\1", text)
+    return UPPER_KILO.sub("k", text)
+
+
+def canonicalize_query(text: str) -> str:
+    """
+    キャッシュの検索キー用に質問文を正規化
+
+    Args:
+        text: ユーザーの質問文
+
+    Returns:
+        正規化した質問文（例: 「すみません、２ＫΩの抵抗に１０ボルトを加えたときの電流を教えてください？」
+        → 「2kΩの抵抗に10Vを加えたときの電流」）
+    """
+    normalized = CJK_SPACES.sub("", INNER_SPACES.sub(" ", normalize_text(text).strip()))
+    text = LEADING_FILLERS.sub("", normalized)
+
+    while True:
+        stripped = TRAILING_FILLERS.sub("", text)
+        if stripped == text:
+            break
+        text = stripped
+
+    # つなぎの言葉だけの入力は、元の文を正規化したものをそのまま使う
+    return text or normalized
@@ -0,0 +1,576 @@
+"""
+RAGパイプラインモジュール
+FAISS検索→教科書内容の整形→回答生成の処理を、Streamlitに依存しない関数として提供
+（画面（main.py）とHTTP API（api_server.py）の両方から利用する。状態・エラーの表示は呼び出し元が行う）
+"""
+
+import asyncio
+import threading
+import time
+from contextlib import nullcontext
+from functools import partial
+
+import constants as ct
+import llm_client
+from admission import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, AdmissionRejected, RequestCancelled, Slot, admission_controller, describe_wait
+from circuit_breaker import generation_breaker
+from llm_resilience import resilient_invoker
+from chunk_preprocessor import get_cleaned_text, get_key_points
+from math_normalizer import enhance_math_display, normalize_answer_math, prepare_math_response
+from metrics import metrics_registry
+
+
+class GenerationUnavailable(RuntimeError):
+    """LLMで回答を生成できない（呼び出し元は教科書の抜粋で回答する）"""
+
+
+class DailyLimitError(GenerationUnavailable):
+    """日次のAPI使用制限に達したため、LLMを呼び出せない"""
+
+
+class CircuitOpenError(GenerationUnavailable):
+    """LLMの失敗・遅延が続いているため、サーキットブレーカーが呼び出しを止めている"""
+
+
+class GenerationFailed(GenerationUnavailable):
+    """再試行しても回答を生成できなかった（元の例外は__cause__）"""
+
+
+def search(vectorstore, query: str, k: int = ct.FAISS_SEARCH_K) -> list:
+    """
+    FAISSで類似度検索し、結果を整形
+
+    Args:
+        vectorstore: FAISSのベクターストア
+        query: 検索クエリ
+        k: 取得件数
+
+    Returns:
+        検索結果（content・metadata・similarity_score・search_type）のリスト
+    """
+    if vectorstore is None:
+        return []
+
+    # 質問の埋め込み（API・キャッシュ）とFAISSの検索を分けて計測
+    with metrics_registry.timer("query_embedding"):
+        embedding = vectorstore.embeddings.embed_query(query)
+    with metrics_registry.timer("faiss_search"):
+        docs_and_scores = vectorstore.similarity_search_with_score_by_vector(embedding, k=k)
+
+    return [
+        {
+            'content': doc.page_content,
+            'metadata': doc.metadata,
+            'similarity_score': score,
+            'search_type': 'FAISS similarity'
+        }
+        for doc, score in docs_and_scores
+    ]
+
+
+def build_context(search_results: list) -> str:
+    """回答生成に渡す教科書の内容（最大3つの検索結果の整形テキストと出典）"""
+    context_content = []
+    for result in search_results[:3]:
+        source_file = result['metadata'].get('source_file', 'unknown')
+        context_content.append(f"【出典: {source_file}】\n{get_cleaned_text(result)}")
+    return "\n\n".join(context_content)
+
+
+def build_student_messages(query: str, context_text: str):
+    """工業高校生向けの回答を依頼するプロンプト"""
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    # 入力パラメータの検証
+    if not query:
+        query = "質問内容なし"
+    if not context_text:
+        context_text = "関連する教科書の内容が見つかりませんでした。"
+
+    # 不変の指導方針をシステムメッセージの接頭辞とし、質問・教科書内容は後ろに置く
+    # （OpenAIの自動プロンプトキャッシュが接頭辞を再利用できるようにする）
+    try:
+        return [
+            SystemMessage(content=ct.SYSTEM_PROMPT_STUDENT_FRIENDLY),
+            HumanMessage(content=ct.USER_PROMPT_STUDENT_FRIENDLY.format(
+                query=query,
+                context=context_text
+            ))
+        ]
+    except (KeyError, IndexError, ValueError):
+        # テンプレートの書式に誤りがある場合のフォールバック用の簡単なプロンプト
+        return f"""工業高校生向けに分かりやすく回答してください。
+
+質問: {query}
+
+教科書の内容: {context_text}
+
+数式は$記号で囲んで表示してください（例：$V = I × R$）。"""
+
+
+def admit(user_id: str = None, notify=None, priority: int = PRIORITY_INTERACTIVE, is_cancelled=None):
+    """
+    LLMの呼び出しを受付制御で囲むコンテキストマネージャー（待つ間は順番と待ち時間の見込みをnotifyに渡す）
+    受付済みのSlotを返す（slot.remaining()を呼び出しのタイムアウトに使う）
+
+    Raises:
+        admission.AdmissionRejected: 利用者の枠の回復・待ち行列の待ち時間が長すぎる、または期限切れの場合
+        admission.RequestCancelled: 待つ間に依頼元が無くなった場合
+    """
+    if not ct.ENABLE_ADMISSION_CONTROL:
+        return nullcontext(Slot(priority, time.monotonic() + admission_controller.deadline_seconds[priority]))
+
+    on_wait = (lambda position, seconds: notify(describe_wait(position, seconds))) if notify else None
+    return admission_controller.admit(user_id, on_wait, priority, is_cancelled=is_cancelled)
+
+
+async def _acquire_async(user_id: str = None) -> Slot:
+    """
+    受付を待つ（イベントループを止めないようスレッドで待つ）
+    待つ間に呼び出し元が取り消された場合（接続の切断など）は待ち行列から抜け、取り消し後に受け付けられた枠は返す
+    """
+    if not ct.ENABLE_ADMISSION_CONTROL:
+        return Slot(PRIORITY_INTERACTIVE, time.monotonic() + admission_controller.deadline_seconds[PRIORITY_INTERACTIVE])
+
+    cancelled = threading.Event()
+    future = asyncio.get_running_loop().run_in_executor(
+        None, partial(admission_controller.acquire, user_id, is_cancelled=cancelled.is_set)
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancelled.set()
+        future.add_done_callback(
+            lambda done: admission_controller.release(done.result()) if not done.exception() else None
+        )
+        raise
+
+
+def _release(slot: Slot):
+    if ct.ENABLE_ADMISSION_CONTROL:
+        admission_controller.release(slot)
+
+
+def _create_student_llm(**kwargs):
+    # 再試行はllm_resilienceで行う（クライアント側の再試行と重ねない）
+    return llm_client.create_chat_llm(
+        model=ct.OPENAI_CHAT_MODEL,
+        temperature=ct.OPENAI_TEMPERATURE,
+        max_tokens=ct.OPENAI_MAX_TOKENS,
+        max_retries=0,
+        **kwargs
+    )
+
+
+def _record_response(query: str, response, latency_ms: float):
+    """API使用量（トークン数・プロンプトキャッシュのヒット分・モデル・レイテンシ）を記録し、回答をキャッシュ"""
+    from cost_optimizer import cost_optimizer, extract_token_usage, extract_model_name
+
+    cost_optimizer.record_usage(
+        extract_token_usage(response),
+        model=extract_model_name(response, ct.OPENAI_CHAT_MODEL),
+        latency_ms=latency_ms
+    )
+    cost_optimizer.cache_response(query, response.content)
+
+
+def _allow_generation():
+    """サーキットブレーカーが止めている場合はCircuitOpenErrorを送出（通した場合は結果を必ず記録する）"""
+    if ct.ENABLE_GENERATION_BREAKER and not generation_breaker.allow_request():
+        raise CircuitOpenError(generation_breaker.get_status()["reason"] or "一時停止中")
+
+
+def _record_generation(started: float, error: BaseException = None):
+    """
+    回答生成の結果をサーキットブレーカーに記録
+
+    Args:
+        started: LLMの呼び出しを始めた時刻（time.perf_counter()の値。呼び出す前に終わった場合はNone）
+        error: 失敗した場合の例外
+    """
+    if not ct.ENABLE_GENERATION_BREAKER:
+        return
+    if started is None or isinstance(error, (AdmissionRejected, RequestCancelled)) or (
+            error is not None and not isinstance(error, Exception)):
+        # 受付で断られた・取り消された・画面の再実行などで中断された場合は、LLMの状態の判断に使わない
+        generation_breaker.record_ignored()
+    elif error is not None:
+        generation_breaker.record_failure(error)
+    else:
+        generation_breaker.record_success(time.perf_counter() - started)
+
+
+def _generation_deadline(slot: Slot) -> float:
+    """回答生成の期限（生徒の質問は、順番待ちの後に回答生成にかけてよい時間も超えない）"""
+    if slot.priority != PRIORITY_INTERACTIVE:
+        return slot.deadline
+    return min(slot.deadline, time.monotonic() + ct.GENERATION_LATENCY_BUDGET_SECONDS)
+
+
+async def _ainvoke_student_llm(messages, deadline: float):
+    """
+    期限（順番待ちで使った分を除いた残り）の範囲で、再試行・ヘッジ付きで回答を生成
+    （llm_client.run_asyncで実行する。再試行・ヘッジの2本目も含め、プロセスで共有する接続プールを使う）
+    """
+    http_client = llm_client.get_async_http_client()
+    return await resilient_invoker.ainvoke(
+        lambda timeout: _create_student_llm(timeout=timeout, http_async_client=http_client).ainvoke(messages),
+        deadline
+    )
+
+
+def generate_student_answer(query: str, context_text: str, notify=None, user_id: str = None,
+                            priority: int = PRIORITY_INTERACTIVE, is_cancelled=None) -> str:
+    """
+    工業高校生向けの回答を生成（キャッシュがあればAPIを使わない）
+
+    Args:
+        query: 質問
+        context_text: 教科書の内容
+        notify: 処理状況のメッセージを受け取る関数（画面表示用、省略可）
+        user_id: 受付制御で枠を数える利用者の識別子（Noneの場合は同時実行数の制限のみ）
+        priority: PRIORITY_INTERACTIVE（生徒の質問）またはPRIORITY_BACKGROUND（FAQ事前生成・一括評価）
+        is_cancelled: 依頼元が無くなった場合にTrueを返す関数（順番待ちの間に確認する）
+
+    Returns:
+        回答
+
+    Raises:
+        DailyLimitError: 日次のAPI使用制限に達している場合
+        CircuitOpenError: サーキットブレーカーがLLMの呼び出しを止めている場合
+        GenerationFailed: 再試行・回答生成にかけてよい時間の範囲で回答を生成できなかった場合
+        admission.AdmissionRejected: 受付制御で受け付けられなかった場合
+        admission.RequestCancelled: 順番待ちの間に依頼元が無くなった場合
+    """
+    from cost_optimizer import cost_optimizer
+
+    notify = notify or (lambda message: None)
+
+    # キャッシュされた回答をチェック
+    cached_response = cost_optimizer.get_cached_response(query)
+    if cached_response:
+        notify("💰 キャッシュから回答を取得（API使用なし）")
+        return cached_response
+
+    # 日次制限をチェック（達した制限の内容は、教科書の抜粋で回答する際に表示する）
+    limit_message = cost_optimizer.get_daily_limit_message()
+    if limit_message:
+        raise DailyLimitError(limit_message)
+
+    messages = build_student_messages(query, context_text)
+    _allow_generation()
+
+    started = None
+    try:
+        with admit(user_id, notify, priority, is_cancelled) as slot:
+            notify("🤖 GPT-4o-miniで回答生成中...")
+            started = time.perf_counter()
+            with metrics_registry.timer("generation"):
+                response = llm_client.run_async(_ainvoke_student_llm(messages, _generation_deadline(slot)))
+    except BaseException as e:
+        _record_generation(started, e)
+        if started is None or not isinstance(e, Exception):
+            raise
+        raise GenerationFailed(f"回答の生成に失敗しました: {type(e).__name__}") from e
+    _record_generation(started)
+    _record_response(query, response, (time.perf_counter() - started) * 1000)
+
+    return response.content
+
+
+async def astream_student_answer(query: str, context_text: str, user_id: str = None):
+    """
+    工業高校生向けの回答を、生成された順に少しずつ返す（非同期ジェネレーター）
+
+    Args:
+        query: 質問
+        context_text: 教科書の内容
+        user_id: 受付制御で枠を数える利用者の識別子
+
+    Yields:
+        回答の断片（キャッシュがある場合は回答全体を1回で返す）
+
+    Raises:
+        DailyLimitError: 日次のAPI使用制限に達している場合
+        CircuitOpenError: サーキットブレーカーがLLMの呼び出しを止めている場合
+        GenerationFailed: 回答を生成できなかった場合（断片を返した後に失敗することもある）
+        admission.AdmissionRejected: 受付制御で受け付けられなかった場合
+    """
+    from cost_optimizer import cost_optimizer
+
+    cached_response = cost_optimizer.get_cached_response(query)
+    if cached_response:
+        yield cached_response
+        return
+
+    limit_message = cost_optimizer.get_daily_limit_message()
+    if limit_message:
+        raise DailyLimitError(limit_message)
+
+    messages = build_student_messages(query, context_text)
+    _allow_generation()
+    try:
+        slot = await _acquire_async(user_id)
+    except BaseException as e:
+        _record_generation(None, e)
+        raise
+
+    started = time.perf_counter()
+    response = None
+    recorded = False
+    try:
+        # ストリーミングでもトークン使用量を受け取れるようにする（最初の断片より前のエラーは再試行）
+        stream = resilient_invoker.astream(
+            lambda timeout: _create_student_llm(stream_usage=True, timeout=timeout).astream(messages),
+            _generation_deadline(slot)
+        )
+        async for chunk in stream:
+            if not recorded:
+                # ストリーミングは最初の断片までの時間で、LLMの応答の遅さを判断する
+                _record_generation(started)
+                metrics_registry.observe("time_to_first_token", time.perf_counter() - started)
+                recorded = True
+            response = chunk if response is None else response + chunk
+            if chunk.content:
+                yield chunk.content
+    except BaseException as e:
+        if not recorded:
+            _record_generation(started, e)
+        if not isinstance(e, Exception):
+            raise
+        metrics_registry.observe("generation", time.perf_counter() - started, error=True)
+        raise GenerationFailed(f"回答の生成に失敗しました: {type(e).__name__}") from e
+    finally:
+        _release(slot)
+
+    metrics_registry.observe("generation", time.perf_counter() - started)
+    if response is not None:
+        _record_response(query, response, (time.perf_counter() - started) * 1000)
+
+
+def format_search_answer(query: str, search_results: list) -> str:
+    """教科書検索モードの回答（検索結果ごとの重要ポイントと整形テキスト。LLMは使わない）"""
+    response = f"## 📚「{query}」に関連する教科書の内容\n\n"
+
+    for i, result in enumerate(search_results, 1):
+        # インデックス作成時に整形・抽出済みのテキストと重要ポイント
+        cleaned_content = get_cleaned_text(result)
+        key_points = get_key_points(result)
+
+        score = result['similarity_score']
+        source_file = result['metadata'].get('source_file', 'unknown')
+
+        response += f"### 📖 検索結果 {i} (類似度: {score:.3f})\n"
+        response += f"**出典**: {source_file}\n\n"
+
+        # 重要ポイントがあれば最初に表示
+        if key_points:
+            response += "**重要ポイント**:\n"
+            for point in key_points[:3]:  # 最大3つ
+                response += f"- {point}\n"
+            response += "\n"
+
+        # 整形されたテキスト
+        if len(cleaned_content) > 400:
+            response += f"**内容**: {cleaned_content[:400]}...\n\n"
+        else:
+            response += f"**内容**: {cleaned_content}\n\n"
+
+        response += "---\n\n"
+
+    return response
+
+
+def format_references(search_results: list) -> str:
+    """問い合わせモードの回答の末尾に付ける、参考にした教科書の内容"""
+    references = "\n\n---\n\n**📚 参考にした教科書の内容**:\n"
+    for i, result in enumerate(search_results[:2], 1):
+        source_file = result['metadata'].get('source_file', 'unknown')
+        score = result['similarity_score']
+        preview = get_cleaned_text(result)[:150] + "..."
+        references += f"\n{i}. **{source_file}** (関連度: {score:.1f})\n{preview}\n"
+    return references
+
+
+def format_degraded_answer(query: str, search_results: list, reason) -> str:
+    """LLMで回答を生成できない場合の回答（理由の表示＋教科書検索モードと同じ教科書の抜粋）"""
+    banner = ct.DEGRADED_ANSWER_BANNER.format(reason=str(reason).rstrip("。"))
+    return f"> {banner}\n\n" + format_search_answer(query, search_results)
+
+
+def finish_student_answer(answer: str, search_results: list) -> str:
+    """生成した回答の数式表示を整え（公式・代入式を$記号で囲む）、参考情報を追加"""
+    with metrics_registry.timer("math_postprocess"):
+        answer = normalize_answer_math(answer)
+    return answer + format_references(search_results)
+
+
+def build_solver_context(solution: dict, search_results: list) -> str:
+    """回路計算ソルバーの結果の解説を依頼する際の教科書の内容（計算はソルバーの結果を正とする）"""
+    context_content = [f"【自動計算の結果（この数値を使って解説すること）】\n{solution['answer']}"]
+    for result in search_results[:2]:
+        source_file = result['metadata'].get('source_file', 'unknown')
+        context_content.append(f"【出典: {source_file}】\n{get_cleaned_text(result)}")
+    return "\n\n".join(context_content)
+
+
+def finish_solver_answer(solution: dict, explanation: str = None) -> str:
+    """回路計算ソルバーの回答（LLMの解説がある場合は後ろに追加）"""
+    if explanation is None:
+        return solution["answer"]
+    with metrics_registry.timer("math_postprocess"):
+        explanation = enhance_math_display(explanation)
+    return solution["answer"] + "\n\n---\n\n### 💡 解説\n\n" + explanation
+
+
+def answer_question(vectorstore, query: str, mode: str, notify=None, priority: int = PRIORITY_INTERACTIVE):
+    """
+    検索から回答作成までを実行
+
+    Args:
+        vectorstore: FAISSのベクターストア
+        query: 質問
+        mode: ct.ANSWER_MODE_1（教科書検索）またはct.ANSWER_MODE_2（問い合わせ）
+        notify: 処理状況のメッセージを受け取る関数（省略可）
+        priority: 受付制御の優先度（一括評価などはPRIORITY_BACKGROUND）
+
+    Returns:
+        (回答, 検索結果) のタプル
+    """
+    search_results = search(vectorstore, query, k=ct.FAISS_SEARCH_K)
+    if not search_results:
+        return ct.NO_SEARCH_RESULTS_MESSAGE, search_results
+
+    if mode == ct.ANSWER_MODE_1:
+        return format_search_answer(query, search_results), search_results
+
+    try:
+        answer = generate_student_answer(query, build_context(search_results), notify=notify, priority=priority)
+    except GenerationUnavailable as e:
+        return format_degraded_answer(query, search_results, e), search_results
+    return finish_student_answer(answer, search_results), search_results
+
+
+def answer_faq_question(vectorstore, question: str):
+    """
+    FAQ事前生成用に、質問を回答パイプライン全体に通す（生徒の質問の後に回すPRIORITY_BACKGROUNDで生成）
+    LLMを使えない場合は例外を送出する（教科書の抜粋の回答は事前回答として保存しない）
+
+    Args:
+        vectorstore: FAISSのベクターストア
+        question: FAQの質問
+
+    Returns:
+        (回答, 表示用に数式を整形した回答, 検索結果) のタプル
+    """
+    import circuit_solver
+
+    # 計算問題はチャットでの回答と同じく自動計算の結果を使う
+    solution = circuit_solver.solve_question(question) if ct.ENABLE_CIRCUIT_SOLVER else None
+    if solution:
+        explanation = None
+        if ct.CIRCUIT_SOLVER_LLM_EXPLANATION:
+            context_text = build_solver_context(solution, search(vectorstore, question, k=ct.FAISS_SEARCH_K))
+            try:
+                explanation = generate_student_answer(question, context_text, priority=PRIORITY_BACKGROUND)
+            except GenerationUnavailable:
+                # 計算結果はソルバーで求めているため、解説なしで回答する
+                pass
+        answer = finish_solver_answer(solution, explanation)
+        return answer, prepare_math_response(answer), []
+
+    search_results = search(vectorstore, question, k=ct.FAISS_SEARCH_K)
+    if not search_results:
+        raise ValueError("関連する教科書の内容が見つかりませんでした。")
+
+    answer = generate_student_answer(question, build_context(search_results), priority=PRIORITY_BACKGROUND)
+    answer = finish_student_answer(answer, search_results)
+    return answer, prepare_math_response(answer), search_results
+
+
+def create_conversational_chain(retriever, mode: str):
+    """
+    会話履歴を踏まえて検索・回答する「RAG x 会話履歴の記憶機能」のChainを作成
+
+    Args:
+        retriever: ベクターストアのRetriever
+        mode: ct.ANSWER_MODE_1（文書検索用のプロンプト）またはct.ANSWER_MODE_2（問い合わせ用のプロンプト）
+
+    Returns:
+        入力（input・chat_history）から回答（answer・context）を返すChain
+    """
+    from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+
+    # LLMのオブジェクトを用意
+    llm = llm_client.create_chat_llm(model=ct.MODEL, temperature=ct.TEMPERATURE, timeout=ct.LLM_INTERACTIVE_DEADLINE_SECONDS)
+
+    # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのプロンプトテンプレートを作成
+    question_generator_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}")
+        ]
+    )
+
+    # モードによってLLMから回答を取得する用のプロンプトを変更
+    if mode == ct.ANSWER_MODE_1:
+        question_answer_template = ct.SYSTEM_PROMPT_DOC_SEARCH
+        question_answer_user_template = ct.USER_PROMPT_DOC_SEARCH
+    else:
+        question_answer_template = ct.SYSTEM_PROMPT_INQUIRY
+        question_answer_user_template = ct.USER_PROMPT_INQUIRY
+    # （不変のシステムプロンプトを先頭に置き、文脈は最後のユーザーメッセージに入れてプロンプトキャッシュを効かせる）
+    question_answer_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", question_answer_template),
+            MessagesPlaceholder("chat_history"),
+            ("human", question_answer_user_template)
+        ]
+    )
+
+    # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのRetrieverを作成
+    # （2回のLLM呼び出しを段階ごとに計測できるよう、StageTimingCallbackHandler用のタグを付ける）
+    history_aware_retriever = create_history_aware_retriever(
+        llm.with_config(tags=["stage:question_rewrite"]), retriever, question_generator_prompt
+    )
+
+    # LLMから回答を取得する用のChainを作成
+    question_answer_chain = create_stuff_documents_chain(
+        llm.with_config(tags=["stage:generation"]), question_answer_prompt
+    )
+    return create_retrieval_chain(history_aware_retriever, question_answer_chain)
+
+
+def invoke_conversational_chain(chain, memory, user_input: str, user_id: str = None, notify=None,
+                                is_cancelled=None) -> dict:
+    """
+    会話履歴（トークン数の上限内の直近のやり取り＋要約）を渡してChainを実行し、やり取りを履歴に追加
+
+    Args:
+        chain: create_conversational_chainで作成したChain
+        memory: ConversationMemoryのオブジェクト
+        user_input: ユーザー入力値
+        user_id: 受付制御で枠を数える利用者の識別子
+        notify: 受付を待つ間の状況のメッセージを受け取る関数（省略可）
+        is_cancelled: 依頼元が無くなった場合にTrueを返す関数（順番待ちの間に確認する）
+
+    Returns:
+        Chainの出力（answer・context など）に、プロンプトに含めた会話履歴のトークン数（history_tokens）を加えたもの
+    """
+    from cost_optimizer import cost_optimizer
+    from usage_callbacks import StageTimingCallbackHandler, TokenUsageCallbackHandler
+
+    history_tokens = memory.get_token_counts()
+    # 質問の書き換えと回答の2回のLLM呼び出しを、1回分の受付として扱う
+    with admit(user_id, notify, is_cancelled=is_cancelled):
+        llm_response = chain.invoke(
+            {"input": user_input, "chat_history": memory.get_messages()},
+            config={"callbacks": [TokenUsageCallbackHandler(cost_optimizer), StageTimingCallbackHandler()]}
+        )
+    llm_response["history_tokens"] = history_tokens
+    # LLMレスポンスを会話履歴に追加（上限を超えた古いやり取りはバックグラウンドで要約）
+    memory.add_turn(user_input, llm_response["answer"])
+    return llm_response
@@ -0,0 +1,547 @@
+"""
+レスポンスキャッシュの永続化モジュール
+SQLite（WALモード）の単一ファイルにLLMの回答をキャッシュし、件数・容量の上限をLRU/LFUで管理する機能と、
+その前段に置くプロセス内メモリキャッシュ（L1）を提供
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    cache_key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    size_bytes INTEGER NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL DEFAULT 0,
+    hit_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS cache_stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS cache_changes (
+    generation INTEGER PRIMARY KEY AUTOINCREMENT,
+    cache_key TEXT
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache (expires_at);
+CREATE INDEX IF NOT EXISTS idx_response_cache_lru ON response_cache (last_access);
+CREATE INDEX IF NOT EXISTS idx_response_cache_lfu ON response_cache (hit_count, last_access);
+"""
+
+# 旧スキーマ（有効期限のみ）から追加したカラム
+ADDED_COLUMNS = {
+    "size_bytes": "INTEGER NOT NULL DEFAULT 0",
+    "last_access": "REAL NOT NULL DEFAULT 0",
+    "hit_count": "INTEGER NOT NULL DEFAULT 0",
+}
+
+# 変更履歴（保存・全件削除）を残す件数。これより古い世代を知っているプロセスはL1を全件捨てる
+CHANGE_LOG_SIZE = 1000
+
+EVICTION_ORDER = {
+    "lru": "last_access ASC",
+    "lfu": "hit_count ASC, last_access ASC",
+}
+
+
+class SQLiteResponseCache:
+    """SQLiteによるレスポンスキャッシュ（キーは主キー、有効期限・アクセス情報はインデックス付き）"""
+
+    def __init__(self, db_path: str, max_entries: int = None, max_bytes: int = None,
+                 eviction_policy: str = "lru", refresh_ttl_seconds: float = None,
+                 busy_timeout: float = 10.0, stats_flush_interval_seconds: float = 60.0):
+        if eviction_policy not in EVICTION_ORDER:
+            raise ValueError(f"未対応の追い出し方式です: {eviction_policy}")
+
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy
+        # 指定された場合、ヒットするたびに有効期限をこの秒数だけ延長する（よく読まれる回答は期限切れにならない）
+        self.refresh_ttl_seconds = refresh_ttl_seconds
+        self.busy_timeout = busy_timeout
+        # ミスの回数は書き込みを伴わないため、メモリに溜めて書き込みのついで・一定間隔ごとにまとめて反映する
+        self.stats_flush_interval_seconds = stats_flush_interval_seconds
+        self._stats_lock = threading.Lock()
+        self._pending_stats = {}
+        self._last_stats_flush = time.time()
+        # 世代番号の確認用の接続（L1のヒットのたびに確認するため、スレッドごとに使い回す）
+        self._local = threading.local()
+        self._initialize()
+
+    def _connect(self) -> sqlite3.Connection:
+        """接続を作成（プロセス・スレッドをまたいで安全に使えるよう呼び出しごとに接続）"""
+        conn = sqlite3.connect(str(self.db_path), timeout=self.busy_timeout, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _initialize(self):
+        """WALモードの設定、テーブル作成と旧スキーマからの移行"""
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(response_cache)")}
+            for column, definition in ADDED_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE response_cache ADD COLUMN {column} {definition}")
+            if "size_bytes" not in columns:
+                conn.execute(
+                    "UPDATE response_cache SET size_bytes = LENGTH(CAST(query AS BLOB)) + LENGTH(CAST(response AS BLOB)), "
+                    "last_access = created_at"
+                )
+
+            conn.executescript(INDEXES)
+
+    def _increment_stat(self, conn, name: str, amount: int = 1):
+        """統計カウンタを加算"""
+        if amount:
+            conn.execute(
+                "INSERT INTO cache_stats (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount)
+            )
+
+    def _record_change(self, conn, cache_key: str = None):
+        """保存・全件削除を変更履歴に記録し、世代番号を進める（cache_keyがNoneの場合は全件削除）"""
+        generation = conn.execute("INSERT INTO cache_changes (cache_key) VALUES (?)", (cache_key,)).lastrowid
+        conn.execute("DELETE FROM cache_changes WHERE generation <= ?", (generation - CHANGE_LOG_SIZE,))
+
+    def get_generation(self) -> int:
+        """現在の世代番号（保存・全件削除のたびに増える。他のプロセスでの変更の検出に使う）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn.execute("SELECT COALESCE(MAX(generation), 0) FROM cache_changes").fetchone()[0]
+
+    def get_changed_keys(self, since: int):
+        """
+        指定した世代より後に保存されたキーを取得
+
+        Returns:
+            キーの集合（全件削除があった場合・変更履歴が残っていない場合はNone）
+        """
+        with closing(self._connect()) as conn:
+            oldest = conn.execute("SELECT MIN(generation) FROM cache_changes").fetchone()[0]
+            if oldest is not None and oldest > since + 1:
+                return None
+            keys = set()
+            for (cache_key,) in conn.execute("SELECT cache_key FROM cache_changes WHERE generation > ?", (since,)):
+                if cache_key is None:
+                    return None
+                keys.add(cache_key)
+        return keys
+
+    def _count_stat(self, name: str, amount: int = 1):
+        """統計カウンタの加算をメモリに溜める"""
+        with self._stats_lock:
+            self._pending_stats[name] = self._pending_stats.get(name, 0) + amount
+
+    def _write_pending_stats(self, conn, force: bool = True):
+        """溜めておいた統計カウンタを反映（トランザクション内で呼び出す。force=Falseの場合は一定間隔ごと）"""
+        with self._stats_lock:
+            if not self._pending_stats:
+                return
+            if not force and time.time() - self._last_stats_flush < self.stats_flush_interval_seconds:
+                return
+            pending = self._pending_stats
+            self._pending_stats = {}
+            self._last_stats_flush = time.time()
+        for name, amount in pending.items():
+            self._increment_stat(conn, name, amount)
+
+    def flush_stats(self, force: bool = True):
+        """溜めておいた統計カウンタをデータベースに反映（force=Falseの場合は一定間隔ごと）"""
+        with self._stats_lock:
+            if not self._pending_stats:
+                return
+            if not force and time.time() - self._last_stats_flush < self.stats_flush_interval_seconds:
+                return
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._write_pending_stats(conn)
+            conn.execute("COMMIT")
+
+    def get(self, cache_key: str):
+        """有効期限内のレスポンスを取得し、アクセス情報を更新（設定により有効期限も延長）"""
+        entry = self.get_entry(cache_key)
+        return entry[0] if entry else None
+
+    def get_entry(self, cache_key: str):
+        """有効期限内のレスポンスと有効期限（UNIX時刻）の組を取得し、アクセス情報を更新"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT response, expires_at FROM response_cache WHERE cache_key = ? AND expires_at > ?",
+                (cache_key, now)
+            ).fetchone()
+
+            if row is None:
+                self._count_stat("misses")
+            else:
+                conn.execute("BEGIN IMMEDIATE")
+                self._touch(conn, [(cache_key, 1, now)])
+                self._increment_stat(conn, "hits")
+                self._write_pending_stats(conn)
+                conn.execute("COMMIT")
+
+        if row is None:
+            self.flush_stats(force=False)
+            return None
+
+        expires_at = row[1]
+        if self.refresh_ttl_seconds is not None:
+            expires_at = max(expires_at, now + self.refresh_ttl_seconds)
+        return row[0], expires_at
+
+    def _touch(self, conn, accesses: list):
+        """アクセス情報（キー, 回数, 最終アクセス時刻）を反映（設定により有効期限も延長）"""
+        if self.refresh_ttl_seconds is not None:
+            conn.executemany(
+                "UPDATE response_cache SET hit_count = hit_count + ?, last_access = MAX(last_access, ?), "
+                "expires_at = MAX(expires_at, ?) WHERE cache_key = ?",
+                [(count, accessed_at, accessed_at + self.refresh_ttl_seconds, cache_key)
+                 for cache_key, count, accessed_at in accesses]
+            )
+        else:
+            conn.executemany(
+                "UPDATE response_cache SET hit_count = hit_count + ?, last_access = MAX(last_access, ?) "
+                "WHERE cache_key = ?",
+                [(count, accessed_at, cache_key) for cache_key, count, accessed_at in accesses]
+            )
+
+    def record_accesses(self, accesses: list):
+        """上位のキャッシュで処理したヒットのアクセス情報をまとめて反映（LRU/LFUの順序と有効期限の延長に使う）"""
+        if not accesses:
+            return
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._touch(conn, accesses)
+            conn.execute("COMMIT")
+
+    def set(self, cache_key: str, query: str, response: str, ttl_seconds: float):
+        """レスポンスを保存（同じキーは上書き）し、上限を超えた分を追い出す"""
+        now = time.time()
+        size_bytes = len(query.encode("utf-8")) + len(response.encode("utf-8"))
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache "
+                "(cache_key, query, response, created_at, expires_at, size_bytes, last_access, hit_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                (cache_key, query, response, now, now + ttl_seconds, size_bytes, now)
+            )
+            self._enforce_limits(conn, now, keep_key=cache_key)
+            self._record_change(conn, cache_key)
+            self._write_pending_stats(conn)
+            conn.execute("COMMIT")
+
+    def _enforce_limits(self, conn, now: float, keep_key: str = None):
+        """期限切れを削除した上で、件数・容量の上限を超えた分をLRU/LFUの順に追い出す（保存直後のキーは残す）"""
+        if self.max_entries is None and self.max_bytes is None:
+            return
+
+        self._increment_stat(
+            conn, "expirations",
+            conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,)).rowcount
+        )
+
+        total_entries, total_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM response_cache"
+        ).fetchone()
+        max_entries = self.max_entries if self.max_entries is not None else total_entries
+        max_bytes = self.max_bytes if self.max_bytes is not None else total_bytes
+        if total_entries <= max_entries and total_bytes <= max_bytes:
+            return
+
+        victims = []
+        cursor = conn.execute(
+            f"SELECT cache_key, size_bytes FROM response_cache WHERE cache_key IS NOT ? "
+            f"ORDER BY {EVICTION_ORDER[self.eviction_policy]}",
+            (keep_key,)
+        )
+        for cache_key, size_bytes in cursor:
+            if total_entries <= max_entries and total_bytes <= max_bytes:
+                break
+            victims.append((cache_key,))
+            total_entries -= 1
+            total_bytes -= size_bytes
+        cursor.close()
+
+        conn.executemany("DELETE FROM response_cache WHERE cache_key = ?", victims)
+        self._increment_stat(conn, "evictions", len(victims))
+
+    def evict_expired(self) -> int:
+        """期限切れのエントリを一括削除"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            removed = conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+            self._increment_stat(conn, "expirations", removed)
+            conn.execute("COMMIT")
+        return removed
+
+    def clear(self):
+        """全エントリを削除"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM response_cache")
+            self._record_change(conn)
+            conn.execute("COMMIT")
+
+    def count(self) -> int:
+        """エントリ数を取得"""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+    def get_stats(self) -> dict:
+        """件数・容量・ヒット率・追い出し数を取得"""
+        self.flush_stats()
+        with closing(self._connect()) as conn:
+            entries, total_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM response_cache"
+            ).fetchone()
+            counters = dict(conn.execute("SELECT name, value FROM cache_stats").fetchall())
+
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "entries": entries,
+            "bytes": total_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            "evictions": counters.get("evictions", 0),
+            "expirations": counters.get("expirations", 0),
+        }
+
+    def migrate_json_files(self, cache_dir, get_key) -> int:
+        """
+        旧形式（1クエリ1ファイルのJSON）のキャッシュを取り込み、元ファイルを削除
+
+        Args:
+            cache_dir: 旧形式のキャッシュのディレクトリ
+            get_key: 質問文からキャッシュキーを作る関数（旧形式のファイル名は正規化前の質問文のハッシュのため、
+                     保存されている質問文から現在の方法でキーを作り直す）
+
+        Returns:
+            取り込んだ件数
+        """
+        json_files = list(Path(cache_dir).glob("*.json"))
+        if not json_files:
+            return 0
+
+        now = time.time()
+        rows = []
+        for cache_file in json_files:
+            try:
+                with open(cache_file, "r", encoding="utf-8") as f:
+                    cache_data = json.load(f)
+                expires_at = datetime.fromisoformat(cache_data["expires"]).timestamp()
+                if expires_at > now:
+                    created_at = datetime.fromisoformat(cache_data["timestamp"]).timestamp()
+                    size_bytes = len(cache_data["query"].encode("utf-8")) + len(cache_data["response"].encode("utf-8"))
+                    rows.append((get_key(cache_data["query"]), cache_data["query"], cache_data["response"],
+                                 created_at, expires_at, size_bytes, created_at))
+            except Exception:
+                # 破損したキャッシュファイルは取り込まない
+                pass
+
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR IGNORE INTO response_cache "
+                "(cache_key, query, response, created_at, expires_at, size_bytes, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._enforce_limits(conn, now)
+            conn.execute("COMMIT")
+
+        for cache_file in json_files:
+            cache_file.unlink(missing_ok=True)
+
+        return len(rows)
+
+
+class MemoryCache:
+    """プロセス内のメモリキャッシュ（件数上限付きのLRU、エントリごとに有効期限を持つ）"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key: str):
+        """有効期限内の値を取得（ヒットしたエントリは最新として扱う）"""
+        now = time.time()
+        with self.lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[cache_key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, cache_key: str, value, expires_at: float = None):
+        """値を保存（有効期限は自身のTTLと指定の期限の早い方）"""
+        expires_at_limit = time.time() + self.ttl_seconds
+        expires_at = min(expires_at, expires_at_limit) if expires_at is not None else expires_at_limit
+        with self.lock:
+            self._entries[cache_key] = (value, expires_at)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, cache_key: str):
+        """指定したキーを削除"""
+        with self.lock:
+            self._entries.pop(cache_key, None)
+
+    def evict_expired(self) -> int:
+        """期限切れのエントリを削除"""
+        now = time.time()
+        with self.lock:
+            expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def clear(self):
+        """全エントリを削除"""
+        with self.lock:
+            self._entries.clear()
+
+    def get_stats(self) -> dict:
+        """件数・ヒット数・ミス数を取得"""
+        with self.lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class TieredResponseCache:
+    """
+    2層のレスポンスキャッシュ
+    L1（プロセス内メモリ）でヒットした場合は回答を読まずに返し、L2（SQLite）のヒットはL1に載せる。
+    L1でのヒットはアクセス情報として溜めておき、L2へ書き込むついで（ミス・保存時）にまとめて反映する。
+    他のプロセス（ワーカー）での保存・全件削除は、L2の世代番号を参照のたびに確認してL1から取り除く。
+    """
+
+    def __init__(self, l2: SQLiteResponseCache, l1_max_entries: int, l1_ttl_seconds: float,
+                 flush_interval_seconds: float = 60.0):
+        self.l1 = MemoryCache(l1_max_entries, l1_ttl_seconds)
+        self.l2 = l2
+        self.flush_interval_seconds = flush_interval_seconds
+        self._pending_lock = threading.Lock()
+        self._pending_accesses = {}
+        self._last_flush = time.time()
+        self._generation_lock = threading.Lock()
+        self._generation = l2.get_generation()
+
+    def _sync_l1(self):
+        """L2の世代番号が進んでいれば、その間に保存されたキーをL1から取り除く（全件削除があれば全件）"""
+        generation = self.l2.get_generation()
+        if generation == self._generation:
+            return
+        with self._generation_lock:
+            if generation <= self._generation:
+                return
+            changed_keys = self.l2.get_changed_keys(self._generation)
+            if changed_keys is None:
+                self.l1.clear()
+            else:
+                for cache_key in changed_keys:
+                    self.l1.invalidate(cache_key)
+            self._generation = generation
+
+    def get(self, cache_key: str):
+        """L1→L2の順にレスポンスを取得"""
+        self._sync_l1()
+        response = self.l1.get(cache_key)
+        if response is not None:
+            with self._pending_lock:
+                count, _ = self._pending_accesses.get(cache_key, (0, 0))
+                self._pending_accesses[cache_key] = (count + 1, time.time())
+            return response
+
+        self.flush_accesses(force=False)
+        entry = self.l2.get_entry(cache_key)
+        if entry is None:
+            return None
+        response, expires_at = entry
+        self.l1.set(cache_key, response, expires_at)
+        return response
+
+    def set(self, cache_key: str, query: str, response: str, ttl_seconds: float):
+        """L2に保存し、L1の古い値を無効化"""
+        self.l1.invalidate(cache_key)
+        self.flush_accesses(force=False)
+        self.l2.set(cache_key, query, response, ttl_seconds)
+
+    def flush_accesses(self, force: bool = True):
+        """溜めておいたL1ヒットのアクセス情報をL2に反映（force=Falseの場合は一定間隔ごと）"""
+        with self._pending_lock:
+            if not self._pending_accesses:
+                return
+            if not force and time.time() - self._last_flush < self.flush_interval_seconds:
+                return
+            accesses = [(key, count, accessed_at) for key, (count, accessed_at) in self._pending_accesses.items()]
+            self._pending_accesses = {}
+            self._last_flush = time.time()
+        self.l2.record_accesses(accesses)
+
+    def evict_expired(self) -> int:
+        """期限切れのエントリを両方の層から削除"""
+        self.l1.evict_expired()
+        self.flush_accesses()
+        return self.l2.evict_expired()
+
+    def clear(self):
+        """全エントリを両方の層から削除"""
+        with self._pending_lock:
+            self._pending_accesses = {}
+        self.l1.clear()
+        self.l2.clear()
+
+    def count(self) -> int:
+        """エントリ数（L2）を取得"""
+        return self.l2.count()
+
+    def get_stats(self) -> dict:
+        """
+        L2の統計（全プロセスの合計）に、このプロセスのL1の統計を別の値として加えて取得
+        （L1の値はプロセスごとのため、全プロセスの合計であるL2の値とは足し合わせない）
+        """
+        self.flush_accesses()
+        stats = self.l2.get_stats()
+        l1_stats = self.l1.get_stats()
+        l1_lookups = l1_stats["hits"] + l1_stats["misses"]
+        stats.update({
+            "l1_entries": l1_stats["entries"],
+            "l1_hits": l1_stats["hits"],
+            "l1_misses": l1_stats["misses"],
+            "l1_hit_ratio": l1_stats["hits"] / l1_lookups if l1_lookups else 0.0,
+        })
+        return stats
+
+    def migrate_json_files(self, cache_dir, get_key) -> int:
+        """旧形式のJSONキャッシュをL2に取り込む"""
+        return self.l2.migrate_json_files(cache_dir, get_key)
@@ -0,0 +1,253 @@
+"""
+このファイルは、アプリを複数のワーカープロセスで動かすための起動スクリプトです。
+CPUコア数（または指定数）の「streamlit run main.py」を127.0.0.1の別々のポートで起動し、
+利用者が接続する1つのポートで受けた接続を、ブラウザごとに同じワーカーへ振り分けます。
+
+起動例:
+    python run_workers.py --workers 4 --port 8501
+
+各ワーカーはデータディレクトリ（ベクターストア・レスポンスキャッシュ・使用量の台帳・FAQ事前回答）を共有します。
+インデックスの作成はプロセス間ロックにより1ワーカーだけが行い、他のワーカーは完成したものを読み込みます。
+Streamlitのセッションはワーカーのメモリ上にあるため、振り分けはTCP接続単位で行い、
+最初の応答で振り分け先のワーカーをCookieに記録して、同じブラウザのWebSocket・再接続・メディアの取得が
+同じワーカーに届くようにしています（WebSocketもそのまま中継されます）。
+Cookieの無い新しいブラウザは接続中の数が最も少ないワーカーに振り分けるため、
+教室の生徒が学校のNATの後ろから同じIPアドレスで接続しても、ワーカー間で分散します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+import constants as ct
+
+
+############################################################
+# ワーカープロセス
+############################################################
+
+def start_worker(port, extra_args):
+    """
+    127.0.0.1の指定ポートでStreamlitのワーカーを起動
+    """
+    command = [
+        sys.executable, "-m", "streamlit", "run", "main.py",
+        "--server.address", "127.0.0.1",
+        "--server.port", str(port),
+        "--server.headless", "true",
+        *extra_args,
+    ]
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for_port(port, process, timeout):
+    """
+    ワーカーが接続を受け付けるまで待つ（起動に失敗した場合はFalse）
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def stop_workers(processes):
+    """
+    全ワーカーを終了（終了しない場合は強制終了）
+    """
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+############################################################
+# 振り分けプロキシ
+############################################################
+
+AFFINITY_COOKIE_PATTERN = re.compile(rf"(?:^|;)\s*{re.escape(ct.WORKER_AFFINITY_COOKIE)}=(\d+)")
+HEAD_END = b"\r\n\r\n"
+
+
+def parse_request_headers(head):
+    """
+    HTTPリクエストのヘッダー部分から、小文字のヘッダー名と値の辞書を作成（HTTPでない場合は空）
+    """
+    headers = {}
+    for line in head.decode("latin-1").split("\r\n")[1:]:
+        name, separator, value = line.partition(":")
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+class WorkerBalancer:
+    """
+    接続の振り分け先のワーカーを決める（ワーカーごとの接続中の数を数える）
+    1. 以前に振り分けたワーカーのCookie（同じブラウザのセッションを同じワーカーに届ける）
+    2. X-User-Idヘッダーのハッシュ（Cookieを保持しないクライアント向け）
+    3. 接続中の数が最も少ないワーカー（同じ数の場合は順番に）
+    """
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.active = [0] * len(ports)
+        self._next = 0
+
+    def choose(self, headers):
+        """
+        Returns:
+            (ワーカーの番号, 応答でCookieを設定するか) のタプル
+        """
+        match = AFFINITY_COOKIE_PATTERN.search(headers.get("cookie", ""))
+        if match and int(match.group(1)) < len(self.ports):
+            return int(match.group(1)), False
+
+        user_id = headers.get("x-user-id")
+        if user_id:
+            digest = hashlib.md5(user_id.encode()).digest()
+            return int.from_bytes(digest[:4], "big") % len(self.ports), False
+
+        count = len(self.ports)
+        order = [(self._next + i) % count for i in range(count)]
+        index = min(order, key=lambda i: self.active[i])
+        self._next = (index + 1) % count
+        return index, True
+
+
+def affinity_cookie_header(index):
+    """振り分け先のワーカーを記録するSet-Cookieヘッダー（ブラウザを閉じるまで有効）"""
+    return f"Set-Cookie: {ct.WORKER_AFFINITY_COOKIE}={index}; Path=/; HttpOnly; SameSite=Lax\r\n".encode()
+
+
+async def read_head(reader):
+    """
+    HTTPのヘッダー部分（空行まで）を読む（HTTPでない・大きすぎる場合は空。読み残しはそのまま中継される）
+    """
+    try:
+        return await reader.readuntil(HEAD_END)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except (asyncio.LimitOverrunError, ConnectionError):
+        return b""
+
+
+async def pipe(reader, writer, extra_header=None):
+    """
+    一方向のデータ中継（相手が閉じたら書き込み側も閉じる）
+    extra_headerを指定した場合は、最初の応答のヘッダーに追加する
+    """
+    try:
+        if extra_header:
+            head = await read_head(reader)
+            if head.endswith(HEAD_END):
+                head = head[:-2] + extra_header + b"\r\n"
+            writer.write(head)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+def create_connection_handler(ports, balancer=None):
+    """
+    受け付けた接続を担当のワーカーに中継するハンドラを作成
+    """
+    balancer = balancer or WorkerBalancer(ports)
+
+    async def handle_connection(client_reader, client_writer):
+        # 最初のリクエストのヘッダーで振り分け先を決め、読んだ分はワーカーに送る
+        head = await read_head(client_reader)
+        index, set_cookie = balancer.choose(parse_request_headers(head))
+        try:
+            worker_reader, worker_writer = await asyncio.open_connection("127.0.0.1", ports[index])
+        except OSError:
+            client_writer.close()
+            return
+        balancer.active[index] += 1
+        try:
+            worker_writer.write(head)
+            await asyncio.gather(
+                pipe(client_reader, worker_writer),
+                pipe(worker_reader, client_writer, affinity_cookie_header(index) if set_cookie else None)
+            )
+        finally:
+            balancer.active[index] -= 1
+
+    return handle_connection
+
+
+async def serve_proxy(host, port, ports, balancer=None):
+    server = await asyncio.start_server(create_connection_handler(ports, balancer), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+############################################################
+# 起動処理
+############################################################
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="アプリを複数のワーカープロセスで起動")
+    parser.add_argument("--workers", type=int, default=ct.WORKER_COUNT or os.cpu_count() or 1,
+                        help="ワーカープロセス数（既定はCPUコア数）")
+    parser.add_argument("--host", default=ct.WORKER_PROXY_HOST, help="利用者が接続するアドレス")
+    parser.add_argument("--port", type=int, default=ct.WORKER_PROXY_PORT, help="利用者が接続するポート")
+    parser.add_argument("--base-port", type=int, default=ct.WORKER_BASE_PORT, help="ワーカーに割り当てる最初のポート")
+    parser.add_argument("streamlit_args", nargs=argparse.REMAINDER,
+                        help="各ワーカーのstreamlit runにそのまま渡す引数（-- の後に指定）")
+    return parser
+
+
+def main(argv=None):
+    config = build_arg_parser().parse_args(argv)
+    extra_args = [arg for arg in config.streamlit_args if arg != "--"]
+    ports = [config.base_port + i for i in range(config.workers)]
+
+    processes = [start_worker(port, extra_args) for port in ports]
+    try:
+        for port, process in zip(ports, processes):
+            if not wait_for_port(port, process, ct.WORKER_STARTUP_TIMEOUT_SECONDS):
+                print(f"ワーカー（ポート{port}）の起動に失敗しました", file=sys.stderr)
+                return 1
+
+        print(f"{config.workers}ワーカーで起動しました: http://{config.host}:{config.port}")
+        # SIGTERM（Heroku等の停止）でもワーカーを終了させる
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        asyncio.run(serve_proxy(config.host, config.port, ports))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(processes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,9 @@
+"""
+テスト共通設定
+リポジトリ直下のモジュール（circuit_solver.py など）を import できるようにする
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
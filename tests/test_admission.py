@@ -0,0 +1,209 @@
+"""
+LLM呼び出しの受付制御（admission.py）のテスト
+"""
+
+import threading
+import time
+
+import pytest
+
+import admission
+from admission import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from admission import AdmissionController, AdmissionRejected, RequestCancelled, TokenBucket
+
+
+class FakeClock:
+    """time.monotonic()・time.sleep()の代わりに使う時計（sleepすると進む）"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(admission, "time", fake)
+    return fake
+
+
+def test_bucket_allows_burst_then_waits(clock):
+    bucket = TokenBucket(rate_per_second=0.5, burst=3)
+    assert [bucket.reserve(max_wait=0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # 4回目は1トークン貯まるまで（2秒）待つ必要があり、待てない場合は予約しない
+    assert bucket.reserve(max_wait=1) == pytest.approx(-2.0)
+    assert bucket.available() == 0.0
+
+
+def test_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate_per_second=0.5, burst=3)
+    for _ in range(3):
+        bucket.reserve(max_wait=0)
+
+    clock.advance(3)
+    assert bucket.available() == pytest.approx(1.5)
+    clock.advance(100)
+    assert bucket.available() == 3.0
+
+
+def test_bucket_reserve_within_max_wait(clock):
+    bucket = TokenBucket(rate_per_second=0.5, burst=1)
+    bucket.reserve(max_wait=0)
+    assert bucket.reserve(max_wait=5) == pytest.approx(2.0)
+    # 予約済みのため、次の予約はさらに2秒後になる
+    assert bucket.reserve(max_wait=5) == pytest.approx(4.0)
+
+    bucket.refund()
+    assert bucket.reserve(max_wait=5) == pytest.approx(4.0)
+
+
+def make_controller(**kwargs):
+    params = {"rate_per_minute": 30, "burst": 2, "max_concurrent": 4, "max_wait_seconds": 10}
+    params.update(kwargs)
+    return AdmissionController(**params)
+
+
+def test_user_over_burst_waits_for_refill(clock):
+    controller = make_controller()
+    for _ in range(2):
+        controller.release(controller.acquire("student"))
+
+    waits = []
+    started = clock.now
+    controller.release(controller.acquire("student", on_wait=lambda position, seconds: waits.append((position, seconds))))
+    # 2秒に1回分回復するため、3回目は2秒待ってから受け付ける
+    assert clock.now - started == pytest.approx(2.0)
+    assert waits[0] == (0, pytest.approx(2.0))
+
+
+def test_user_over_burst_is_rejected_when_wait_is_too_long(clock):
+    controller = make_controller(rate_per_minute=1)
+    for _ in range(2):
+        controller.release(controller.acquire("student"))
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire("student")
+    assert excinfo.value.retry_after == pytest.approx(60.0)
+    # 他の利用者の枠は減らない
+    controller.release(controller.acquire("other"))
+    assert controller.get_stats()["rejected"] == 1
+
+
+def test_cancelled_while_waiting_for_bucket_refunds_token(clock):
+    controller = make_controller(burst=1)
+    controller.release(controller.acquire("student"))
+
+    with pytest.raises(RequestCancelled):
+        controller.acquire("student", is_cancelled=lambda: True)
+    assert controller.get_stats()["cancelled"] == 1
+    # 取り消した分の予約は返されている（次の予約は1回分の回復を待つだけ）
+    clock.advance(2)
+    assert controller.get_user_status("student")["available"] == 1
+
+
+def wait_for(predicate, timeout: float = 5):
+    """別のスレッドの状態がpredicateを満たすまで待つ"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def start_waiter(controller, name: str, order: list, priority: int):
+    """受付を待ち、受け付けられた順にorderへ名前を追加してすぐに枠を返すスレッド"""
+    def run():
+        slot = controller.acquire(priority=priority)
+        order.append(name)
+        controller.release(slot)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def queued(controller) -> int:
+    stats = controller.get_stats()
+    return stats["queued"] + stats["background_queued"]
+
+
+def test_queue_admits_interactive_before_background_in_arrival_order():
+    controller = make_controller(max_concurrent=1, max_wait_seconds=60)
+    held = controller.acquire()
+
+    order = []
+    threads = []
+    for name, priority in [("background", PRIORITY_BACKGROUND), ("interactive1", PRIORITY_INTERACTIVE),
+                           ("interactive2", PRIORITY_INTERACTIVE)]:
+        threads.append(start_waiter(controller, name, order, priority))
+        wait_for(lambda: queued(controller) == len(threads))
+
+    controller.release(held)
+    for thread in threads:
+        thread.join(5)
+    assert order == ["interactive1", "interactive2", "background"]
+
+
+def test_background_limit_does_not_hold_back_interactive():
+    controller = make_controller(max_concurrent=2, max_background_concurrent=1)
+    background = controller.acquire(priority=PRIORITY_BACKGROUND)
+
+    order = []
+    thread = start_waiter(controller, "background", order, PRIORITY_BACKGROUND)
+    wait_for(lambda: controller.get_stats()["background_queued"] == 1)
+    # バックグラウンドの枠は埋まっているが、対話は残りの枠ですぐに受け付ける
+    controller.release(controller.acquire())
+    assert order == []
+
+    controller.release(background)
+    thread.join(5)
+    assert order == ["background"]
+
+
+def test_request_past_deadline_leaves_queue():
+    controller = make_controller(max_concurrent=1)
+    held = controller.acquire()
+
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(priority=PRIORITY_BACKGROUND, deadline_seconds=0.2)
+    stats = controller.get_stats()
+    assert stats["expired"] == 1
+    assert queued(controller) == 0
+    controller.release(held)
+
+
+def test_cancelled_request_leaves_queue_and_next_one_proceeds():
+    controller = make_controller(max_concurrent=1, max_wait_seconds=60)
+    held = controller.acquire()
+    cancelled = threading.Event()
+    errors = []
+
+    def run_cancelled():
+        try:
+            controller.acquire(is_cancelled=cancelled.is_set)
+        except RequestCancelled as e:
+            errors.append(e)
+
+    first = threading.Thread(target=run_cancelled, daemon=True)
+    first.start()
+    wait_for(lambda: queued(controller) == 1)
+    order = []
+    second = start_waiter(controller, "second", order, PRIORITY_INTERACTIVE)
+    wait_for(lambda: queued(controller) == 2)
+
+    cancelled.set()
+    first.join(5)
+    assert len(errors) == 1
+    assert controller.get_stats()["cancelled"] == 1
+
+    controller.release(held)
+    second.join(5)
+    assert order == ["second"]
+    assert queued(controller) == 0
@@ -0,0 +1,45 @@
+"""
+チャンクの前処理（chunk_preprocessor.py）のテスト
+"""
+
+from types import SimpleNamespace
+
+import chunk_preprocessor
+from chunk_preprocessor import PREPROCESS_VERSION, VERSION_KEY, preprocess_chunks
+
+CONTENT = "オームの法則とは、電圧と電流の関係を表す法則である。V = I × R"
+
+
+def make_chunk(metadata=None):
+    return SimpleNamespace(page_content=CONTENT, metadata=dict(metadata or {}))
+
+
+def test_preprocess_chunks_fills_missing_metadata():
+    chunk = make_chunk()
+    assert preprocess_chunks([chunk]) == 1
+    assert chunk.metadata[VERSION_KEY] == PREPROCESS_VERSION
+    assert chunk.metadata[chunk_preprocessor.KEY_POINTS_KEY]
+
+
+def test_preprocess_chunks_skips_current_metadata():
+    chunk = make_chunk()
+    preprocess_chunks([chunk])
+    # 保存済みのメタデータが最新なら計算しない（呼び出し元は保存し直さない）
+    assert preprocess_chunks([chunk]) == 0
+
+
+def test_preprocess_chunks_recomputes_after_version_bump(monkeypatch):
+    chunk = make_chunk()
+    preprocess_chunks([chunk])
+    monkeypatch.setattr(chunk_preprocessor, "PREPROCESS_VERSION", PREPROCESS_VERSION + 1)
+    assert preprocess_chunks([chunk]) == 1
+    assert chunk.metadata[VERSION_KEY] == PREPROCESS_VERSION + 1
+
+
+def test_preprocess_chunks_keeps_newer_metadata():
+    # 新しいルールで保存されたチャンクを、古いルールで上書きしない
+    chunk = make_chunk({VERSION_KEY: PREPROCESS_VERSION + 1, chunk_preprocessor.CLEANED_TEXT_KEY: "新しいルールの整形"})
+    assert preprocess_chunks([chunk]) == 0
+    assert chunk.metadata[chunk_preprocessor.CLEANED_TEXT_KEY] == "新しいルールの整形"
+    # 検索時はその場で現在のルールで整形する
+    assert chunk_preprocessor.get_cleaned_text({"content": CONTENT, "metadata": chunk.metadata}) != "新しいルールの整形"
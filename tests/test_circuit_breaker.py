@@ -0,0 +1,133 @@
+"""
+回答生成のサーキットブレーカー（circuit_breaker.py）のテスト
+"""
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker
+
+
+class FakeClock:
+    """time.monotonic()の代わりに使う時計（advanceで進める）"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", fake)
+    return fake
+
+
+def make_breaker():
+    return CircuitBreaker(window_size=4, min_calls=4, failure_rate_threshold=0.5,
+                          slow_call_seconds=10, slow_rate_threshold=0.5, open_seconds=30)
+
+
+def open_breaker(breaker):
+    for _ in range(2):
+        breaker.record_success(1)
+    for _ in range(2):
+        breaker.record_failure(TimeoutError())
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure(TimeoutError())
+    assert breaker.get_status()["state"] == STATE_CLOSED
+    assert breaker.allow_request()
+
+
+def test_opens_on_failure_rate(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+
+    status = breaker.get_status()
+    assert status["state"] == STATE_OPEN
+    assert status["retry_in_seconds"] == 30
+    assert not breaker.allow_request()
+    assert breaker.get_status()["short_circuited"] == 1
+
+
+def test_opens_on_slow_rate(clock):
+    breaker = make_breaker()
+    for seconds in (1, 1, 11, 11):
+        breaker.record_success(seconds)
+    assert breaker.get_status()["state"] == STATE_OPEN
+    assert "応答が遅い" in breaker.get_status()["reason"]
+
+
+def test_half_open_allows_single_probe(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+
+    clock.advance(30)
+    assert breaker.allow_request()
+    assert breaker.get_status()["state"] == STATE_HALF_OPEN
+    # 試している間は他のリクエストを通さない
+    assert not breaker.allow_request()
+
+
+def test_successful_probe_closes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    breaker.allow_request()
+
+    breaker.record_success(1)
+    status = breaker.get_status()
+    assert status["state"] == STATE_CLOSED
+    assert status["reason"] is None
+    # 開く前の結果は捨てている
+    assert status["calls"] == 1
+    assert breaker.allow_request()
+
+
+@pytest.mark.parametrize("record", [
+    lambda breaker: breaker.record_failure(TimeoutError()),
+    lambda breaker: breaker.record_success(11),
+], ids=["failure", "slow"])
+def test_failed_probe_reopens(clock, record):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    breaker.allow_request()
+
+    record(breaker)
+    status = breaker.get_status()
+    assert status["state"] == STATE_OPEN
+    assert status["opened"] == 2
+    assert status["retry_in_seconds"] == 30
+    assert not breaker.allow_request()
+
+
+def test_ignored_probe_releases_half_open_slot(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    assert breaker.allow_request()
+
+    # 試しのリクエストが受付で断られた場合は、次のリクエストで試し直す
+    breaker.record_ignored()
+    assert breaker.get_status()["state"] == STATE_HALF_OPEN
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+
+def test_record_ignored_while_closed_is_noop(clock):
+    breaker = make_breaker()
+    breaker.allow_request()
+    breaker.record_ignored()
+    status = breaker.get_status()
+    assert status["state"] == STATE_CLOSED
+    assert status["calls"] == 0
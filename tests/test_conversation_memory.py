@@ -0,0 +1,153 @@
+"""
+会話履歴（conversation_memory.py）のテスト
+トークン数はtiktokenを使わない概算（日本語は1文字1トークン）で数える
+"""
+
+import threading
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+import constants as ct
+import conversation_memory
+from conversation_memory import ConversationMemory, count_tokens
+
+
+@pytest.fixture(autouse=True)
+def approximate_tokens(monkeypatch):
+    monkeypatch.setattr(conversation_memory, "_encoding", False)
+
+
+# 4回のやり取り（1回あたり7トークン）で上限（20トークン）を超え、古い2回が要約に回る
+NUMBERS = "一二三四"
+
+
+class FakeSummarizer:
+    """要約の代わりに、受け取った質問を連結して返す"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, summary, turns, is_cancelled=None):
+        self.calls.append((summary, list(turns)))
+        return summary + "".join(question for question, _ in turns)
+
+
+def make_memory(summarize=None, **kwargs):
+    params = {"recent_token_budget": 20, "summary_token_budget": 10, "min_recent_turns": 1}
+    params.update(kwargs)
+    return ConversationMemory(summarize=summarize or FakeSummarizer(), **params)
+
+
+def test_count_tokens_approximation():
+    assert count_tokens("") == 0
+    assert count_tokens("電圧") == 2
+    assert count_tokens("abcdefgh") == 2
+
+
+def test_turns_within_budget_are_kept_as_is():
+    summarizer = FakeSummarizer()
+    memory = make_memory(summarizer)
+    memory.add_turn("質問一", "回答一")
+    memory.add_turn("質問二", "回答二")
+    memory.wait_for_summary()
+
+    assert summarizer.calls == []
+    assert memory.get_messages() == [
+        HumanMessage(content="質問一"), AIMessage(content="回答一"),
+        HumanMessage(content="質問二"), AIMessage(content="回答二"),
+    ]
+    assert memory.get_token_counts()["recent_tokens"] == 12
+
+
+def test_old_turns_are_folded_into_summary():
+    summarizer = FakeSummarizer()
+    memory = make_memory(summarizer)
+    for number in NUMBERS:
+        memory.add_turn(f"質問{number}", "回答です")  # 1回あたり7トークン
+    memory.wait_for_summary()
+
+    counts = memory.get_token_counts()
+    assert counts["recent_tokens"] <= 20
+    assert counts["recent_turns"] == 2
+    assert counts["pending_turns"] == 0
+    messages = memory.get_messages()
+    assert messages[0] == SystemMessage(content=ct.HISTORY_SUMMARY_PREFIX + "質問一質問二")
+    assert messages[1] == HumanMessage(content="質問三")
+
+
+def test_summary_is_truncated_to_budget():
+    memory = make_memory(lambda summary, turns, is_cancelled=None: "長い要約" * 10)
+    for number in NUMBERS:
+        memory.add_turn(f"質問{number}", "回答です")
+    memory.wait_for_summary()
+
+    assert memory.get_token_counts()["summary_tokens"] == 10
+    assert memory.get_messages()[0].content == ct.HISTORY_SUMMARY_PREFIX + ("長い要約" * 10)[:10]
+
+
+def test_fallback_summary_lists_questions():
+    def failing_summarize(summary, turns, is_cancelled=None):
+        raise RuntimeError("API error")
+
+    memory = make_memory(failing_summarize, summary_token_budget=100)
+    for number in NUMBERS:
+        memory.add_turn(f"質問{number}", "回答です")
+    memory.wait_for_summary()
+
+    assert memory.get_messages()[0].content == ct.HISTORY_SUMMARY_PREFIX + "これまでの質問:\n- 質問一\n- 質問二"
+
+
+def test_clear_discards_summary_started_before_clear():
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_summarize(summary, turns, is_cancelled=None):
+        started.set()
+        release.wait(5)
+        return "消去前の要約"
+
+    memory = make_memory(slow_summarize)
+    for number in NUMBERS:
+        memory.add_turn(f"質問{number}", "回答です")
+    assert started.wait(5)
+    memory.clear()
+    release.set()
+    memory.wait_for_summary(timeout=5)
+
+    assert memory.get_messages() == []
+    assert memory.get_token_counts()["history_tokens"] == 0
+
+
+def test_cancelled_session_is_not_summarized():
+    summarizer = FakeSummarizer()
+    memory = make_memory(summarizer, is_cancelled=lambda: True)
+    for number in NUMBERS:
+        memory.add_turn(f"質問{number}", "回答です")
+    memory.wait_for_summary()
+
+    assert summarizer.calls == []
+
+
+def test_long_latest_answer_is_truncated_to_budget():
+    memory = make_memory()
+    memory.add_turn("質問", "とても長い回答" * 10)
+    memory.wait_for_summary()
+
+    counts = memory.get_token_counts()
+    assert counts["recent_tokens"] == 20
+    assert counts["recent_turns"] == 1
+    question, answer = memory.get_messages()
+    assert question.content == "質問"
+    assert answer.content == ("とても長い回答" * 10)[:18]
+
+
+def test_long_question_is_truncated_when_answer_is_not_enough():
+    memory = make_memory()
+    memory.add_turn("長い質問" * 10, "回答")
+    memory.wait_for_summary()
+
+    assert memory.get_token_counts()["recent_tokens"] <= 20
+    question, answer = memory.get_messages()
+    assert answer.content == ""
+    assert question.content == ("長い質問" * 10)[:20]
@@ -0,0 +1,114 @@
+"""
+インデックスの事前読み込み（index_loader.py）のテスト
+読み込み・公開中のバージョンの取得は、テスト用の関数に差し替える
+"""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import constants as ct
+import index_loader as il
+
+
+class FakeIndexSource:
+    """公開中のバージョンと、読み込みの成否を切り替えられる読み込み元"""
+
+    def __init__(self):
+        self.published = "v1"
+        self.error = None
+        self.loads = 0
+
+    def load(self, report):
+        self.loads += 1
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return object(), [SimpleNamespace(metadata={"source_file": "textbook.pdf"})], "cache", self.published
+
+    def published_version(self):
+        return self.published
+
+
+@pytest.fixture(autouse=True)
+def check_every_time(monkeypatch):
+    monkeypatch.setattr(ct, "INDEX_VERSION_CHECK_SECONDS", 0)
+
+
+def wait_until_loaded(loader, timeout: float = 5):
+    """バックグラウンドの読み込みが終わるまで待つ"""
+    deadline = time.monotonic() + timeout
+    while loader.get_status()["state"] == il.STATE_LOADING:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def source():
+    return FakeIndexSource()
+
+
+@pytest.fixture
+def loader(source):
+    return il.IndexLoader(load=source.load, published_version=source.published_version, on_ready=None)
+
+
+def test_first_load_failure_is_failed(loader, source):
+    source.error = "APIキーがありません"
+    assert loader.start()
+    wait_until_loaded(loader)
+
+    status = loader.get_status()
+    assert status["state"] == il.STATE_FAILED
+    assert status["error"] == "APIキーがありません"
+    assert loader.get_index() is None
+    assert not loader.check_for_update()
+
+
+def test_new_version_is_loaded(loader, source):
+    loader.start()
+    wait_until_loaded(loader)
+    assert not loader.check_for_update()
+
+    source.published = "v2"
+    assert loader.check_for_update()
+    wait_until_loaded(loader)
+    assert loader.get_index()["version"] == "v2"
+    assert loader.get_index()["generation"] == 2
+
+
+def test_failed_reload_keeps_serving_and_retries(loader, source):
+    loader.start()
+    wait_until_loaded(loader)
+
+    source.published = "v2"
+    source.error = "読み込みエラー"
+    assert loader.check_for_update()
+    wait_until_loaded(loader)
+
+    # 前のインデックスで回答を続け、失敗は読み込み直しのエラーとして知らせる
+    status = loader.get_status()
+    assert status["state"] == il.STATE_READY
+    assert status["error"] is None
+    assert status["reload_error"] == "読み込みエラー"
+    assert loader.get_index()["version"] == "v1"
+
+    # 次の確認で再試行する
+    source.error = None
+    assert loader.check_for_update()
+    wait_until_loaded(loader)
+    status = loader.get_status()
+    assert status["reload_error"] is None
+    assert status["version"] == "v2"
+    assert source.loads == 3
+
+
+def test_version_check_is_rate_limited(loader, source, monkeypatch):
+    loader.start()
+    wait_until_loaded(loader)
+    monkeypatch.setattr(ct, "INDEX_VERSION_CHECK_SECONDS", 3600)
+    assert not loader.check_for_update()
+
+    # 前回の確認から INDEX_VERSION_CHECK_SECONDS が経つまでは、公開中のバージョンを確認しない
+    source.published = "v2"
+    assert not loader.check_for_update()
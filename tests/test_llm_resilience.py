@@ -0,0 +1,181 @@
+"""
+LLM呼び出しの再試行・ヘッジ（llm_resilience.py）のテスト
+"""
+
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from llm_resilience import ResilientInvoker, get_retry_after, is_retryable
+
+
+def make_invoker(**kwargs):
+    params = {"max_attempts": 3, "attempt_timeout_seconds": 2, "backoff_base_seconds": 0.001,
+              "backoff_max_seconds": 0.001, "enable_hedging": False}
+    params.update(kwargs)
+    return ResilientInvoker(**params)
+
+
+def status_error(status_code: int, headers: dict = None, code: str = None):
+    """OpenAIのAPIが返すステータスコード付きのエラー"""
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    body = {"code": code} if code else None
+    if status_code == 429:
+        return openai.RateLimitError("rate limited", response=response, body=body)
+    return openai.InternalServerError("server error", response=response, body=body)
+
+
+class FlakyCall:
+    """最初のfailures回はerrorで失敗し、その後は成功する呼び出し"""
+
+    def __init__(self, failures: int, error=None):
+        self.failures = failures
+        self.error = error or TimeoutError()
+        self.calls = 0
+
+    async def __call__(self, timeout):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return "回答"
+
+
+@pytest.mark.parametrize("error, expected", [
+    (TimeoutError(), True),
+    (status_error(429), True),
+    (status_error(500), True),
+    (status_error(429, code="insufficient_quota"), False),
+    (ValueError(), False),
+])
+def test_is_retryable(error, expected):
+    assert is_retryable(error) is expected
+
+
+def test_get_retry_after():
+    assert get_retry_after(status_error(429, headers={"retry-after": "1.5"})) == 1.5
+    assert get_retry_after(status_error(429)) is None
+    assert get_retry_after(TimeoutError()) is None
+
+
+def test_retries_until_success():
+    invoker = make_invoker()
+    call = FlakyCall(failures=2)
+    assert asyncio.run(invoker.ainvoke(call)) == "回答"
+
+    stats = invoker.get_stats()
+    assert call.calls == 3
+    assert (stats["attempts"], stats["retries"], stats["timeouts"], stats["failures"]) == (3, 2, 2, 0)
+
+
+def test_gives_up_after_max_attempts():
+    invoker = make_invoker()
+    call = FlakyCall(failures=10, error=status_error(500))
+    with pytest.raises(openai.InternalServerError):
+        asyncio.run(invoker.ainvoke(call))
+
+    assert call.calls == 3
+    assert invoker.get_stats()["failures"] == 1
+
+
+def test_does_not_retry_non_retryable_error():
+    invoker = make_invoker()
+    call = FlakyCall(failures=10, error=status_error(429, code="insufficient_quota"))
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(invoker.ainvoke(call))
+    assert call.calls == 1
+
+
+def test_waits_for_retry_after():
+    invoker = make_invoker()
+    call = FlakyCall(failures=1, error=status_error(429, headers={"retry-after": "0.3"}))
+    started = time.monotonic()
+    assert asyncio.run(invoker.ainvoke(call)) == "回答"
+    # バックオフ（最大0.001秒）よりRetry-Afterの指定を優先する
+    assert time.monotonic() - started >= 0.3
+
+
+def test_gives_up_when_retry_after_exceeds_deadline():
+    invoker = make_invoker()
+    call = FlakyCall(failures=1, error=status_error(429, headers={"retry-after": "60"}))
+    started = time.monotonic()
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(invoker.ainvoke(call, deadline=time.monotonic() + 5))
+    assert call.calls == 1
+    assert time.monotonic() - started < 1
+
+
+def test_stream_retries_only_before_first_chunk():
+    invoker = make_invoker()
+    calls = []
+
+    def stream(timeout):
+        async def chunks():
+            calls.append(timeout)
+            if len(calls) == 1:
+                raise TimeoutError()
+            yield "断片1"
+            raise TimeoutError()
+        return chunks()
+
+    received = []
+
+    async def consume():
+        async for chunk in invoker.astream(stream):
+            received.append(chunk)
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(consume())
+    # 断片を返した後のエラーは再試行しない
+    assert len(calls) == 2
+    assert received == ["断片1"]
+    assert invoker.get_stats()["retries"] == 1
+
+
+def primed_hedging_invoker(latency: float = 0.05):
+    """ヘッジを出すまでの時間（p95）がlatency秒になるように、応答時間の実績を入れたもの"""
+    invoker = make_invoker(enable_hedging=True, hedge_min_samples=5)
+    for _ in range(5):
+        invoker._record_attempt(latency)
+    return invoker
+
+
+def test_no_hedge_without_enough_samples():
+    invoker = make_invoker(enable_hedging=True, hedge_min_samples=5)
+    invoker._record_attempt(0.05)
+    assert invoker.hedge_delay() is None
+
+
+def test_hedge_is_sent_when_primary_is_slow():
+    invoker = primed_hedging_invoker()
+    started = []
+    cancelled = []
+
+    async def call(timeout):
+        started.append(time.monotonic())
+        if len(started) == 1:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return "遅い回答"
+        return "速い回答"
+
+    assert asyncio.run(invoker.ainvoke(call)) == "速い回答"
+    stats = invoker.get_stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
+    # 2本目はp95（0.05秒）を過ぎてから出し、遅い方は取り消す
+    assert started[1] - started[0] >= 0.05
+    assert cancelled == [True]
+
+
+def test_no_hedge_when_primary_is_fast():
+    invoker = primed_hedging_invoker(latency=1)
+    call = FlakyCall(failures=0)
+    assert asyncio.run(invoker.ainvoke(call)) == "回答"
+    assert call.calls == 1
+    assert invoker.get_stats()["hedges"] == 0
@@ -0,0 +1,44 @@
+"""
+数式表示の正規化（math_normalizer.py）のテスト
+期待出力（benchmarks/math_normalizer_golden.json）と一致し、noteのあるケース以外は旧実装と同じ出力になることを確認する
+"""
+
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+import math_normalizer
+
+BENCHMARK_PATH = Path(__file__).resolve().parent.parent / "benchmarks" / "bench_math_normalizer.py"
+GOLDEN_PATH = BENCHMARK_PATH.with_name("math_normalizer_golden.json")
+
+
+def load_benchmark():
+    """旧実装（LEGACY_FUNCTIONS）を持つベンチマークのモジュールを読み込む"""
+    spec = importlib.util.spec_from_file_location("bench_math_normalizer", BENCHMARK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+bench = load_benchmark()
+with open(GOLDEN_PATH, "r", encoding="utf-8") as f:
+    CASES = json.load(f)["cases"]
+
+PARAMS = [
+    pytest.param(case, name, id=f"{name}-{i}")
+    for i, case in enumerate(CASES)
+    for name in bench.FUNCTIONS
+]
+
+
+@pytest.mark.parametrize("case, name", PARAMS)
+def test_matches_golden(case, name):
+    assert getattr(math_normalizer, name)(case["input"]) == case[name]
+
+
+@pytest.mark.parametrize("case, name", [param for param in PARAMS if "note" not in param.values[0]])
+def test_matches_legacy_implementation(case, name):
+    assert getattr(math_normalizer, name)(case["input"]) == bench.LEGACY_FUNCTIONS[name](case["input"])
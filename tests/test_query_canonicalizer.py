@@ -0,0 +1,105 @@
+"""
+質問文の正規化（query_canonicalizer.py）と検索クエリの埋め込みキャッシュ（cached_embeddings.py）のテスト
+"""
+
+import pytest
+
+import constants as ct
+from query_canonicalizer import canonicalize_query, normalize_text
+
+
+@pytest.mark.parametrize("variant, expected", [
+    # 全角・半角
+    ("２ｋΩの抵抗に１０Ｖを加えたときの電流", "2kΩの抵抗に10Vを加えたときの電流"),
+    ("2 KΩの抵抗に10 Vを加えたときの電流", "2kΩの抵抗に10Vを加えたときの電流"),
+    # 単位の読み方
+    ("2キロオームの抵抗に10ボルトを加えたときの電流", "2kΩの抵抗に10Vを加えたときの電流"),
+    ("5オームの抵抗に2アンペアの電流", "5Ωの抵抗に2Aの電流"),
+    # 文末の記号
+    ("オームの法則？", "オームの法則"),
+    ("オームの法則。", "オームの法則"),
+    ("オームの法則?!", "オームの法則"),
+    # つなぎの言葉・丁寧語
+    ("すみません、オームの法則について教えてください", "オームの法則"),
+    ("先生 オームの法則とは何ですか？", "オームの法則"),
+    ("えっと、キルヒホッフの法則を説明してください。", "キルヒホッフの法則"),
+])
+def test_canonicalize_query_absorbs_variants(variant, expected):
+    assert canonicalize_query(variant) == expected
+
+
+def test_canonicalize_query_keeps_values():
+    # 数値・単位が異なる質問は別のキーにする
+    assert canonicalize_query("10Vの電圧") != canonicalize_query("100Vの電圧")
+    assert canonicalize_query("2kΩの抵抗") != canonicalize_query("2MΩの抵抗")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("すみません", "すみません"),
+    ("質問です。", "質問です。"),
+    ("？", "？"),
+])
+def test_canonicalize_query_falls_back_for_filler_only_input(text, expected):
+    # つなぎの言葉だけの入力は空文字列にせず、正規化した元の文を使う
+    assert canonicalize_query(text) == normalize_text(expected)
+
+
+def test_canonicalize_query_empty_input():
+    assert canonicalize_query("") == ""
+    assert canonicalize_query("   ") == ""
+
+
+def test_normalize_text_keeps_sentence():
+    # 回路計算ソルバー用の正規化は単位・全角だけを統一し、文末表現は残す
+    assert normalize_text("１０ボルト、５オームの時の電流は？") == "10V、5Ωの時の電流は?"
+
+
+class CountingEmbeddings:
+    """埋め込んだ文字列を記録する埋め込みモデル"""
+
+    def __init__(self):
+        self.queries = []
+
+    def embed_query(self, text):
+        self.queries.append(text)
+        return [float(len(text)), 1.0]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+@pytest.fixture
+def cached_embeddings(tmp_path, monkeypatch):
+    pytest.importorskip("langchain_core")
+    from cached_embeddings import CachedQueryEmbeddings
+
+    monkeypatch.setattr(ct, "QUERY_EMBEDDING_CACHE_DB_PATH", str(tmp_path / "query_embeddings.db"))
+    return CachedQueryEmbeddings(CountingEmbeddings())
+
+
+def test_cached_query_embeddings_hit_and_miss(cached_embeddings):
+    base = cached_embeddings.embeddings
+
+    first = cached_embeddings.embed_query("オームの法則とは？")
+    # 表記ゆれの違いだけの質問はキャッシュから返す
+    assert cached_embeddings.embed_query("すみません、オームの法則について教えてください") == first
+    assert base.queries == ["オームの法則"]
+
+    # 別の質問は元のモデルで埋め込む
+    cached_embeddings.embed_query("キルヒホッフの法則")
+    assert base.queries == ["オームの法則", "キルヒホッフの法則"]
+
+
+def test_cached_query_embeddings_shared_through_sqlite(cached_embeddings):
+    from cached_embeddings import CachedQueryEmbeddings
+
+    vector = cached_embeddings.embed_query("オームの法則")
+    # 別のワーカー（別のインスタンス）もSQLiteに保存されたベクトルを使う
+    other = CachedQueryEmbeddings(CountingEmbeddings())
+    assert other.embed_query("オームの法則？") == vector
+    assert other.embeddings.queries == []
+
+
+def test_cached_query_embeddings_does_not_cache_documents(cached_embeddings):
+    cached_embeddings.embed_documents(["オームの法則", "オームの法則"])
+    assert cached_embeddings.embeddings.queries == ["オームの法則", "オームの法則"]
@@ -0,0 +1,300 @@
+"""
+レスポンスキャッシュ（response_cache.py）のテスト
+"""
+
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+import pytest
+
+import response_cache
+from query_canonicalizer import canonicalize_query
+from response_cache import SQLiteResponseCache, TieredResponseCache
+
+
+class FakeClock:
+    """time.time()の代わりに使う時計（advanceで進める）"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(response_cache, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "cache" / "response_cache.db"
+
+
+def test_entry_expires_after_ttl(db_path, clock):
+    cache = SQLiteResponseCache(db_path)
+    cache.set("key", "質問", "回答", ttl_seconds=60)
+
+    clock.advance(59)
+    assert cache.get("key") == "回答"
+    clock.advance(1)
+    assert cache.get("key") is None
+
+
+def test_evict_expired_removes_only_expired_entries(db_path, clock):
+    cache = SQLiteResponseCache(db_path)
+    cache.set("short", "質問1", "回答1", ttl_seconds=10)
+    cache.set("long", "質問2", "回答2", ttl_seconds=100)
+
+    clock.advance(10)
+    assert cache.evict_expired() == 1
+    assert cache.count() == 1
+    assert cache.get("long") == "回答2"
+    assert cache.get_stats()["expirations"] == 1
+
+
+def write_legacy_file(cache_dir, name: str, query: str, response: str, created_at: float, expires_at: float):
+    """旧形式（1クエリ1ファイルのJSON）のキャッシュファイルを作成"""
+    with open(cache_dir / f"{name}.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "query": query,
+            "response": response,
+            "timestamp": datetime.fromtimestamp(created_at).isoformat(),
+            "expires": datetime.fromtimestamp(expires_at).isoformat(),
+        }, f, ensure_ascii=False)
+
+
+def test_migrate_json_files_rekeys_by_stored_query(db_path, tmp_path, clock):
+    legacy_dir = tmp_path / "legacy"
+    legacy_dir.mkdir()
+    # 旧形式のファイル名は正規化前の質問文のハッシュ
+    write_legacy_file(legacy_dir, "raw-md5-1", "オームの法則とは何ですか？", "V = IR", clock.now - 60, clock.now + 3600)
+    write_legacy_file(legacy_dir, "raw-md5-2", "期限切れの質問", "古い回答", clock.now - 7200, clock.now - 60)
+    (legacy_dir / "raw-md5-3.json").write_text("{壊れたJSON", encoding="utf-8")
+
+    cache = SQLiteResponseCache(db_path)
+    assert cache.migrate_json_files(legacy_dir, canonicalize_query) == 1
+
+    # 表記ゆれのある質問でも、現在の方法で作ったキーでヒットする
+    assert cache.get(canonicalize_query("すみません、オームの法則とは")) == "V = IR"
+    assert cache.get("raw-md5-1") is None
+    assert cache.count() == 1
+    # 取り込んだファイル・取り込めなかったファイルは削除する
+    assert list(legacy_dir.glob("*.json")) == []
+
+
+def test_migrate_json_files_keeps_expiry(db_path, tmp_path, clock):
+    legacy_dir = tmp_path / "legacy"
+    legacy_dir.mkdir()
+    write_legacy_file(legacy_dir, "raw-md5", "質問", "回答", clock.now - 60, clock.now + 120)
+
+    cache = SQLiteResponseCache(db_path)
+    cache.migrate_json_files(legacy_dir, lambda query: query)
+
+    clock.advance(119)
+    assert cache.get("質問") == "回答"
+    clock.advance(1)
+    assert cache.get("質問") is None
+
+
+def test_migrate_json_files_without_files(db_path, tmp_path):
+    cache = SQLiteResponseCache(db_path)
+    assert cache.migrate_json_files(tmp_path / "missing", lambda query: query) == 0
+
+
+def test_refresh_on_access_extends_expiry(db_path, clock):
+    cache = SQLiteResponseCache(db_path, refresh_ttl_seconds=100)
+    cache.set("key", "質問", "回答", ttl_seconds=100)
+
+    clock.advance(90)
+    response, expires_at = cache.get_entry("key")
+    assert response == "回答"
+    assert expires_at == clock.now + 100
+    # 最初の期限（100秒後）を過ぎても、ヒットした時点から延長されている
+    clock.advance(90)
+    assert cache.get("key") == "回答"
+    clock.advance(100)
+    assert cache.get("key") is None
+
+
+def test_without_refresh_expiry_is_fixed(db_path, clock):
+    cache = SQLiteResponseCache(db_path)
+    cache.set("key", "質問", "回答", ttl_seconds=100)
+
+    clock.advance(90)
+    assert cache.get("key") == "回答"
+    clock.advance(10)
+    assert cache.get("key") is None
+
+
+def fill(cache, clock, keys):
+    """1秒ずつ間をあけて保存（最終アクセス時刻で順序が決まるようにする）"""
+    for key in keys:
+        cache.set(key, key, "回答", ttl_seconds=3600)
+        clock.advance(1)
+
+
+def test_lru_evicts_least_recently_used_by_entries(db_path, clock):
+    cache = SQLiteResponseCache(db_path, max_entries=2, eviction_policy="lru")
+    fill(cache, clock, ["a", "b"])
+    cache.get("a")
+    clock.advance(1)
+
+    cache.set("c", "c", "回答", ttl_seconds=3600)
+    assert cache.get("b") is None
+    assert cache.get("a") == "回答"
+    assert cache.get("c") == "回答"
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_lfu_evicts_least_frequently_used_by_entries(db_path, clock):
+    cache = SQLiteResponseCache(db_path, max_entries=2, eviction_policy="lfu")
+    fill(cache, clock, ["a", "b"])
+    # aは2回・bは1回。最後にアクセスしたのはbでも、回数の少ないbを追い出す
+    cache.get("a")
+    cache.get("a")
+    clock.advance(1)
+    cache.get("b")
+    clock.advance(1)
+
+    cache.set("c", "c", "回答", ttl_seconds=3600)
+    assert cache.get("b") is None
+    assert cache.get("a") == "回答"
+
+
+def test_evicts_by_bytes(db_path, clock):
+    # 1件あたり 1バイト（質問）+ 6バイト（回答）= 7バイト
+    cache = SQLiteResponseCache(db_path, max_bytes=15)
+    fill(cache, clock, ["a", "b", "c"])
+
+    stats = cache.get_stats()
+    assert stats["entries"] == 2
+    assert stats["bytes"] == 14
+    assert cache.get("a") is None
+
+
+def test_keeps_entry_just_saved_even_if_over_limit(db_path, clock):
+    cache = SQLiteResponseCache(db_path, max_bytes=10)
+    fill(cache, clock, ["a"])
+    cache.set("large", "large", "長い回答" * 10, ttl_seconds=3600)
+
+    assert cache.count() == 1
+    assert cache.get("large") is not None
+
+
+def test_expired_entries_are_removed_before_eviction(db_path, clock):
+    cache = SQLiteResponseCache(db_path, max_entries=2)
+    cache.set("old", "old", "回答", ttl_seconds=10)
+    fill(cache, clock, ["a"])
+    clock.advance(10)
+
+    cache.set("b", "b", "回答", ttl_seconds=3600)
+    stats = cache.get_stats()
+    assert stats["expirations"] == 1
+    assert stats["evictions"] == 0
+    assert cache.get("a") == "回答"
+
+
+def stored_counters(db_path) -> dict:
+    """データベースに書き込まれた統計カウンタ"""
+    with closing(sqlite3.connect(str(db_path))) as conn:
+        return dict(conn.execute("SELECT name, value FROM cache_stats").fetchall())
+
+
+def test_misses_are_written_in_batches(db_path, clock):
+    cache = SQLiteResponseCache(db_path, stats_flush_interval_seconds=60)
+    for _ in range(3):
+        assert cache.get("missing") is None
+    # ミスのたびには書き込まない
+    assert stored_counters(db_path).get("misses") is None
+
+    clock.advance(60)
+    cache.get("missing")
+    assert stored_counters(db_path)["misses"] == 4
+
+
+def test_pending_misses_are_written_with_other_writes(db_path, clock):
+    cache = SQLiteResponseCache(db_path, stats_flush_interval_seconds=60)
+    cache.get("missing")
+    cache.set("key", "質問", "回答", ttl_seconds=60)
+    assert stored_counters(db_path)["misses"] == 1
+
+    cache.get("missing")
+    stats = cache.get_stats()
+    assert stats["misses"] == 2
+    assert stats["hit_ratio"] == 0.0
+
+
+def make_worker(db_path):
+    """1ワーカー分の2層キャッシュ（同じSQLiteファイルを共有する）"""
+    return TieredResponseCache(SQLiteResponseCache(db_path), l1_max_entries=10, l1_ttl_seconds=300)
+
+
+def test_l1_sees_set_from_other_process(db_path, clock):
+    worker1 = make_worker(db_path)
+    worker2 = make_worker(db_path)
+    worker1.set("key", "質問", "古い回答", ttl_seconds=3600)
+    assert worker2.get("key") == "古い回答"
+
+    worker1.set("key", "質問", "新しい回答", ttl_seconds=3600)
+    assert worker2.get("key") == "新しい回答"
+
+
+def test_l1_keeps_unchanged_keys_when_other_keys_are_set(db_path, clock):
+    worker1 = make_worker(db_path)
+    worker2 = make_worker(db_path)
+    worker1.set("a", "a", "回答", ttl_seconds=3600)
+    worker2.get("a")
+
+    worker1.set("b", "b", "回答", ttl_seconds=3600)
+    worker2.get("a")
+    assert worker2.get_stats()["l1_hits"] == 1
+
+
+def test_l1_sees_clear_from_other_process(db_path, clock):
+    worker1 = make_worker(db_path)
+    worker2 = make_worker(db_path)
+    worker1.set("key", "質問", "回答", ttl_seconds=3600)
+    assert worker2.get("key") == "回答"
+
+    worker1.clear()
+    assert worker2.get("key") is None
+
+
+def test_l1_is_cleared_when_change_log_was_pruned(db_path, clock, monkeypatch):
+    monkeypatch.setattr(response_cache, "CHANGE_LOG_SIZE", 2)
+    worker1 = make_worker(db_path)
+    worker2 = make_worker(db_path)
+    worker1.set("key", "質問", "古い回答", ttl_seconds=3600)
+    worker2.get("key")
+
+    worker1.set("key", "質問", "新しい回答", ttl_seconds=3600)
+    worker1.set("other1", "other1", "回答", ttl_seconds=3600)
+    worker1.set("other2", "other2", "回答", ttl_seconds=3600)
+    assert worker2.l2.get_changed_keys(worker2._generation) is None
+    assert worker2.get("key") == "新しい回答"
+
+
+def test_tiered_stats_keep_l1_separate_from_shared_l2(db_path, clock):
+    worker1 = make_worker(db_path)
+    worker2 = make_worker(db_path)
+    worker1.set("key", "質問", "回答", ttl_seconds=3600)
+    worker1.get("key")  # L2のヒット
+    worker1.get("key")  # L1のヒット
+    worker2.get("key")  # L2のヒット
+    worker2.get("missing")
+
+    stats = worker2.get_stats()
+    # L2は全ワーカーの合計、L1はこのワーカーの値
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+    assert stats["hit_ratio"] == pytest.approx(2 / 3)
+    assert (stats["l1_hits"], stats["l1_misses"]) == (0, 2)
+    assert worker1.get_stats()["l1_hits"] == 1
@@ -0,0 +1,86 @@
+"""
+API使用量の記録用コールバックモジュール
+LangChainのChain内部で行われるLLM呼び出しのトークン使用量・モデル・レイテンシと、段階ごとの所要時間を記録する機能を提供
+（LangChainの読み込みが重いため、cost_optimizerとは分けて利用時に読み込む）
+"""
+
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+from cost_optimizer import extract_token_usage, extract_model_name
+from metrics import metrics_registry
+
+
+class TokenUsageCallbackHandler(BaseCallbackHandler):
+    """Chain内部のLLM呼び出しのトークン使用量・モデル・レイテンシを記録するコールバック"""
+
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+        self._started = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        latency_ms = (time.perf_counter() - started) * 1000 if started is not None else None
+        default_model = (response.llm_output or {}).get("model_name")
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if message is not None:
+                    self.optimizer.record_usage(
+                        extract_token_usage(message),
+                        model=extract_model_name(message, default_model),
+                        latency_ms=latency_ms
+                    )
+
+
+class StageTimingCallbackHandler(BaseCallbackHandler):
+    """
+    Chain内部の処理段階の所要時間をmetrics_registryに記録するコールバック
+    LLM呼び出しは「stage:<段階>」のタグ（llm.with_config(tags=[...])）の段階として、検索はchain_retrievalとして記録する
+    """
+
+    def __init__(self):
+        self._started = {}
+
+    def _start(self, run_id, stage):
+        if stage:
+            self._started[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id, error=False):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            stage, started_at = started
+            metrics_registry.observe(stage, time.perf_counter() - started_at, error=error)
+
+    @staticmethod
+    def _stage_from_tags(tags):
+        for tag in tags or []:
+            if tag.startswith("stage:"):
+                return tag[len("stage:"):]
+        return None
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        self._start(run_id, self._stage_from_tags(tags))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, tags=None, **kwargs):
+        self._start(run_id, self._stage_from_tags(tags))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id, "chain_retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
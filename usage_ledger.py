@@ -0,0 +1,215 @@
+"""
+API使用量の記録モジュール
+SQLite（WALモード）の単一ファイルに、リクエストごとのトークン数・モデル・レイテンシ・推定コストを記録し、
+日次の集計値を原子的に更新する機能を提供（複数セッション・複数プロセスから安全に書き込める）
+"""
+
+import json
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    day TEXT NOT NULL,
+    model TEXT,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms REAL,
+    cost REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_usage_events_day ON usage_events (day);
+CREATE TABLE IF NOT EXISTS daily_usage (
+    day TEXT PRIMARY KEY,
+    calls INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    latency_ms_total REAL NOT NULL DEFAULT 0,
+    latency_count INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+EMPTY_DAY = {
+    "calls": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "cached_tokens": 0,
+    "cost": 0.0,
+    "avg_latency_ms": None,
+}
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int,
+                  pricing: dict) -> float:
+    """
+    トークン数から推定コストを計算
+
+    Args:
+        model: モデル名（"gpt-4o-mini-2024-07-18" のような日付付きの名前も前方一致で解決）
+        prompt_tokens: 入力トークン数（キャッシュ済みを含む）
+        completion_tokens: 出力トークン数
+        cached_tokens: 入力のうちプロンプトキャッシュにヒットしたトークン数
+        pricing: モデル名 → {"input", "cached_input", "output"}（100万トークンあたりの単価）
+
+    Returns:
+        推定コスト（単価表に無いモデルは0）
+    """
+    prices = pricing.get(model) if model else None
+    if prices is None and model:
+        prices = next((p for name, p in sorted(pricing.items(), key=lambda x: -len(x[0]))
+                       if model.startswith(name)), None)
+    if prices is None:
+        return 0.0
+
+    cached_tokens = min(cached_tokens, prompt_tokens)
+    return (
+        (prompt_tokens - cached_tokens) * prices["input"]
+        + cached_tokens * prices.get("cached_input", prices["input"])
+        + completion_tokens * prices["output"]
+    ) / 1_000_000
+
+
+class UsageLedger:
+    """API使用量の台帳（明細と日次集計を同一トランザクションで更新）"""
+
+    def __init__(self, db_path: str, retention_days: int = 30, busy_timeout: float = 10.0):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.retention_days = retention_days
+        self.busy_timeout = busy_timeout
+        self._initialize()
+
+    def _connect(self) -> sqlite3.Connection:
+        """接続を作成（プロセス・スレッドをまたいで安全に使えるよう呼び出しごとに接続）"""
+        conn = sqlite3.connect(str(self.db_path), timeout=self.busy_timeout, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _initialize(self):
+        """WALモードの設定とテーブル作成"""
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @staticmethod
+    def today() -> str:
+        """集計に使う日付（ローカル時刻）"""
+        return datetime.now().strftime("%Y-%m-%d")
+
+    def record(self, model: str = None, prompt_tokens: int = 0, completion_tokens: int = 0,
+               cached_tokens: int = 0, latency_ms: float = None, cost: float = 0.0, calls: int = 1):
+        """1リクエスト分の使用量を明細に追加し、日次集計を加算"""
+        now = time.time()
+        day = self.today()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO usage_events "
+                "(created_at, day, model, prompt_tokens, completion_tokens, cached_tokens, latency_ms, cost) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (now, day, model, prompt_tokens, completion_tokens, cached_tokens, latency_ms, cost)
+            )
+            conn.execute(
+                "INSERT INTO daily_usage "
+                "(day, calls, prompt_tokens, completion_tokens, cached_tokens, cost, latency_ms_total, latency_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(day) DO UPDATE SET "
+                "calls = calls + excluded.calls, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cached_tokens = cached_tokens + excluded.cached_tokens, "
+                "cost = cost + excluded.cost, "
+                "latency_ms_total = latency_ms_total + excluded.latency_ms_total, "
+                "latency_count = latency_count + excluded.latency_count",
+                (day, calls, prompt_tokens, completion_tokens, cached_tokens, cost,
+                 latency_ms or 0.0, 1 if latency_ms is not None else 0)
+            )
+            conn.execute("COMMIT")
+
+    def get_day(self, day: str = None) -> dict:
+        """指定日（省略時は当日）の集計を取得（主キー1行の読み込みのみ）"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT calls, prompt_tokens, completion_tokens, cached_tokens, cost, latency_ms_total, latency_count "
+                "FROM daily_usage WHERE day = ?",
+                (day or self.today(),)
+            ).fetchone()
+
+        if row is None:
+            return dict(EMPTY_DAY)
+        calls, prompt_tokens, completion_tokens, cached_tokens, cost, latency_total, latency_count = row
+        return {
+            "calls": calls,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "cost": cost,
+            "avg_latency_ms": latency_total / latency_count if latency_count else None,
+        }
+
+    def get_total_calls(self) -> int:
+        """累計の呼び出し回数を取得"""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COALESCE(SUM(calls), 0) FROM daily_usage").fetchone()[0]
+
+    def get_events(self, day: str = None) -> list:
+        """指定日（省略時は当日）の明細を取得"""
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT created_at, model, prompt_tokens, completion_tokens, cached_tokens, latency_ms, cost "
+                "FROM usage_events WHERE day = ? ORDER BY id",
+                (day or self.today(),)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def prune(self) -> int:
+        """保存期間を過ぎた明細を削除（日次集計は累計のため残す）"""
+        cutoff_day = (datetime.now() - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        with closing(self._connect()) as conn:
+            return conn.execute("DELETE FROM usage_events WHERE day < ?", (cutoff_day,)).rowcount
+
+    def migrate_json_file(self, usage_file) -> bool:
+        """旧形式（api_usage.json）の日次集計を取り込み、元ファイルを退避"""
+        usage_path = Path(usage_file)
+        if not usage_path.exists():
+            return False
+
+        try:
+            with open(usage_path, "r") as f:
+                data = json.load(f)
+        except Exception:
+            # 破損したファイルは取り込まない
+            return False
+
+        daily_calls = data.get("daily_calls", {})
+        daily_tokens = data.get("daily_tokens", {})
+        rows = []
+        for day in sorted(set(daily_calls) | set(daily_tokens)):
+            tokens = daily_tokens.get(day, {})
+            rows.append((day, daily_calls.get(day, 0), tokens.get("prompt_tokens", 0),
+                         tokens.get("completion_tokens", 0), tokens.get("cached_tokens", 0)))
+        # 日次の内訳が残っていない過去分の呼び出し回数は、累計が変わらないよう1行にまとめる
+        older_calls = data.get("total_calls", 0) - sum(daily_calls.values())
+        if older_calls > 0:
+            rows.append(("0000-00-00", older_calls, 0, 0, 0))
+
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR IGNORE INTO daily_usage (day, calls, prompt_tokens, completion_tokens, cached_tokens) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.execute("COMMIT")
+
+        usage_path.replace(usage_path.with_suffix(".json.migrated"))
+        return True
@@ -8,22 +8,14 @@
 import os
 from dotenv import load_dotenv
 import streamlit as st
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.schema import HumanMessage
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.text_splitter import CharacterTextSplitter
 import constants as ct
+import llm_client
+from admission import AdmissionRejected
+from chunk_preprocessor import preprocess_chunks
+from lazy_imports import check_vector_support
 
-# PDF処理とベクターストアのためのインポート
-try:
-    from langchain_community.document_loaders import PyMuPDFLoader
-    from langchain_community.vectorstores import FAISS
-    VECTOR_SUPPORT = True
-except ImportError as e:
-    VECTOR_SUPPORT = False
-    IMPORT_ERROR = str(e)
+# PDF処理とベクターストアに必要なライブラリの確認（LangChain・FAISSは利用時に読み込む）
+VECTOR_SUPPORT, IMPORT_ERROR = check_vector_support()
 
 
 ############################################################
@@ -69,6 +61,42 @@ def build_error_message(message):
     return "\n".join([message, ct.COMMON_ERROR_MESSAGE])
 
 
+def get_session_cancel_check():
+    """
+    現在のStreamlitのセッションが終了した（ブラウザを閉じた等）かを確認する関数を取得
+
+    Returns:
+        セッションが終了していればTrueを返す関数（Streamlitの外から呼ばれた場合はNone）
+    """
+    from streamlit import runtime
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    if ctx is None or not runtime.exists():
+        return None
+    instance = runtime.get_instance()
+    session_id = ctx.session_id
+    return lambda: not instance.is_active_session(session_id)
+
+
+def get_conversation_memory():
+    """
+    セッションの会話履歴（トークン数の上限付き）を取得
+
+    Returns:
+        ConversationMemoryのオブジェクト
+    """
+    if "conversation_memory" not in st.session_state:
+        from conversation_memory import ConversationMemory
+        st.session_state.conversation_memory = ConversationMemory(
+            ct.HISTORY_RECENT_TOKEN_BUDGET,
+            ct.HISTORY_SUMMARY_TOKEN_BUDGET,
+            min_recent_turns=ct.HISTORY_MIN_RECENT_TURNS,
+            is_cancelled=get_session_cancel_check()
+        )
+    return st.session_state.conversation_memory
+
+
 def get_llm_response(chat_message):
     """
     LLMからの回答取得
@@ -79,52 +107,15 @@ def get_llm_response(chat_message):
     Returns:
         LLMからの回答
     """
-    # LLMのオブジェクトを用意
-    llm = ChatOpenAI(model_name=ct.MODEL, temperature=ct.TEMPERATURE)
-
-    # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのプロンプトテンプレートを作成
-    question_generator_template = ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT
-    question_generator_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", question_generator_template),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}")
-        ]
-    )
-
-    # モードによってLLMから回答を取得する用のプロンプトを変更
-    if st.session_state.mode == ct.ANSWER_MODE_1:
-        # モードが「社内文書検索」の場合のプロンプト
-        question_answer_template = ct.SYSTEM_PROMPT_DOC_SEARCH
-    else:
-        # モードが「社内問い合わせ」の場合のプロンプト
-        question_answer_template = ct.SYSTEM_PROMPT_INQUIRY
-    # LLMから回答を取得する用のプロンプトテンプレートを作成
-    question_answer_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", question_answer_template),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}")
-        ]
-    )
+    import rag_pipeline
 
-    # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのRetrieverを作成
-    history_aware_retriever = create_history_aware_retriever(
-        llm, st.session_state.retriever, question_generator_prompt
+    chain = rag_pipeline.create_conversational_chain(st.session_state.retriever, st.session_state.mode)
+    return rag_pipeline.invoke_conversational_chain(
+        chain, get_conversation_memory(), chat_message,
+        user_id=st.session_state.get("user_id"), notify=st.empty().info,
+        is_cancelled=get_session_cancel_check()
     )
 
-    # LLMから回答を取得する用のChainを作成
-    question_answer_chain = create_stuff_documents_chain(llm, question_answer_prompt)
-    # 「RAG x 会話履歴の記憶機能」を実現するためのChainを作成
-    chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-    # LLMへのリクエストとレスポンス取得
-    llm_response = chain.invoke({"input": chat_message, "chat_history": st.session_state.chat_history})
-    # LLMレスポンスを会話履歴に追加
-    st.session_state.chat_history.extend([HumanMessage(content=chat_message), llm_response["answer"]])
-
-    return llm_response
-
 
 def initialize_rag():
     """
@@ -133,6 +124,10 @@ def initialize_rag():
     if not VECTOR_SUPPORT:
         raise ImportError(f"必要なライブラリがインストールされていません: {IMPORT_ERROR}")
     
+    from langchain_community.document_loaders import PyMuPDFLoader
+    from langchain_community.vectorstores import FAISS
+    from langchain.text_splitter import CharacterTextSplitter
+    
     # 存在するファイルのみを選択
     existing_files = [pdf_path for pdf_path in ct.PDF_FILES if os.path.exists(pdf_path)]
     
@@ -142,8 +137,8 @@ def initialize_rag():
     if not existing_files:
         raise ValueError("利用可能なPDFファイルがありません。")
     
-    # OpenAI APIキーの確認
-    if not os.getenv("OPENAI_API_KEY"):
+    # OpenAI APIキー（またはスタブサーバーの接続先）の確認
+    if not llm_client.is_openai_configured():
         raise ValueError("OpenAI APIキーが設定されていません。")
     
     # 全PDFファイルの読み込み
@@ -184,10 +179,11 @@ def initialize_rag():
     max_chunks = min(ct.FAISS_MAX_CHUNKS, len(split_docs))
     test_chunks = split_docs[:max_chunks]
     
+    # 整形テキスト・重要ポイントを事前計算
+    preprocess_chunks(test_chunks)
+    
     # 埋め込みベクター作成
-    embeddings = OpenAIEmbeddings(
-        model=ct.OPENAI_EMBEDDING_MODEL
-    )
+    embeddings = llm_client.create_embeddings(cache_queries=True)
     
     # FAISSベクターストア作成
     vectorstore = FAISS.from_documents(test_chunks, embeddings)
@@ -198,36 +194,11 @@ def initialize_rag():
     st.session_state.retriever = vectorstore.as_retriever(search_kwargs={"k": ct.SEARCH_K})
     
     # 会話履歴の初期化
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+    get_conversation_memory()
     
     return True
 
 
-def format_latex_equations(text):
-    """
-    LaTeX数式の整形処理
-    """
-    import re
-    
-    # [ ] で囲まれた数式を $$ $$ に変換
-    text = re.sub(r'\[\s*([^\[\]]+?)\s*\]', r'$$\1$$', text)
-    
-    # 単一の$で囲まれた数式を$$に変換（既に$$で囲まれていない場合のみ）
-    text = re.sub(r'(?<!\$)\$(?!\$)([^$]+?)(?<!\$)\$(?!\$)', r'$$\1$$', text)
-    
-    # 数式内のアンダースコアを適切に処理（I_1 → I_{1}）
-    text = re.sub(r'\$\$([^$]*?)([A-Za-z])_([0-9]+)([^$]*?)\$\$', r'$$\1\2_{\3}\4$$', text)
-    
-    # 複数の連続する$$を整理
-    text = re.sub(r'\$\$\s*\$\$', r'$$', text)
-    
-    # 数式の前後に適切な改行とスペースを追加
-    text = re.sub(r'\$\$([^$]+?)\$\$', r'\n\n$$\1$$\n\n', text)
-    
-    return text
-
-
 def get_rag_chain_answer_qa(user_input):
     """
     RAGチェーンを使った問い合わせ回答の取得
@@ -239,51 +210,26 @@ def get_rag_chain_answer_qa(user_input):
         }
     
     try:
-        # LLMのオブジェクトを用意
-        llm = ChatOpenAI(model_name=ct.MODEL, temperature=ct.TEMPERATURE)
-
-        # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのプロンプトテンプレートを作成
-        question_generator_template = ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT
-        question_generator_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", question_generator_template),
-                MessagesPlaceholder("chat_history"),
-                ("human", "{input}")
-            ]
-        )
-
-        # 問い合わせ用のプロンプト
-        question_answer_template = ct.SYSTEM_PROMPT_INQUIRY
-        question_answer_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", question_answer_template),
-                MessagesPlaceholder("chat_history"),
-                ("human", "{input}")
-            ]
-        )
-
-        # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのRetrieverを作成
-        history_aware_retriever = create_history_aware_retriever(
-            llm, st.session_state.retriever, question_generator_prompt
+        import rag_pipeline
+
+        # 問い合わせ用のプロンプトで、会話履歴を踏まえて回答
+        chain = rag_pipeline.create_conversational_chain(st.session_state.retriever, ct.ANSWER_MODE_2)
+        llm_response = rag_pipeline.invoke_conversational_chain(
+            chain, get_conversation_memory(), user_input,
+            user_id=st.session_state.get("user_id"), notify=st.empty().info,
+            is_cancelled=get_session_cancel_check()
         )
 
-        # LLMから回答を取得する用のChainを作成
-        question_answer_chain = create_stuff_documents_chain(llm, question_answer_prompt)
-        # 「RAG x 会話履歴の記憶機能」を実現するためのChainを作成
-        chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-        # LLMへのリクエストとレスポンス取得
-        chat_history = st.session_state.get('chat_history', [])
-        llm_response = chain.invoke({"input": user_input, "chat_history": chat_history})
-        
-        # LLMレスポンスを会話履歴に追加
-        if "chat_history" not in st.session_state:
-            st.session_state.chat_history = []
-        st.session_state.chat_history.extend([HumanMessage(content=user_input), llm_response["answer"]])
-
         return {
             "answer": llm_response["answer"],
-            "source_documents": llm_response.get("context", [])
+            "source_documents": llm_response.get("context", []),
+            "history_tokens": llm_response["history_tokens"]
+        }
+    
+    except AdmissionRejected as e:
+        return {
+            "answer": f"⏳ {e}",
+            "source_documents": []
         }
     
     except Exception as e: